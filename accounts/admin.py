@@ -1,6 +1,8 @@
 from django.contrib import admin
 from django.contrib.auth import get_user_model
+from django.utils import timezone
 from .models import Category, Product, WishlistItem, ShippingInformation
+from .replicas import ReplicaChangeListMixin
 
 User = get_user_model()
 
@@ -10,12 +12,12 @@ admin.site.register(ShippingInformation)
 
 
 @admin.register(Category)
-class CategoryAdmin(admin.ModelAdmin):
+class CategoryAdmin(ReplicaChangeListMixin, admin.ModelAdmin):
     list_display = ['name', 'slug']
     prepopulated_fields = {'slug': ('name',)}
 
 @admin.register(Product)
-class ProductAdmin(admin.ModelAdmin):
+class ProductAdmin(ReplicaChangeListMixin, admin.ModelAdmin):
     list_display = ['id', 'name', 'slug', 'price', 'in_stock', 'is_active']
     list_editable = ['price', 'in_stock', 'is_active']
     prepopulated_fields = {'slug': ('name',)}
@@ -28,32 +30,70 @@ class CartItemInline(admin.TabularInline):
     extra = 0
 
 @admin.register(Cart)
-class CartAdmin(admin.ModelAdmin):
-    list_display = ['id', 'user', 'product_names','created_at', 'get_total_items', 'get_total_price']
+class CartAdmin(ReplicaChangeListMixin, admin.ModelAdmin):
+    list_display = ['id', 'user', 'product_names','created_at', 'item_count', 'get_total_price']
+    readonly_fields = ['item_count', 'subtotal']
     inlines = [CartItemInline]  # インライン表示の追加
 
-    def get_total_items(self, obj):
-        return obj.items.count()
+    def get_queryset(self, request):
+        return super().get_queryset(request).select_related('user').prefetch_related('items__product')
+
+    def save_related(self, request, form, formsets, change):
+        super().save_related(request, form, formsets, change)
+        # インラインで明細が変更された場合に集計値を計算し直す
+        Cart.objects.filter(pk=form.instance.pk).refresh_summary()
 
     def get_total_price(self, obj):
-        total_price = sum(item.get_total_price() for item in obj.items.all())
-        return f"${total_price:.2f}"
+        return f"${obj.subtotal:.2f}"
     
     def product_names(self, obj):
         return ", ".join(item.product.name for item in obj.items.all())
     
-    get_total_items.short_description = 'Total Items'
     get_total_price.short_description = 'Total Price'
     product_names.short_description = 'Product Names'
 
 
 
 @admin.register(CartItem)
-class CartItemAdmin(admin.ModelAdmin):
+class CartItemAdmin(ReplicaChangeListMixin, admin.ModelAdmin):
     list_display = ['id', 'cart', 'product', 'quantity', 'get_total_price']
 
+    def get_queryset(self, request):
+        return super().get_queryset(request).select_related('product')
+
+    def save_model(self, request, obj, form, change):
+        super().save_model(request, obj, form, change)
+        Cart.objects.filter(pk=obj.cart_id).refresh_summary()
+
+    def delete_model(self, request, obj):
+        super().delete_model(request, obj)
+        Cart.objects.filter(pk=obj.cart_id).refresh_summary()
+
+    def delete_queryset(self, request, queryset):
+        cart_ids = list(queryset.values_list('cart_id', flat=True))
+        super().delete_queryset(request, queryset)
+        Cart.objects.filter(pk__in=cart_ids).refresh_summary()
+
     def get_total_price(self, obj):
         return f"${obj.get_total_price():.2f}"
 
     get_total_price.short_description = 'Total Price'
 
+
+
+
+from .models import WebhookEvent, WebhookStatus
+@admin.register(WebhookEvent)
+class WebhookEventAdmin(ReplicaChangeListMixin, admin.ModelAdmin):
+    list_display = ['event_id', 'type', 'status', 'attempts', 'received_at', 'processed_at']
+    list_filter = ['status', 'type']
+    search_fields = ['event_id']
+    actions = ['retry_events']
+
+    def retry_events(self, request, queryset):
+        # 失敗したイベントを再度処理待ちに戻す
+        queryset.exclude(status=WebhookStatus.DONE.value).update(
+            status=WebhookStatus.PENDING.value, attempts=0, next_attempt_at=timezone.now()
+        )
+
+    retry_events.short_description = '選択したイベントを再処理する'
@@ -0,0 +1,60 @@
+from django.conf import settings
+from rest_framework_simplejwt.views import TokenObtainPairView
+
+from . import views
+from .executors import run_in_executor
+
+
+def _dispatch(view, request, *args, **kwargs):
+    response = view(request, *args, **kwargs)
+    # レンダリングもワーカーで行う（ハンドラーに任せると1つの共有スレッドで実行される）
+    if hasattr(response, 'render') and callable(response.render):
+        response.render()
+    return response
+
+
+class AsyncCatalogView:
+    """
+    カタログの同期DRFビューを非同期ビューとして提供する（uvicornワーカーで使用）
+    Django 3.2 のORMとキャッシュには非同期APIがないため、ビュー全体を上限付きのスレッドプールで実行する
+    1ワーカーで同時に処理できるリクエスト数は CATALOG_ASYNC_WORKERS になる
+    """
+    executor = 'catalog'
+    workers_setting = 'CATALOG_ASYNC_WORKERS'
+
+    def __init__(self, view_class):
+        self.view_class = view_class
+
+    def as_view(self, **initkwargs):
+        view = self.view_class.as_view(**initkwargs)
+
+        async def async_view(request, *args, **kwargs):
+            return await run_in_executor(
+                self.executor, getattr(settings, self.workers_setting), _dispatch, view, request, *args, **kwargs
+            )
+
+        async_view.view_class = self.view_class
+        async_view.csrf_exempt = True
+        return async_view
+
+
+ProductList = AsyncCatalogView(views.ProductList)
+ProductDetail = AsyncCatalogView(views.ProductDetail)
+ProductSearch = AsyncCatalogView(views.ProductSearch)
+RelatedProducts = AsyncCatalogView(views.RelatedProducts)
+CategoryList = AsyncCatalogView(views.CategoryList)
+CategoryProductsList = AsyncCatalogView(views.CategoryProductsList)
+SalesDiscountProducts = AsyncCatalogView(views.SalesDiscountProducts)
+RecommendProducts = AsyncCatalogView(views.RecommendProducts)
+NewProducts = AsyncCatalogView(views.NewProducts)
+RankingProducts = AsyncCatalogView(views.RankingProducts)
+
+
+class AsyncAuthView(AsyncCatalogView):
+    # パスワードのハッシュ計算（PBKDF2）はCPUを使うため、カタログとは別のスレッドプールで同時実行数を制限する
+    executor = 'auth'
+    workers_setting = 'AUTH_HASHER_WORKERS'
+
+
+RegisterView = AsyncAuthView(views.RegisterView)
+LoginView = AsyncAuthView(TokenObtainPairView)
@@ -0,0 +1,103 @@
+from django.contrib.auth import get_user_model
+from django.utils.functional import cached_property
+from rest_framework.exceptions import AuthenticationFailed
+from rest_framework_simplejwt.authentication import JWTAuthentication
+from rest_framework_simplejwt.exceptions import InvalidToken
+from rest_framework_simplejwt.serializers import TokenObtainPairSerializer, TokenRefreshSerializer
+from rest_framework_simplejwt.settings import api_settings
+from rest_framework_simplejwt.tokens import AccessToken, RefreshToken
+
+from .entitlements import PERIOD_END_CLAIM
+
+# トークンに含めるユーザーの属性（これらはDBを読まずに参照できる）
+USER_CLAIMS = ('email', 'name', 'is_staff', 'is_superuser')
+
+
+def set_user_claims(token, user):
+    for claim in USER_CLAIMS:
+        token[claim] = getattr(user, claim)
+    token[PERIOD_END_CLAIM] = int(user.current_period_end.timestamp()) if user.current_period_end else None
+
+
+class ClaimsTokenObtainPairSerializer(TokenObtainPairSerializer):
+    @classmethod
+    def get_token(cls, user):
+        token = super().get_token(user)
+        set_user_claims(token, user)
+        return token
+
+
+class ClaimsTokenRefreshSerializer(TokenRefreshSerializer):
+    """
+    更新時はユーザーを1回読み直し、無効化・削除されたユーザーには新しいトークンを発行しない
+    権限・メールアドレス・サブスク有効期限などのクレームも最新の値で発行し直す
+    """
+
+    def validate(self, attrs):
+        data = super().validate(attrs)
+        access = AccessToken(data['access'])
+        user = get_user_model().objects.filter(pk=access[api_settings.USER_ID_CLAIM]).first()
+        if user is None or not user.is_active:
+            raise AuthenticationFailed('User is inactive or deleted', code='user_inactive')
+        set_user_claims(access, user)
+        data['access'] = str(access)
+        if 'refresh' in data:
+            # ROTATE_REFRESH_TOKENS の場合は更新用トークンのクレームも最新にする
+            refresh = RefreshToken(data['refresh'])
+            set_user_claims(refresh, user)
+            data['refresh'] = str(refresh)
+        return data
+
+
+class ClaimsUser:
+    """
+    トークンのクレームから作るユーザー
+    id と USER_CLAIMS の属性はDBを読まずに返し、それ以外の属性に触れたときに初めて UserAccount を取得する
+    """
+    is_active = True
+    is_anonymous = False
+    is_authenticated = True
+
+    def __init__(self, token):
+        self.id = self.pk = token[api_settings.USER_ID_CLAIM]
+        for claim in USER_CLAIMS:
+            if claim in token:
+                setattr(self, claim, token[claim])
+
+    @cached_property
+    def user(self):
+        try:
+            return get_user_model().objects.get(pk=self.id)
+        except get_user_model().DoesNotExist:
+            raise AuthenticationFailed('User not found', code='user_not_found')
+
+    def __getattr__(self, name):
+        # 通常の属性として見つからなかった場合のみ呼ばれる
+        if name.startswith('_') or name == 'user':
+            raise AttributeError(name)
+        return getattr(self.user, name)
+
+    def __str__(self):
+        return self.email
+
+    def __eq__(self, other):
+        return getattr(other, 'pk', None) == self.pk and getattr(other, 'is_authenticated', False)
+
+    def __hash__(self):
+        return hash(self.pk)
+
+    def get_username(self):
+        return self.email
+
+
+class ClaimsJWTAuthentication(JWTAuthentication):
+    """
+    ユーザーをDBから読まずにトークンのクレームから作る JWTAuthentication
+    無効化・降格されたユーザーのトークンも有効期限（ACCESS_TOKEN_LIFETIME）までは使えるため、期限は短く保つ
+    （更新時には ClaimsTokenRefreshSerializer がユーザーを読み直すため、それ以降は反映される）
+    """
+
+    def get_user(self, validated_token):
+        if api_settings.USER_ID_CLAIM not in validated_token:
+            raise InvalidToken('Token contained no recognizable user identification')
+        return ClaimsUser(validated_token)
@@ -0,0 +1,127 @@
+import hashlib
+import threading
+import time
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db import transaction
+from django.http import HttpResponse
+
+from .models import Category
+from .replicas import reading_from_replica
+
+
+CATALOG_VERSION_KEY = 'catalog:version'
+CATALOG_UPDATED_AT_KEY = 'catalog:updated_at'
+
+
+def get_catalog_version():
+    version = cache.get(CATALOG_VERSION_KEY)
+    if version is None:
+        # 期限切れ・再起動後でも過去のバージョンと衝突しないよう時刻で初期化
+        cache.add(CATALOG_VERSION_KEY, time.time_ns(), timeout=None)
+        version = cache.get(CATALOG_VERSION_KEY)
+    return version
+
+
+def _incr_catalog_version():
+    try:
+        cache.incr(CATALOG_VERSION_KEY)
+    except ValueError:
+        cache.set(CATALOG_VERSION_KEY, time.time_ns(), timeout=None)
+    cache.set(CATALOG_UPDATED_AT_KEY, time.time(), timeout=None)
+
+
+def bump_catalog_version():
+    _incr_catalog_version()
+    # トランザクション中に古いデータがキャッシュされた場合に備えてコミット後にも更新
+    if transaction.get_connection().in_atomic_block:
+        transaction.on_commit(_incr_catalog_version)
+
+
+def get_catalog_updated_at():
+    # 最後にカタログ（商品・カテゴリ）を更新した時刻（UNIX時刻、記録がなければ None）
+    return cache.get(CATALOG_UPDATED_AT_KEY)
+
+
+def catalog_cacheable():
+    # レプリカから読んだ結果は、更新直後（レプリカが遅れている可能性がある間）はキャッシュしない
+    if not reading_from_replica():
+        return True
+    updated_at = cache.get(CATALOG_UPDATED_AT_KEY)
+    return updated_at is None or time.time() - updated_at > settings.REPLICA_STICKY_SECONDS
+
+
+_category_ids = {'version': None, 'slug': {}, 'name': {}}
+_category_ids_lock = threading.Lock()
+
+
+def get_category_ids():
+    """
+    カテゴリのスラッグ・名前からidへの対応表を返す
+    対応表はプロセス内に保持し、カタログのバージョンが変わったとき（カテゴリ保存時など）に再読み込みする
+    """
+    global _category_ids
+    version = get_catalog_version()
+    category_ids = _category_ids
+    if category_ids['version'] != version:
+        with _category_ids_lock:
+            rows = list(Category.objects.values_list('id', 'slug', 'name'))
+            category_ids = {
+                'version': version if catalog_cacheable() else None,
+                'slug': {slug: pk for pk, slug, _ in rows},
+                'name': {name: pk for pk, _, name in rows},
+            }
+            _category_ids = category_ids
+    return category_ids
+
+
+def get_category_id(slug=None, name=None):
+    # カテゴリのスラッグ（または名前）からidを返す
+    category_ids = get_category_ids()
+    if slug is not None:
+        return category_ids['slug'].get(slug)
+    return category_ids['name'].get(name)
+
+
+def catalog_cache_key(path):
+    path = hashlib.md5(path.encode()).hexdigest()
+    return f'catalog:{get_catalog_version()}:{path}'
+
+
+class CatalogCacheMixin:
+    """
+    カタログ一覧のレンダリング済みJSONをキャッシュする
+    キーにはカタログのバージョンを含めるため、商品・カテゴリの更新で自動的に無効化される
+    """
+    cache_timeout = None
+
+    def get_cache_path(self, request):
+        # 同じ内容を返すリクエストが同じキーになるよう、ビューごとに正規化できる
+        return request.get_full_path()
+
+    def get_cache_timeout(self):
+        if self.cache_timeout is not None:
+            return self.cache_timeout
+        return settings.CATALOG_CACHE_TIMEOUT
+
+    def list(self, request, *args, **kwargs):
+        if request.accepted_renderer.format != 'json':
+            return super().list(request, *args, **kwargs)
+
+        key = catalog_cache_key(self.get_cache_path(request))
+        content = cache.get(key)
+        if content is not None:
+            return HttpResponse(content, content_type='application/json')
+
+        response = super().list(request, *args, **kwargs)
+        response.catalog_cache_key = key
+        return response
+
+    def finalize_response(self, request, response, *args, **kwargs):
+        response = super().finalize_response(request, response, *args, **kwargs)
+        key = getattr(response, 'catalog_cache_key', None)
+        if key and response.status_code == 200 and catalog_cacheable():
+            response.render()
+            cache.set(key, response.content, self.get_cache_timeout())
+        return response
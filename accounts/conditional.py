@@ -0,0 +1,99 @@
+import hashlib
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db.models import Count, Max
+from django.utils.cache import get_conditional_response
+from django.utils.http import http_date, quote_etag
+from rest_framework.exceptions import NotFound
+
+from .cache import catalog_cache_key, catalog_cacheable, get_catalog_updated_at
+
+
+def make_etag(*parts):
+    return quote_etag(hashlib.md5(':'.join(str(p) for p in parts).encode()).hexdigest())
+
+
+def _set_validators(response, etag, last_modified):
+    response['ETag'] = etag
+    if last_modified is not None:
+        response['Last-Modified'] = http_date(last_modified)
+    return response
+
+
+def _conditional(request, etag, last_modified, get_response):
+    # 変更がなければシリアライズ前に304を返す
+    response = get_conditional_response(request, etag=etag, last_modified=last_modified)
+    if response is not None:
+        return _set_validators(response, etag, last_modified)
+    return _set_validators(get_response(), etag, last_modified)
+
+
+class ConditionalListMixin:
+    """
+    一覧にETag / Last-Modifiedを付与し、条件付きGETに304で応答する
+    検証子は絞り込み後のクエリセットに対する max(updated_at)（カタログの更新時刻より古ければ更新時刻）と件数から
+    集計クエリ1回で求め、
+    カタログのバージョンごとにキャッシュする（?cursor= の場合はそのページの行だけで求める）
+    """
+    last_modified_field = 'updated_at'
+
+    def get_cache_path(self, request):
+        return request.get_full_path()
+
+    def get_list_validators(self, request):
+        key = f'{catalog_cache_key(self.get_cache_path(request))}:validators'
+        validators = cache.get(key)
+        if validators is None:
+            last_modified = count = None
+            if self.last_modified_field:
+                queryset = self.filter_queryset(self.get_queryset())
+                paginator = self.paginator
+                if paginator is not None and getattr(paginator, 'is_keyset', None) and paginator.is_keyset(request):
+                    # キーセットではカーソルごとにキーが変わるため、全件ではなくそのページの行だけで求める
+                    # （キーにはカタログのバージョンが含まれる）
+                    page = paginator.get_keyset_queryset(queryset, request).values('pk')
+                    queryset = queryset.model._default_manager.filter(
+                        pk__in=page[:paginator.get_page_size(request) + 1]
+                    )
+                summary = queryset.order_by().aggregate(
+                    last_modified=Max(self.last_modified_field), count=Count('pk')
+                )
+                count = summary['count']
+                # 無効化・削除・絞り込みで外れた商品は max(updated_at) に現れないため、カタログの更新時刻とも比べる
+                timestamps = [get_catalog_updated_at()]
+                if summary['last_modified'] is not None:
+                    timestamps.append(summary['last_modified'].timestamp())
+                timestamps = [t for t in timestamps if t is not None]
+                if timestamps:
+                    last_modified = int(max(timestamps))
+            etag = make_etag(key, request.accepted_media_type, count, last_modified)
+            validators = (etag, last_modified)
+            if catalog_cacheable():
+                cache.set(key, validators, settings.CATALOG_CACHE_TIMEOUT)
+        return validators
+
+    def list(self, request, *args, **kwargs):
+        etag, last_modified = self.get_list_validators(request)
+        return _conditional(
+            request, etag, last_modified,
+            lambda: super(ConditionalListMixin, self).list(request, *args, **kwargs)
+        )
+
+
+class ConditionalRetrieveMixin:
+    # 詳細はカテゴリ名の変更も反映されるよう、カテゴリも含めた1クエリで検証子を求める
+    def retrieve(self, request, *args, **kwargs):
+        lookup = {self.lookup_field: self.kwargs[self.lookup_url_kwarg or self.lookup_field]}
+        row = self.get_queryset().filter(**lookup).values_list(
+            'updated_at', 'category__name', 'category__slug'
+        ).first()
+        if row is None:
+            raise NotFound()
+        updated_at = row[0]
+        last_modified = int(updated_at.timestamp())
+        etag = make_etag(request.get_full_path(), request.accepted_media_type, updated_at.isoformat(), *row[1:])
+        return _conditional(
+            request, etag, last_modified,
+            lambda: super(ConditionalRetrieveMixin, self).retrieve(request, *args, **kwargs)
+        )
@@ -0,0 +1,48 @@
+import time
+
+from django.conf import settings
+from django.core.signals import request_started
+from django.db import connections
+from django.db.backends.signals import connection_created
+from django.dispatch import receiver
+
+
+def record_last_query(conn):
+    # 接続で最後にクエリを実行した時刻を記録する
+    def wrapper(execute, sql, params, many, context):
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            conn.last_query_at = time.monotonic()
+    return wrapper
+
+
+@receiver(connection_created)
+def track_connection_use(sender, connection, **kwargs):
+    connection.last_query_at = time.monotonic()
+    # execute_wrappers は接続を作り直しても引き継がれるため、1回だけ登録する
+    if not getattr(connection, 'tracks_last_query', False):
+        connection.execute_wrappers.append(record_last_query(connection))
+        connection.tracks_last_query = True
+
+
+@receiver(request_started)
+def check_connections(**kwargs):
+    """
+    永続接続を再利用する前に、DBサーバーやプーラー側で切断されていないか確認する
+    Django 4.1 の CONN_HEALTH_CHECKS 相当（3.2 では設定が無視されるため、ここで行う）
+    確認は SELECT 1 の往復になるため、DB_CONN_HEALTH_CHECK_IDLE 秒以上クエリを実行していない接続だけを確認する
+    （続けて使われている接続やレプリカは確認しないため、キャッシュや 304 で応答するリクエストに往復が増えない）
+    """
+    now = time.monotonic()
+    for conn in connections.all():
+        if conn.connection is None or conn.in_atomic_block:
+            continue
+        if not conn.settings_dict.get('CONN_HEALTH_CHECKS'):
+            continue
+        if now - getattr(conn, 'last_query_at', 0) < settings.DB_CONN_HEALTH_CHECK_IDLE:
+            continue
+        if conn.is_usable():
+            conn.last_query_at = now
+        else:
+            conn.close()
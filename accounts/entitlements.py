@@ -0,0 +1,60 @@
+import time
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db import transaction
+from rest_framework.permissions import BasePermission
+
+from .models import UserAccount
+
+# トークンに含めるサブスク有効期限のクレーム（UNIXタイムスタンプ、未契約はNone）
+PERIOD_END_CLAIM = 'period_end'
+NO_SUBSCRIPTION = 0
+
+
+def _cache_key(user_id):
+    return f'entitlement:{user_id}'
+
+
+def get_period_end(user_id):
+    """
+    ユーザーのサブスク有効期限をUNIXタイムスタンプで返す（未契約はNone）
+    キャッシュになければDBから読み、ENTITLEMENT_CACHE_TIMEOUT の間キャッシュする
+    """
+    period_end = cache.get(_cache_key(user_id))
+    if period_end is None:
+        value = UserAccount.objects.filter(pk=user_id).values_list('current_period_end', flat=True).first()
+        period_end = int(value.timestamp()) if value else NO_SUBSCRIPTION
+        cache.set(_cache_key(user_id), period_end, settings.ENTITLEMENT_CACHE_TIMEOUT)
+    return period_end or None
+
+
+def _delete(user_ids):
+    cache.delete_many([_cache_key(user_id) for user_id in user_ids])
+
+
+def invalidate_entitlements(user_ids):
+    _delete(user_ids)
+    # トランザクション中に古い値が読み込まれた場合に備えてコミット後にも削除
+    if transaction.get_connection().in_atomic_block:
+        transaction.on_commit(lambda: _delete(user_ids))
+
+
+def is_entitled(request):
+    # トークンの有効期限が切れていなければDBもキャッシュも使わない（更新直後はキャッシュで確認する）
+    user = request.user
+    if not user or not user.is_authenticated:
+        return False
+    now = time.time()
+    claim = request.auth.get(PERIOD_END_CLAIM) if request.auth is not None else None
+    if claim and claim > now:
+        return True
+    period_end = get_period_end(user.id)
+    return period_end is not None and period_end > now
+
+
+class HasActiveSubscription(BasePermission):
+    message = 'サブスクの有効期限が切れています'
+
+    def has_permission(self, request, view):
+        return is_entitled(request)
@@ -0,0 +1,40 @@
+import asyncio
+import functools
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from django.db import close_old_connections
+
+_executors = {}
+_executors_lock = threading.Lock()
+
+
+def get_executor(name, max_workers):
+    """
+    用途ごとに上限付きのスレッドプールを返す
+    スレッドごとにDB接続を持つため、スレッド数がワーカーあたりのDB接続数の上限にもなる
+    """
+    executor = _executors.get(name)
+    if executor is None:
+        with _executors_lock:
+            executor = _executors.get(name)
+            if executor is None:
+                executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix=name)
+                _executors[name] = executor
+    return executor
+
+
+def _call_with_connections(func, *args, **kwargs):
+    # ワーカースレッドではリクエストのシグナルが送られないため、DB接続を自分で片付ける
+    close_old_connections()
+    try:
+        return func(*args, **kwargs)
+    finally:
+        close_old_connections()
+
+
+async def run_in_executor(name, max_workers, func, *args, **kwargs):
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(
+        get_executor(name, max_workers), functools.partial(_call_with_connections, func, *args, **kwargs)
+    )
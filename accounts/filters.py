@@ -0,0 +1,161 @@
+from decimal import Decimal, InvalidOperation
+from urllib.parse import urlencode
+
+from django.conf import settings
+from django.db.models import Count, F, Q
+from rest_framework.exceptions import ValidationError
+
+from .cache import get_category_ids
+
+FLAG_FIELDS = ('sales_discount', 'recommend', 'new_product')
+
+# 並び順（同じ値の商品はidで並べて順序を固定する）
+SORT_ORDERINGS = {
+    '-created_at': ('-created_at', '-id'),
+    'created_at': ('created_at', 'id'),
+    'price': ('price', 'id'),
+    '-price': ('-price', '-id'),
+    'ranking': (F('ranking').asc(nulls_last=True), 'id'),
+}
+DEFAULT_SORT = '-created_at'
+
+TRUE_VALUES = ('1', 'true', 'yes', 'on')
+FALSE_VALUES = ('0', 'false', 'no', 'off')
+
+
+def _parse_bool(params, name):
+    value = params.get(name, '').strip().lower()
+    if not value:
+        return None
+    if value in TRUE_VALUES:
+        return True
+    if value in FALSE_VALUES:
+        return False
+    raise ValidationError({name: '真偽値を指定してください'})
+
+
+def _parse_price(params, name):
+    value = params.get(name, '').strip()
+    if not value:
+        return None
+    try:
+        price = Decimal(value)
+    except InvalidOperation:
+        raise ValidationError({name: '数値を指定してください'})
+    if not price.is_finite() or price < 0:
+        raise ValidationError({name: '0以上の数値を指定してください'})
+    return price.normalize()
+
+
+class ProductFilter:
+    """
+    商品一覧の絞り込み・並び替え条件
+    同じ条件は同じ形に正規化されるため、キャッシュのキーにもそのまま使える
+    """
+    page_params = ('page', 'cursor')
+
+    def __init__(self, params):
+        self.categories = sorted({slug for slug in params.get('category', '').split(',') if slug})
+        # カテゴリの対応表は指定がある場合だけ読み込む
+        category_slugs = get_category_ids()['slug'] if self.categories else {}
+        unknown = [slug for slug in self.categories if slug not in category_slugs]
+        if unknown:
+            raise ValidationError({'category': f'カテゴリが見つかりません: {", ".join(unknown)}'})
+        self.category_ids = [category_slugs[slug] for slug in self.categories]
+        self.min_price = _parse_price(params, 'min_price')
+        self.max_price = _parse_price(params, 'max_price')
+        self.in_stock = _parse_bool(params, 'in_stock')
+        # false を指定した場合はフラグの付いていない商品に絞り込む（in_stock と同じ扱い）
+        self.flags = {}
+        for flag in FLAG_FIELDS:
+            value = _parse_bool(params, flag)
+            if value is not None:
+                self.flags[flag] = value
+        self.sort = params.get('sort') or DEFAULT_SORT
+        if self.sort not in SORT_ORDERINGS:
+            raise ValidationError({'sort': f'{", ".join(SORT_ORDERINGS)} のいずれかを指定してください'})
+        # キーセットのカーソルは作成日時の新しい順でしか使えない
+        if 'cursor' in params and self.sort != DEFAULT_SORT:
+            raise ValidationError({'cursor': 'cursor は sort を指定しない場合のみ使用できます'})
+        self.facets = bool(_parse_bool(params, 'facets'))
+        self.page = {name: params[name] for name in self.page_params if name in params}
+
+    def conditions(self, exclude=None):
+        # 各条件を名前付きで返す（ファセットの件数は自分以外の条件で絞り込んで数える）
+        conditions = {}
+        if self.categories:
+            conditions['category'] = Q(category_id__in=self.category_ids)
+        price = Q()
+        if self.min_price is not None:
+            price &= Q(price__gte=self.min_price)
+        if self.max_price is not None:
+            price &= Q(price__lte=self.max_price)
+        if price:
+            conditions['price'] = price
+        if self.in_stock is not None:
+            conditions['in_stock'] = Q(in_stock=self.in_stock)
+        for flag, value in self.flags.items():
+            conditions[flag] = Q(**{flag: value})
+        conditions.pop(exclude, None)
+        return conditions
+
+    def where(self, exclude=None):
+        where = Q()
+        for condition in self.conditions(exclude).values():
+            where &= condition
+        return where
+
+    def apply(self, queryset):
+        return queryset.filter(self.where()).order_by(*SORT_ORDERINGS[self.sort])
+
+    def cache_params(self):
+        params = []
+        if self.categories:
+            params.append(('category', ','.join(self.categories)))
+        for name in ('min_price', 'max_price'):
+            if getattr(self, name) is not None:
+                params.append((name, str(getattr(self, name))))
+        if self.in_stock is not None:
+            params.append(('in_stock', str(self.in_stock).lower()))
+        params.extend((flag, str(value).lower()) for flag, value in self.flags.items())
+        if self.sort != DEFAULT_SORT:
+            params.append(('sort', self.sort))
+        if self.facets:
+            params.append(('facets', 'true'))
+        params.extend(sorted(self.page.items()))
+        return urlencode(params)
+
+    def price_buckets(self):
+        bounds = [0, *settings.PRODUCT_PRICE_BUCKETS]
+        return list(zip(bounds, bounds[1:] + [None]))
+
+    def get_facets(self, queryset):
+        """
+        カテゴリ別・フラグ別・価格帯別の件数を条件付き集計で1回のクエリで求める
+        各ファセットは自分以外の条件で絞り込んだ件数を返す（選択中のカテゴリ以外の件数も分かる）
+        """
+        category_ids = get_category_ids()['slug']
+        where = self.where()
+        aggregates = {'total': Count('pk', filter=where) if where else Count('pk')}
+        category_where = self.where(exclude='category')
+        for slug, pk in category_ids.items():
+            aggregates[f'category_{pk}'] = Count('pk', filter=category_where & Q(category_id=pk))
+        for flag in FLAG_FIELDS:
+            aggregates[f'flag_{flag}'] = Count('pk', filter=self.where(exclude=flag) & Q(**{flag: True}))
+        aggregates['flag_in_stock'] = Count('pk', filter=self.where(exclude='in_stock') & Q(in_stock=True))
+        price_where = self.where(exclude='price')
+        buckets = self.price_buckets()
+        for i, (low, high) in enumerate(buckets):
+            bucket = Q(price__gte=low) if high is None else Q(price__gte=low, price__lt=high)
+            aggregates[f'price_{i}'] = Count('pk', filter=price_where & bucket)
+
+        counts = queryset.order_by().aggregate(**aggregates)
+        return {
+            'total': counts['total'],
+            'categories': {slug: counts[f'category_{pk}'] for slug, pk in sorted(category_ids.items())},
+            'flags': {flag: counts[f'flag_{flag}'] for flag in (*FLAG_FIELDS, 'in_stock')},
+            'price': [
+                {'min': low, 'max': high, 'count': counts[f'price_{i}']}
+                for i, (low, high) in enumerate(buckets)
+            ],
+        }
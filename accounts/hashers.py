@@ -0,0 +1,13 @@
+from django.conf import settings
+from django.contrib.auth.hashers import PBKDF2PasswordHasher
+
+
+class TunablePBKDF2PasswordHasher(PBKDF2PasswordHasher):
+    """
+    反復回数を PASSWORD_HASH_ITERATIONS で調整できる PBKDF2 ハッシャー
+    アルゴリズム名は同じなので既存のハッシュもそのまま照合でき、回数が異なるハッシュはログイン時に更新される
+    """
+
+    @property
+    def iterations(self):
+        return settings.PASSWORD_HASH_ITERATIONS
@@ -0,0 +1,90 @@
+import random
+import statistics
+import time
+from contextlib import contextmanager
+from decimal import Decimal
+
+from django.db import connection
+
+from accounts.models import Category, Product
+
+
+@contextmanager
+def benchmark_database(verbosity=0):
+    # 本番データに影響しないよう、テスト用データベースを作成して計測する
+    old_name = connection.settings_dict['NAME']
+    connection.creation.create_test_db(verbosity=verbosity, autoclobber=True, serialize=False)
+    try:
+        yield
+    finally:
+        connection.creation.destroy_test_db(old_name, verbosity=verbosity)
+
+
+# 商品説明の合成に使う語（実際の商品説明に近い文字の種類と n-gram の分布にする）
+DESCRIPTION_WORDS = (
+    '天然素材', 'を使用した', '軽量', 'で', '丈夫な', '財布', '靴', 'バッグ', 'シャツ', '毎日', '使いやすい',
+    'シンプルな', 'デザイン', 'です', '。', '、', '収納力', 'が高く', '防水', '加工', 'ポケット', '付き',
+    'サイズ', 'カラー', 'ブラック', 'ホワイト', 'ネイビー', '本革', 'コットン', '100%', 'ギフト', 'にも',
+    'おすすめ', 'します', '手入れ', 'が簡単', '国産', '職人', 'が一つずつ', '仕上げ', 'ました', '通勤',
+    '旅行', 'アウトドア', '季節', 'を問わず', 'お使い', 'いただけます', '※', '色味', 'は画面', 'と異なる',
+    '場合', 'があります', 'Mサイズ', 'Lサイズ', '約', 'cm', 'g', '洗濯機', '可', '不可', '限定',
+)
+
+
+def synthetic_description(rng, i, length):
+    words = [f'ベンチマーク用の商品{i}の説明です']
+    if not length:
+        return words[0]
+    size = len(words[0])
+    while size < length:
+        word = rng.choice(DESCRIPTION_WORDS)
+        words.append(word)
+        size += len(word)
+    return ''.join(words)[:length]
+
+
+def seed_catalog(products, categories=20, batch_size=5000, flag_ratio=0.05, seed=0, description_length=0):
+    # description_length を指定すると、その文字数の説明を合成する（検索の索引の大きさを実際に近づける）
+    rng = random.Random(seed)
+    category_ids = [
+        c.pk for c in Category.objects.bulk_create(
+            Category(name=f'カテゴリ{i}', slug=f'category-{i}') for i in range(categories)
+        )
+    ]
+    if not category_ids or category_ids[0] is None:
+        category_ids = list(Category.objects.values_list('pk', flat=True))
+
+    batch = []
+    for i in range(products):
+        batch.append(Product(
+            category_id=rng.choice(category_ids),
+            name=f'商品{i}',
+            slug=f'product-{i}',
+            description=synthetic_description(rng, i, description_length),
+            price=Decimal(rng.randint(100, 50000)),
+            sales_discount=rng.random() < flag_ratio,
+            recommend=rng.random() < flag_ratio,
+            new_product=rng.random() < flag_ratio,
+            ranking=i + 1 if rng.random() < flag_ratio else None,
+        ))
+        if len(batch) >= batch_size:
+            Product.objects.bulk_create(batch)
+            batch = []
+    if batch:
+        Product.objects.bulk_create(batch)
+    analyze()
+    return category_ids
+
+
+def analyze():
+    with connection.cursor() as cursor:
+        cursor.execute('ANALYZE')
+
+
+def measure(func, repeat=20):
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        timings.append((time.perf_counter() - start) * 1000)
+    return statistics.median(timings)
@@ -0,0 +1,81 @@
+import asyncio
+import threading
+import time
+
+from django.core.management.base import BaseCommand
+from django.db import connections
+from django.db.backends.signals import connection_created
+from django.test import AsyncRequestFactory, RequestFactory, override_settings
+
+from accounts import async_views, views
+
+from ._bench import benchmark_database, seed_catalog
+
+
+class Command(BaseCommand):
+    help = (
+        'カタログ一覧を同期ビュー（1ワーカー＝同時1件）と非同期ビューで処理し、'
+        '1ワーカーあたりの同時処理数とスループットを比較する（テスト用DBを使用）'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--products', type=int, default=2000)
+        parser.add_argument('--requests', type=int, default=200)
+        parser.add_argument('--db-latency', type=float, default=5.0, help='クエリごとに加えるネットワーク遅延（ms）')
+        parser.add_argument('--threads', type=int, default=16, help='CATALOG_ASYNC_WORKERS')
+
+    def handle(self, *args, **options):
+        latency = options['db_latency'] / 1000
+        self.in_flight = self.max_in_flight = 0
+        lock = threading.Lock()
+
+        def slow_execute(execute, sql, params, many, context):
+            # 本番のDBサーバーまでの往復時間を再現し、同時に待っているクエリ数を数える
+            with lock:
+                self.in_flight += 1
+                self.max_in_flight = max(self.max_in_flight, self.in_flight)
+            try:
+                time.sleep(latency)
+            finally:
+                with lock:
+                    self.in_flight -= 1
+            return execute(sql, params, many, context)
+
+        def add_latency(connection, **kwargs):
+            connection.execute_wrappers.append(slow_execute)
+
+        # キャッシュを無効にしてDBまで到達する場合を計測する
+        dummy_cache = {'default': {'BACKEND': 'django.core.cache.backends.dummy.DummyCache'}}
+        with benchmark_database(), override_settings(CACHES=dummy_cache, CATALOG_ASYNC_WORKERS=options['threads']):
+            seed_catalog(options['products'])
+            connection_created.connect(add_latency)
+            connections['default'].execute_wrappers.append(slow_execute)
+            try:
+                sync_elapsed = self.run_sync(options['requests'])
+                sync_in_flight = self.max_in_flight
+                self.max_in_flight = 0
+                async_elapsed = asyncio.run(self.run_async(options['requests']))
+            finally:
+                connection_created.disconnect(add_latency)
+                connections['default'].execute_wrappers.remove(slow_execute)
+
+        count = options['requests']
+        self.stdout.write(f'{"同期ビュー":10s} 同時処理 {sync_in_flight:3d}件  {count / sync_elapsed:8.1f}件/秒')
+        self.stdout.write(f'{"非同期ビュー":10s} 同時処理 {self.max_in_flight:3d}件  {count / async_elapsed:8.1f}件/秒')
+
+    def run_sync(self, count):
+        view = views.ProductList.as_view()
+        start = time.perf_counter()
+        for i in range(count):
+            request = RequestFactory().get(f'/api/auth/products/?page={i % 10 + 1}')
+            view(request).render()
+        return time.perf_counter() - start
+
+    async def run_async(self, count):
+        view = async_views.ProductList.as_view()
+
+        start = time.perf_counter()
+        await asyncio.gather(*(
+            view(AsyncRequestFactory().get(f'/api/auth/products/?page={i % 10 + 1}')) for i in range(count)
+        ))
+        return time.perf_counter() - start
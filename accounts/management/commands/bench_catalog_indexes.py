@@ -0,0 +1,55 @@
+from django.core.management.base import BaseCommand
+from django.db import connection
+
+from accounts.models import Product
+
+from ._bench import analyze, benchmark_database, measure, seed_catalog
+
+
+class Command(BaseCommand):
+    help = '商品一覧のインデックス有無による実行計画と実行時間を比較する（テスト用DBを使用）'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--products', type=int, default=500000)
+        parser.add_argument('--repeat', type=int, default=20)
+
+    def handle(self, *args, **options):
+        with benchmark_database():
+            self.stdout.write(f'{options["products"]}件の商品を作成しています...')
+            category_ids = seed_catalog(options['products'])
+
+            querysets = {
+                'products': lambda: Product.objects.catalog(),
+                'category': lambda: Product.objects.catalog().in_category(category_ids[0]),
+                'sales': lambda: Product.objects.catalog().sales_discount(),
+                'recommend': lambda: Product.objects.catalog().recommended(),
+                'new': lambda: Product.objects.catalog().new_products(),
+                'ranking': lambda: Product.objects.catalog().filter(
+                    ranking__isnull=False).order_by('ranking'),
+            }
+
+            indexes = Product._meta.indexes
+            with connection.schema_editor() as editor:
+                for index in indexes:
+                    editor.remove_index(Product, index)
+            analyze()
+            before = self.run(querysets, options['repeat'], 'インデックスなし')
+
+            with connection.schema_editor() as editor:
+                for index in indexes:
+                    editor.add_index(Product, index)
+            analyze()
+            after = self.run(querysets, options['repeat'], 'インデックスあり')
+
+            self.stdout.write('\n== 結果 (1ページ12件, 中央値) ==')
+            for name in querysets:
+                self.stdout.write(f'{name:10s} {before[name]:9.2f}ms -> {after[name]:9.2f}ms')
+
+    def run(self, querysets, repeat, label):
+        self.stdout.write(f'\n== {label} ==')
+        timings = {}
+        for name, make_queryset in querysets.items():
+            page = make_queryset()[:12]
+            self.stdout.write(f'-- {name}\n{page.explain()}')
+            timings[name] = measure(lambda: list(make_queryset()[:12]), repeat)
+        return timings
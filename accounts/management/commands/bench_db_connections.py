@@ -0,0 +1,52 @@
+import time
+
+from django.core.management.base import BaseCommand
+from django.core.signals import request_finished, request_started
+from django.db import connection
+from django.db.backends.signals import connection_created
+
+from accounts.models import Category
+
+from ._bench import benchmark_database, measure
+
+
+class Command(BaseCommand):
+    help = (
+        '接続を毎リクエスト作り直す場合（CONN_MAX_AGE=0）と再利用する場合で、'
+        '1リクエストあたりの接続コストを比較する（PostgreSQL で実行すること）'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--requests', type=int, default=200)
+        parser.add_argument('--conn-max-age', type=int, default=60)
+
+    def handle(self, *args, **options):
+        self.opened = 0
+
+        def count(**kwargs):
+            self.opened += 1
+
+        def request():
+            # リクエストの開始・終了時の接続の片付け（close_old_connections）も含めて計測する
+            request_started.send(sender=self.__class__)
+            Category.objects.exists()
+            request_finished.send(sender=self.__class__)
+
+        with benchmark_database():
+            if connection.vendor == 'sqlite':
+                self.stderr.write('SQLite のテスト用DBはメモリ上にあり接続を閉じないため、差が出ません')
+            connection_created.connect(count)
+            try:
+                for name, max_age in [('毎回接続', 0), (f'再利用 ({options["conn_max_age"]}秒)', options['conn_max_age'])]:
+                    connection.close()
+                    connection.settings_dict['CONN_MAX_AGE'] = max_age
+                    self.opened = 0
+                    start = time.perf_counter()
+                    elapsed = measure(request, options['requests'])
+                    total = time.perf_counter() - start
+                    self.stdout.write(
+                        f'{name:16s} {elapsed:7.2f}ms / リクエスト（中央値）  '
+                        f'合計 {total:6.2f}s  新規接続 {self.opened}回'
+                    )
+            finally:
+                connection_created.disconnect(count)
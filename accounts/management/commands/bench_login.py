@@ -0,0 +1,63 @@
+import asyncio
+import time
+
+from django.conf import settings
+from django.contrib.auth.hashers import make_password
+from django.core.management.base import BaseCommand
+from django.test import override_settings
+
+from accounts.authentication import ClaimsTokenObtainPairSerializer
+from accounts.executors import run_in_executor
+from accounts.models import UserAccount
+
+from ._bench import benchmark_database
+
+
+class Command(BaseCommand):
+    help = (
+        'ログイン（パスワード照合＋トークン発行）の件数/秒を、同期ワーカー1つと'
+        '非同期ワーカー1つ（ハッシュ計算をスレッドプールで実行）で計測する（テスト用DBを使用）'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--logins', type=int, default=100)
+        parser.add_argument('--iterations', type=int, default=None, help='PASSWORD_HASH_ITERATIONS（省略時は設定値）')
+        parser.add_argument('--threads', type=int, default=None, help='AUTH_HASHER_WORKERS（省略時は設定値）')
+
+    def handle(self, *args, **options):
+        overrides = {}
+        if options['iterations']:
+            overrides['PASSWORD_HASH_ITERATIONS'] = options['iterations']
+        if options['threads']:
+            overrides['AUTH_HASHER_WORKERS'] = options['threads']
+
+        with benchmark_database(), override_settings(**overrides):
+            count = options['logins']
+            password = make_password('password')
+            UserAccount.objects.bulk_create(
+                UserAccount(email=f'user{i}@example.com', name=f'ユーザー{i}', password=password)
+                for i in range(count)
+            )
+
+            start = time.perf_counter()
+            for i in range(count):
+                self.login(i)
+            sync_elapsed = time.perf_counter() - start
+
+            start = time.perf_counter()
+            asyncio.run(self.login_concurrently(count, settings.AUTH_HASHER_WORKERS))
+            async_elapsed = time.perf_counter() - start
+
+            self.stdout.write(
+                f'PBKDF2 {settings.PASSWORD_HASH_ITERATIONS}回  スレッド {settings.AUTH_HASHER_WORKERS}'
+            )
+        self.stdout.write(f'{"同期ワーカー":10s} {count / sync_elapsed:8.1f}件/秒  {sync_elapsed / count * 1000:7.1f}ms/件')
+        self.stdout.write(f'{"非同期ワーカー":10s} {count / async_elapsed:8.1f}件/秒')
+
+    def login(self, i):
+        serializer = ClaimsTokenObtainPairSerializer(data={'email': f'user{i}@example.com', 'password': 'password'})
+        if not serializer.is_valid():
+            raise RuntimeError(serializer.errors)
+
+    async def login_concurrently(self, count, threads):
+        await asyncio.gather(*(run_in_executor('auth', threads, self.login, i) for i in range(count)))
@@ -0,0 +1,87 @@
+import asyncio
+import statistics
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import stripe
+from django.core.management.base import BaseCommand
+from django.test import override_settings
+
+from accounts import payments
+
+
+class Command(BaseCommand):
+    help = (
+        'FakeGateway で決済APIの遅延を再現し、同期ワーカーと非同期ビューで'
+        '決済中に他のリクエストがどれだけ待たされるかを比較する'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--checkouts', type=int, default=40)
+        parser.add_argument('--requests', type=int, default=200, help='決済と同時に届く通常リクエストの数')
+        parser.add_argument('--latency', type=float, default=0.5, help='決済APIの応答時間（秒）')
+        parser.add_argument('--workers', type=int, default=4, help='同期ワーカー数（gunicorn の --workers 相当）')
+
+    def handle(self, *args, **options):
+        with override_settings(
+            PAYMENT_GATEWAY='accounts.payments.FakeGateway',
+            PAYMENT_CIRCUIT_FAILURE_THRESHOLD=options['checkouts'] + 1,
+        ):
+            gateway = payments.get_gateway()
+            gateway.latency = options['latency']
+            results = {
+                '同期ワーカー': self.run_sync(gateway, options),
+                '非同期ビュー': asyncio.run(self.run_async(gateway, options)),
+            }
+            for name, (elapsed, waits) in results.items():
+                self.stdout.write(
+                    f'{name:10s} 全体 {elapsed:7.2f}s  通常リクエストの待ち時間 '
+                    f'p50 {statistics.median(waits):8.1f}ms  最大 {max(waits):8.1f}ms'
+                )
+            self.run_breaker(gateway, options)
+
+    def checkout(self, gateway):
+        return gateway.create_checkout_session(mode='payment', line_items=[])
+
+    def run_sync(self, gateway, options):
+        # 決済の応答を待つ間もワーカーが塞がるため、後から来たリクエストが待たされる
+        waits = []
+        start = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=options['workers']) as pool:
+            for _ in range(options['checkouts']):
+                pool.submit(self.checkout, gateway)
+            for _ in range(options['requests']):
+                submitted = time.perf_counter()
+                pool.submit(lambda submitted=submitted: waits.append((time.perf_counter() - submitted) * 1000))
+        return time.perf_counter() - start, waits
+
+    async def run_async(self, gateway, options):
+        # 決済は専用のスレッドプールで行い、イベントループは通常リクエストを処理し続ける
+        async def request(submitted):
+            await asyncio.sleep(0)
+            return (time.perf_counter() - submitted) * 1000
+
+        start = time.perf_counter()
+        checkouts = [
+            asyncio.ensure_future(payments.run_in_executor(self.checkout, gateway))
+            for _ in range(options['checkouts'])
+        ]
+        waits = await asyncio.gather(*(request(time.perf_counter()) for _ in range(options['requests'])))
+        await asyncio.gather(*checkouts)
+        return time.perf_counter() - start, waits
+
+    def run_breaker(self, gateway, options):
+        gateway.fail = True
+        gateway.breaker.failure_threshold = 5
+        timings = []
+        for _ in range(20):
+            start = time.perf_counter()
+            try:
+                self.checkout(gateway)
+            except (payments.PaymentGatewayError, stripe.error.StripeError):
+                pass
+            timings.append((time.perf_counter() - start) * 1000)
+        self.stdout.write(
+            f'障害時（サーキットブレーカー）: 開く前 {statistics.median(timings[:5]):8.1f}ms  '
+            f'開いた後 {statistics.median(timings[5:]):8.3f}ms'
+        )
@@ -0,0 +1,63 @@
+import time
+import tracemalloc
+
+from django.core.management.base import BaseCommand
+from django.db import connection
+from django.test import Client
+
+from accounts import search
+
+from ._bench import analyze, benchmark_database, measure, seed_catalog
+
+
+class Command(BaseCommand):
+    help = (
+        '商品検索の索引の作成時間と検索時間を計測する（テスト用DBを使用）。'
+        '本番と同じ経路（pg_trgm と n-gram の表）を計測するには DATABASE_URL に PostgreSQL を指定して実行する'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--products', type=int, default=100000)
+        parser.add_argument('--description-length', type=int, default=300, help='合成する商品説明の文字数')
+        parser.add_argument('--repeat', type=int, default=50)
+        parser.add_argument('--query', action='append', dest='queries')
+        parser.add_argument('--explain', action='store_true', help='DBでの検索の実行計画を表示する（PostgreSQL）')
+
+    def handle(self, *args, **options):
+        # 1〜2文字の語（'財布'・'靴'・'42'）は n-gram の表、3文字以上の語は pg_trgm で絞り込む
+        queries = options['queries'] or ['商品12345', '99999', '商品5 説明', '財布', '靴', '本革 財布', '42']
+        postgresql = connection.vendor == 'postgresql'
+        with benchmark_database():
+            seed_catalog(options['products'], description_length=options['description_length'])
+            self.stdout.write(
+                f'データベース: {connection.vendor}  商品 {options["products"]}件  説明 {options["description_length"]}文字'
+            )
+
+            start = time.perf_counter()
+            rows = search.rebuild_ngrams()
+            analyze()
+            self.stdout.write(f'n-gram の表の作成: {time.perf_counter() - start:.2f}s ({rows}行)')
+
+            if not postgresql:
+                # プロセス内の索引は SQLite（開発・テスト）でのみ使う
+                tracemalloc.start()
+                start = time.perf_counter()
+                search.get_index()
+                elapsed = time.perf_counter() - start
+                size = tracemalloc.get_traced_memory()[0] / 1024 / 1024
+                tracemalloc.stop()
+                self.stdout.write(f'プロセス内の索引の作成: {elapsed:.2f}s ({size:.0f}MB、計測のオーバーヘッドを含む)')
+
+            client = Client()
+            for query in queries:
+                hits = len(list(search.search_database(query)))
+                database = measure(lambda: list(search.search_database(query)), options['repeat'])
+                endpoint = measure(
+                    lambda: client.get('/api/auth/products/search/', {'q': query}), options['repeat'])
+                line = f'{query:16s} {hits:7d}件  DB {database:8.2f}ms'
+                if not postgresql:
+                    index = measure(lambda: search.get_index().search(query), options['repeat'])
+                    line += f'  プロセス内の索引 {index:7.2f}ms'
+                self.stdout.write(f'{line}  エンドポイント {endpoint:8.2f}ms')
+                if options['explain']:
+                    self.stdout.write(search.search_database(query).explain(analyze=postgresql))
@@ -0,0 +1,40 @@
+from django.core.management.base import BaseCommand
+from rest_framework.request import Request
+from rest_framework.test import APIRequestFactory
+
+from accounts.models import Product
+from accounts.serializers import ProductCardSerializer, ProductSerializer
+
+from ._bench import benchmark_database, measure, seed_catalog
+
+
+class Command(BaseCommand):
+    help = 'ProductSerializer と ProductCardSerializer のシリアライズ速度を1000件あたりで比較する（テスト用DBを使用）'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--products', type=int, default=1000)
+        parser.add_argument('--repeat', type=int, default=20)
+
+    def handle(self, *args, **options):
+        count, repeat = options['products'], options['repeat']
+        context = {'request': Request(APIRequestFactory().get('/api/auth/products/'))}
+
+        with benchmark_database():
+            seed_catalog(count)
+            products = list(Product.objects.catalog())
+            rows = list(Product.objects.cards())
+
+            results = {
+                'ProductSerializer (シリアライズのみ)': measure(
+                    lambda: ProductSerializer(products, many=True, context=context).data, repeat),
+                'ProductCardSerializer (シリアライズのみ)': measure(
+                    lambda: ProductCardSerializer(rows, many=True, context=context).data, repeat),
+                'ProductSerializer (取得+シリアライズ)': measure(
+                    lambda: ProductSerializer(Product.objects.catalog(), many=True, context=context).data, repeat),
+                'ProductCardSerializer (取得+シリアライズ)': measure(
+                    lambda: ProductCardSerializer(Product.objects.cards(), many=True, context=context).data, repeat),
+            }
+
+        for name, elapsed in results.items():
+            per_1k = elapsed * 1000 / count
+            self.stdout.write(f'{name:45s} {per_1k:8.2f}ms / 1000件  {count / elapsed * 1000:10.0f}件/秒')
@@ -0,0 +1,110 @@
+import random
+import resource
+import time
+from itertools import accumulate
+from decimal import Decimal
+
+from django.core.management.base import BaseCommand
+from django.test import Client
+
+from accounts.models import Order, OrderDetail, Product, ShippingInformation, UserAccount
+from accounts.related import build_related_products, count_cooccurrences
+
+from ._bench import analyze, benchmark_database, measure, seed_catalog
+
+
+class Command(BaseCommand):
+    help = '合成した注文データで関連商品の集計時間・保持する組の数・エンドポイントの応答時間を計測する（テスト用DBを使用）'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--products', type=int, default=10000)
+        parser.add_argument('--orders', type=int, default=1000000)
+        parser.add_argument('--partitions', type=int, action='append', help='比較する分割数（既定 1 と 4）')
+        parser.add_argument('--batch-size', type=int, default=10000)
+        parser.add_argument('--repeat', type=int, default=50)
+
+    def handle(self, *args, **options):
+        with benchmark_database():
+            seed_catalog(options['products'])
+            start = time.perf_counter()
+            details = self.seed_orders(options['orders'], options['batch_size'])
+            self.stdout.write(
+                f'注文 {options["orders"]}件・明細 {details}件を作成 ({time.perf_counter() - start:.1f}s)'
+            )
+
+            products = OrderDetail.objects.values('product_id').distinct().count()
+            self.stdout.write(f'注文に現れた商品 {products}件 / {options["products"]}件')
+
+            # 最大RSSはプロセス全体で単調に増えるため、分割数の多い（メモリの少ない）方から計測する
+            for partitions in sorted(options['partitions'] or [1, 4], reverse=True):
+                # 集計中に保持する組の数（メモリ使用量の目安）は最も大きい分割で決まる
+                pairs = max(
+                    sum(len(neighbors) for neighbors in count_cooccurrences(p, partitions).values())
+                    for p in range(partitions)
+                )
+                start = time.perf_counter()
+                written = build_related_products(partitions)
+                # Linux では KB 単位
+                rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+                self.stdout.write(
+                    f'分割数 {partitions}: 集計と保存 {time.perf_counter() - start:7.1f}s  '
+                    f'保持する組 最大 {pairs}件  保存 {written}件  最大RSS {rss:.0f}MB'
+                )
+
+            client = Client()
+            # 商品ごとに1回ずつ取得してキャッシュに当たらないようにする
+            urls = iter([
+                f'/api/auth/products/{pk}/related/'
+                for pk in Product.objects.values_list('pk', flat=True)[:options['repeat']]
+            ])
+            latency = measure(lambda: client.get(next(urls)), options['repeat'])
+            self.stdout.write(f'products/<pk>/related/ {latency:.2f}ms（キャッシュなしの初回）')
+
+    def seed_orders(self, count, batch_size, seed=0):
+        """
+        1注文に1〜6商品、同じカテゴリの商品を選ばれやすくし、商品の人気にはカテゴリ内の全商品にわたる Zipf 分布
+        （s=1、k 番目の商品が 1/k の重み）で偏りをつける
+        bulk_create で id を受け取れないDBもあるため、注文の id は明示する
+        """
+        rng = random.Random(seed)
+        user = UserAccount.objects.create_user('bench@example.com', 'ベンチ', 'password')
+        shipping = ShippingInformation.objects.create(
+            user=user, address='千代田1-1', city='千代田区', state='東京都', postal_code='1000001', country='JP'
+        )
+        by_category = {}
+        for pk, category_id in Product.objects.order_by('pk').values_list('pk', 'category_id'):
+            by_category.setdefault(category_id, []).append(pk)
+        categories = list(by_category.values())
+        weights = {}
+
+        def pick(products):
+            # 先頭ほど選ばれやすい（人気商品）が、末尾の商品もまれに選ばれる
+            n = len(products)
+            if n not in weights:
+                weights[n] = list(accumulate(1 / k for k in range(1, n + 1)))
+            return rng.choices(products, cum_weights=weights[n])[0]
+
+        orders, details, total = [], [], 0
+        for order_id in range(1, count + 1):
+            orders.append(Order(
+                id=order_id, user=user, shipping_information=shipping, total_price=0, status='Delivered'
+            ))
+            products = rng.choice(categories)
+            basket = {pick(products) for _ in range(rng.randint(1, 6))}
+            if rng.random() < 0.3:
+                basket.add(pick(rng.choice(categories)))
+            for product_id in basket:
+                details.append(OrderDetail(
+                    order_id=order_id, product_id=product_id, product_name='', quantity=1, price=Decimal('1000')
+                ))
+            if len(orders) >= batch_size:
+                total += self.flush(orders, details)
+                orders, details = [], []
+        total += self.flush(orders, details)
+        analyze()
+        return total
+
+    def flush(self, orders, details):
+        Order.objects.bulk_create(orders)
+        OrderDetail.objects.bulk_create(details)
+        return len(details)
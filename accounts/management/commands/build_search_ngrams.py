@@ -0,0 +1,15 @@
+from django.core.management.base import BaseCommand
+
+from accounts.search import rebuild_ngrams
+
+
+class Command(BaseCommand):
+    help = '商品検索用の n-gram の表をすべての商品について作り直す（bulk_create 等で商品を登録した後に実行する）'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--chunk-size', type=int, default=1000)
+        parser.add_argument('--batch-size', type=int, default=5000)
+
+    def handle(self, *args, **options):
+        rows = rebuild_ngrams(options['chunk_size'], options['batch_size'])
+        self.stdout.write(self.style.SUCCESS(f'{rows}件の n-gram を作成しました'))
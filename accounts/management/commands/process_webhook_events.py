@@ -0,0 +1,24 @@
+import time
+
+from django.core.management.base import BaseCommand
+
+from accounts.webhooks import process_pending_events
+
+
+class Command(BaseCommand):
+    help = '保存されたStripe Webhookイベントをまとめて処理する'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=100)
+        parser.add_argument('--loop', action='store_true', help='処理待ちのイベントを待ち続ける')
+        parser.add_argument('--interval', type=float, default=1.0)
+
+    def handle(self, *args, **options):
+        while True:
+            processed = process_pending_events(options['batch_size'])
+            if processed:
+                self.stdout.write(f'{processed}件のイベントを処理しました')
+            if not options['loop']:
+                break
+            if processed < options['batch_size']:
+                time.sleep(options['interval'])
@@ -0,0 +1,23 @@
+from django.core.management.base import BaseCommand
+
+from accounts.models import Cart
+
+
+class Command(BaseCommand):
+    help = 'カートの商品点数・小計を明細から計算し直し、ずれているものをまとめて修正する'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=1000)
+        parser.add_argument('--dry-run', action='store_true')
+
+    def handle(self, *args, **options):
+        drifted = list(Cart.objects.drifted().order_by('pk').values_list('pk', flat=True))
+        self.stdout.write(f'集計値がずれているカート: {len(drifted)}件')
+        if options['dry_run']:
+            return
+
+        batch_size = options['batch_size']
+        fixed = 0
+        for start in range(0, len(drifted), batch_size):
+            fixed += Cart.objects.filter(pk__in=drifted[start:start + batch_size]).refresh_summary()
+        self.stdout.write(self.style.SUCCESS(f'{fixed}件のカートを修正しました'))
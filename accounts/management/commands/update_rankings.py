@@ -0,0 +1,22 @@
+import time
+
+from django.core.management.base import BaseCommand
+
+from accounts.rankings import update_rankings
+
+
+class Command(BaseCommand):
+    help = '注文・カート・お気に入りの直近の件数から商品のランキングを集計し直す（定期実行用）'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=1000)
+        parser.add_argument('--loop', action='store_true', help='interval 秒ごとに集計し続ける')
+        parser.add_argument('--interval', type=float, default=3600.0)
+
+    def handle(self, *args, **options):
+        while True:
+            updated = update_rankings(batch_size=options['batch_size'])
+            self.stdout.write(f'{updated}件の商品のランキングを更新しました')
+            if not options['loop']:
+                break
+            time.sleep(options['interval'])
@@ -0,0 +1,17 @@
+# Generated by Django 3.2.9 on 2026-10-18 12:56
+
+from django.db import migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('accounts', '0008_product_ranking'),
+    ]
+
+    operations = [
+        migrations.AlterModelOptions(
+            name='product',
+            options={'ordering': ('-created_at', '-id'), 'verbose_name': '商品', 'verbose_name_plural': '商品'},
+        ),
+    ]
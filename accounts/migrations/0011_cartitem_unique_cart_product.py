@@ -0,0 +1,33 @@
+# Generated by Django 3.2.9 on 2026-10-18 13:05
+
+from django.db import migrations, models
+from django.db.models import Count, Min, Sum
+
+
+def merge_duplicate_cart_items(apps, schema_editor):
+    # 一意制約の追加前に、同じカート・商品の行を数量を合計して1行にまとめる
+    CartItem = apps.get_model('accounts', 'CartItem')
+    duplicates = (
+        CartItem.objects.values('cart_id', 'product_id')
+        .annotate(rows=Count('id'), keep_id=Min('id'), total=Sum('quantity'))
+        .filter(rows__gt=1)
+    )
+    for row in duplicates:
+        items = CartItem.objects.filter(cart_id=row['cart_id'], product_id=row['product_id'])
+        items.exclude(id=row['keep_id']).delete()
+        items.filter(id=row['keep_id']).update(quantity=row['total'])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('accounts', '0010_product_listing_indexes'),
+    ]
+
+    operations = [
+        migrations.RunPython(merge_duplicate_cart_items, migrations.RunPython.noop),
+        migrations.AddConstraint(
+            model_name='cartitem',
+            constraint=models.UniqueConstraint(fields=('cart', 'product'), name='unique_cart_product'),
+        ),
+    ]
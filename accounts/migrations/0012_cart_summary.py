@@ -0,0 +1,43 @@
+# Generated by Django 3.2.9 on 2026-10-18 13:01
+
+from decimal import Decimal
+from django.db import migrations, models
+from django.db.models import DecimalField, ExpressionWrapper, F, OuterRef, Subquery, Sum
+from django.db.models.functions import Coalesce
+
+
+def backfill_cart_summary(apps, schema_editor):
+    Cart = apps.get_model('accounts', 'Cart')
+    CartItem = apps.get_model('accounts', 'CartItem')
+    items = CartItem.objects.filter(cart=OuterRef('pk')).order_by().values('cart')
+    line_total = ExpressionWrapper(
+        F('product__price') * F('quantity'), output_field=DecimalField(max_digits=12, decimal_places=2)
+    )
+    Cart.objects.update(
+        item_count=Coalesce(Subquery(items.annotate(n=Sum('quantity')).values('n')), 0),
+        subtotal=Coalesce(
+            Subquery(items.annotate(total=Sum(line_total)).values('total')), Decimal('0.00'),
+            output_field=DecimalField(max_digits=12, decimal_places=2),
+        ),
+    )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('accounts', '0011_cartitem_unique_cart_product'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='cart',
+            name='item_count',
+            field=models.PositiveIntegerField(default=0, verbose_name='商品点数'),
+        ),
+        migrations.AddField(
+            model_name='cart',
+            name='subtotal',
+            field=models.DecimalField(decimal_places=2, default=Decimal('0.00'), max_digits=12, verbose_name='小計'),
+        ),
+        migrations.RunPython(backfill_cart_summary, migrations.RunPython.noop),
+    ]
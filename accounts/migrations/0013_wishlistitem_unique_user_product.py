@@ -0,0 +1,33 @@
+# Generated by Django 3.2.9 on 2026-10-18 13:02
+
+from django.db import migrations, models
+from django.db.models import Count, Min
+
+
+def remove_duplicate_wishlist_items(apps, schema_editor):
+    # 一意制約の追加前に、同じユーザー・商品の重複行を最初の1行だけ残して削除する
+    WishlistItem = apps.get_model('accounts', 'WishlistItem')
+    duplicates = (
+        WishlistItem.objects.values('user_id', 'product_id')
+        .annotate(rows=Count('id'), keep_id=Min('id'))
+        .filter(rows__gt=1)
+    )
+    for row in duplicates:
+        WishlistItem.objects.filter(
+            user_id=row['user_id'], product_id=row['product_id']
+        ).exclude(id=row['keep_id']).delete()
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('accounts', '0012_cart_summary'),
+    ]
+
+    operations = [
+        migrations.RunPython(remove_duplicate_wishlist_items, migrations.RunPython.noop),
+        migrations.AddConstraint(
+            model_name='wishlistitem',
+            constraint=models.UniqueConstraint(fields=('user', 'product'), name='unique_wishlist_product'),
+        ),
+    ]
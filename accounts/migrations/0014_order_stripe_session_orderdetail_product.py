@@ -0,0 +1,24 @@
+# Generated by Django 3.2.9 on 2026-10-18 13:03
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('accounts', '0013_wishlistitem_unique_user_product'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='order',
+            name='stripe_session_id',
+            field=models.CharField(blank=True, max_length=255, null=True, verbose_name='Stripeセッション'),
+        ),
+        migrations.AddField(
+            model_name='orderdetail',
+            name='product',
+            field=models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, to='accounts.product'),
+        ),
+    ]
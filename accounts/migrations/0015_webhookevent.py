@@ -0,0 +1,33 @@
+# Generated by Django 3.2.9 on 2026-10-18 13:04
+
+from django.db import migrations, models
+import django.utils.timezone
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('accounts', '0014_order_stripe_session_orderdetail_product'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='WebhookEvent',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('event_id', models.CharField(max_length=255, unique=True, verbose_name='イベントID')),
+                ('type', models.CharField(max_length=255, verbose_name='種類')),
+                ('payload', models.JSONField()),
+                ('status', models.CharField(choices=[('pending', 'PENDING'), ('failed', 'FAILED'), ('done', 'DONE'), ('dead', 'DEAD')], default='pending', max_length=10)),
+                ('attempts', models.PositiveSmallIntegerField(default=0)),
+                ('last_error', models.TextField(blank=True)),
+                ('next_attempt_at', models.DateTimeField(default=django.utils.timezone.now)),
+                ('received_at', models.DateTimeField(auto_now_add=True)),
+                ('processed_at', models.DateTimeField(blank=True, null=True)),
+            ],
+        ),
+        migrations.AddIndex(
+            model_name='webhookevent',
+            index=models.Index(fields=['status', 'next_attempt_at'], name='webhook_status_next_idx'),
+        ),
+    ]
@@ -0,0 +1,35 @@
+from django.db import migrations
+
+# 商品検索用の pg_trgm 索引（PostgreSQL のみ）
+# icontains は UPPER(列::text) LIKE UPPER(%s) になるため、同じ式で索引を作る
+CREATE_SQL = [
+    'CREATE EXTENSION IF NOT EXISTS pg_trgm',
+    'CREATE INDEX IF NOT EXISTS product_name_trgm_idx '
+    'ON accounts_product USING gin (UPPER(name::text) gin_trgm_ops)',
+    'CREATE INDEX IF NOT EXISTS product_description_trgm_idx '
+    'ON accounts_product USING gin (UPPER(description::text) gin_trgm_ops)',
+]
+DROP_SQL = [
+    'DROP INDEX IF EXISTS product_name_trgm_idx',
+    'DROP INDEX IF EXISTS product_description_trgm_idx',
+]
+
+
+def run(statements):
+    def operation(apps, schema_editor):
+        if schema_editor.connection.vendor != 'postgresql':
+            return
+        for sql in statements:
+            schema_editor.execute(sql)
+    return operation
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('accounts', '0015_webhookevent'),
+    ]
+
+    operations = [
+        migrations.RunPython(run(CREATE_SQL), run(DROP_SQL)),
+    ]
@@ -0,0 +1,40 @@
+# Generated by Django 3.2.9 on 2026-10-18 13:24
+
+from django.db import migrations, models
+from django.db.models import OuterRef, Subquery
+import django.utils.timezone
+
+
+def backfill_added_at(apps, schema_editor):
+    # 既存の明細は追加日時が分からないため、カートの作成日時を使う（全件を今追加したことにしない）
+    Cart = apps.get_model('accounts', 'Cart')
+    CartItem = apps.get_model('accounts', 'CartItem')
+    CartItem.objects.update(added_at=Subquery(Cart.objects.filter(pk=OuterRef('cart_id')).values('created_at')[:1]))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('accounts', '0016_product_search_trgm'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='cartitem',
+            name='added_at',
+            field=models.DateTimeField(default=django.utils.timezone.now, verbose_name='追加日時'),
+        ),
+        migrations.RunPython(backfill_added_at, migrations.RunPython.noop),
+        migrations.AddIndex(
+            model_name='cartitem',
+            index=models.Index(fields=['added_at'], name='cartitem_added_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='order',
+            index=models.Index(fields=['ordered_at'], name='order_ordered_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='wishlistitem',
+            index=models.Index(fields=['added_date'], name='wishlist_added_idx'),
+        ),
+    ]
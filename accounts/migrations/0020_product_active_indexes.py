@@ -0,0 +1,41 @@
+# Generated by Django 3.2.9 on 2026-10-18 13:50
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('accounts', '0019_order_pending_status'),
+    ]
+
+    operations = [
+        migrations.RemoveIndex(
+            model_name='product',
+            name='product_active_created_idx',
+        ),
+        migrations.RemoveIndex(
+            model_name='product',
+            name='product_sales_created_idx',
+        ),
+        migrations.RemoveIndex(
+            model_name='product',
+            name='product_recommend_created_idx',
+        ),
+        migrations.RemoveIndex(
+            model_name='product',
+            name='product_new_created_idx',
+        ),
+        migrations.AddIndex(
+            model_name='product',
+            index=models.Index(condition=models.Q(('is_active', True), ('sales_discount', True)), fields=['-created_at', '-id'], name='product_sales_created_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='product',
+            index=models.Index(condition=models.Q(('is_active', True), ('recommend', True)), fields=['-created_at', '-id'], name='product_recommend_created_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='product',
+            index=models.Index(condition=models.Q(('is_active', True), ('new_product', True)), fields=['-created_at', '-id'], name='product_new_created_idx'),
+        ),
+    ]
@@ -0,0 +1,44 @@
+# Generated by Django 3.2.9 on 2026-10-18 14:11
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+from accounts.search import normalize, ngrams
+
+
+def backfill_ngrams(apps, schema_editor):
+    # 既存の商品の n-gram を1000件ずつ作成する
+    Product = apps.get_model('accounts', 'Product')
+    ProductNgram = apps.get_model('accounts', 'ProductNgram')
+    batch = []
+    for pk, name, description in Product.objects.order_by('id').values_list('id', 'name', 'description').iterator(1000):
+        batch.extend(
+            ProductNgram(product_id=pk, gram=gram) for gram in ngrams(normalize(name)) | ngrams(normalize(description))
+        )
+        if len(batch) >= 5000:
+            ProductNgram.objects.bulk_create(batch)
+            batch = []
+    ProductNgram.objects.bulk_create(batch)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('accounts', '0020_product_active_indexes'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ProductNgram',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('gram', models.CharField(max_length=2)),
+                ('product', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='+', to='accounts.product')),
+            ],
+        ),
+        migrations.AddConstraint(
+            model_name='productngram',
+            constraint=models.UniqueConstraint(fields=('gram', 'product'), name='unique_ngram_product'),
+        ),
+        migrations.RunPython(backfill_ngrams, migrations.RunPython.noop),
+    ]
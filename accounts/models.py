@@ -1,6 +1,9 @@
-from django.db import models
+from django.db import IntegrityError, models, transaction
+from django.db.models.functions import Coalesce
 from django.contrib.auth.models import AbstractBaseUser, PermissionsMixin, BaseUserManager
 from django.urls import reverse
+from django.utils import timezone
+from decimal import Decimal
 from enum import Enum
 
 
@@ -67,6 +70,63 @@ class Category(models.Model):
         return reverse('store:category_list', args=[self.slug])
     
 
+class ProductQuerySet(models.QuerySet):
+    # 商品カード（一覧表示）に必要な列
+    card_fields = (
+        'id', 'name', 'slug', 'image', 'price', 'in_stock', 'sales_discount', 'recommend',
+        'new_product', 'ranking', 'created_at', 'category_id', 'category__name', 'category__slug',
+    )
+
+    # 公開中の商品（管理画面で無効にした商品は一覧・詳細に出さない）
+    def active(self):
+        return self.filter(is_active=True)
+
+    # 一覧・詳細表示用（カテゴリをJOINで同時に取得してN+1クエリを防ぐ）
+    def catalog(self):
+        return self.active().select_related('category')
+
+    # 一覧表示用（モデルを生成せず必要な列だけを辞書で取得する）
+    def cards(self):
+        return self.active().values(*self.card_fields)
+
+    def in_category(self, category):
+        return self.filter(category=category)
+
+    def sales_discount(self):
+        return self.filter(sales_discount=True)
+
+    def recommended(self):
+        return self.filter(recommend=True)
+
+    def new_products(self):
+        return self.filter(new_product=True)
+
+    # ランキング順（ランキングのある商品だけの部分インデックスを順に読む）
+    def ranked(self):
+        return self.filter(ranking__isnull=False).order_by('ranking', 'id')
+
+    # 価格を一括で変更した場合は post_save が送られないため、ここでカートの小計を計算し直す
+    # （生のSQLなどそれ以外の方法で価格を変更した場合は reconcile_cart_summaries を実行する）
+    def update(self, **kwargs):
+        if 'price' not in kwargs:
+            return super().update(**kwargs)
+        with transaction.atomic():
+            # 価格で絞り込んでいる場合もあるため、更新前に対象のカートを求めておく
+            cart_ids = list(Cart.objects.filter(items__product__in=self.values('pk')).values_list('pk', flat=True))
+            updated = super().update(**kwargs)
+            Cart.objects.filter(pk__in=set(cart_ids)).refresh_summary()
+        return updated
+
+    def bulk_update(self, objs, fields, batch_size=None):
+        if 'price' not in fields:
+            return super().bulk_update(objs, fields, batch_size=batch_size)
+        objs = list(objs)
+        with transaction.atomic():
+            updated = super().bulk_update(objs, fields, batch_size=batch_size)
+            Cart.objects.filter(items__product__in=[obj.pk for obj in objs]).refresh_summary()
+        return updated
+
+
 class Product(models.Model):
     category = models.ForeignKey(Category, on_delete=models.CASCADE)
     name = models.CharField("商品名", max_length=200, unique=True)
@@ -83,10 +143,26 @@ class Product(models.Model):
     new_product = models.BooleanField(default=False) 
     ranking = models.IntegerField(null=True, blank=True) # ランキング
 
+    objects = ProductQuerySet.as_manager()
+
     class Meta:
         verbose_name = '商品'
         verbose_name_plural = '商品'
-        ordering = ('-created_at',)
+        ordering = ('-created_at', '-id')
+        indexes = [
+            # 一覧・キーセットページネーション用
+            models.Index(fields=['-created_at', '-id'], name='product_created_idx'),
+            models.Index(fields=['category', '-created_at', '-id'], name='product_category_created_idx'),
+            # フラグ付き商品は少数のため、公開中の商品だけの部分インデックスにする
+            models.Index(fields=['-created_at', '-id'], name='product_sales_created_idx',
+                         condition=models.Q(sales_discount=True, is_active=True)),
+            models.Index(fields=['-created_at', '-id'], name='product_recommend_created_idx',
+                         condition=models.Q(recommend=True, is_active=True)),
+            models.Index(fields=['-created_at', '-id'], name='product_new_created_idx',
+                         condition=models.Q(new_product=True, is_active=True)),
+            models.Index(fields=['ranking'], name='product_ranking_idx',
+                         condition=models.Q(ranking__isnull=False)),
+        ]
 
     def __str__(self):
         return self.name
@@ -94,17 +170,183 @@ class Product(models.Model):
     def get_absolute_url(self):
         return reverse('store:product_detail', args=[self.category.slug, self.slug])
     
+class CartQuerySet(models.QuerySet):
+    def add_to_summary(self, product_id, quantity):
+        # 商品点数と小計を差分で更新する（単価はサブクエリで取得）
+        price = Product.objects.filter(pk=product_id).values('price')[:1]
+        return self.update(
+            item_count=models.F('item_count') + quantity,
+            subtotal=models.F('subtotal') + models.Subquery(price) * quantity,
+        )
+
+    def clear_summary(self):
+        return self.update(item_count=0, subtotal=Decimal('0.00'))
+
+    def with_computed_summary(self):
+        items = CartItem.objects.filter(cart=models.OuterRef('pk')).order_by().values('cart')
+        return self.annotate(
+            computed_item_count=Coalesce(
+                models.Subquery(items.annotate(n=models.Sum('quantity')).values('n')), 0
+            ),
+            computed_subtotal=Coalesce(
+                models.Subquery(items.annotate(total=models.Sum(CartItemQuerySet.line_total)).values('total')),
+                Decimal('0.00'), output_field=models.DecimalField(max_digits=12, decimal_places=2),
+            ),
+        )
+
+    def drifted(self):
+        # 保持している集計値と明細から計算した値が一致しないカート
+        return self.with_computed_summary().exclude(
+            item_count=models.F('computed_item_count'), subtotal=models.F('computed_subtotal')
+        )
+
+    def refresh_summary(self):
+        # 明細から商品点数と小計を計算し直す（対象のカートをまとめて1回のUPDATEで更新）
+        computed = self.model.objects.with_computed_summary().filter(pk=models.OuterRef('pk'))
+        return self.update(
+            item_count=models.Subquery(computed.values('computed_item_count')),
+            subtotal=models.Subquery(computed.values('computed_subtotal')),
+        )
+
+
 class Cart(models.Model):
     user = models.ForeignKey(UserAccount, on_delete=models.CASCADE, related_name='cart')
     created_at = models.DateTimeField(auto_now_add=True)
+    item_count = models.PositiveIntegerField("商品点数", default=0)
+    subtotal = models.DecimalField("小計", max_digits=12, decimal_places=2, default=Decimal('0.00'))
+
+    objects = CartQuerySet.as_manager()
 
     def __str__(self):
         return f'Cart {self.id}'
 
+class CartItemQuerySet(models.QuerySet):
+    line_total = models.ExpressionWrapper(
+        models.F('product__price') * models.F('quantity'),
+        output_field=models.DecimalField(max_digits=12, decimal_places=2),
+    )
+
+    # 各行の小計（単価×数量）をSQLで計算する
+    def with_line_total(self):
+        return self.select_related('product').annotate(line_total=self.line_total)
+
+    # カート全体の合計金額と商品点数をSQLで集計する
+    def totals(self):
+        totals = self.aggregate(subtotal=models.Sum(self.line_total), item_count=models.Sum('quantity'))
+        return {
+            'subtotal': totals['subtotal'] or Decimal('0.00'),
+            'item_count': totals['item_count'] or 0,
+        }
+
+    def add(self, cart_id, product_id, quantity=1):
+        """
+        カートに商品を追加する（既にあれば数量を加算）
+        数量はF()で加算するため同時に追加されても更新が失われない
+        """
+        with transaction.atomic():
+            items = self.filter(cart_id=cart_id, product_id=product_id)
+            # 追加し直した商品もランキングの集計期間に入るよう追加日時を更新する
+            increase = {'quantity': models.F('quantity') + quantity, 'added_at': timezone.now()}
+            if not items.update(**increase):
+                if not Product.objects.active().filter(pk=product_id).exists():
+                    raise Product.DoesNotExist
+                try:
+                    with transaction.atomic():
+                        self.create(cart_id=cart_id, product_id=product_id, quantity=quantity)
+                except IntegrityError:
+                    # 同時に作成された場合は一意制約で検出して加算し直す
+                    items.update(**increase)
+            Cart.objects.filter(pk=cart_id).add_to_summary(product_id, quantity)
+
+    def decrease(self, cart_id, product_id):
+        # 数量を1減らす（1個の場合はそのまま）
+        with transaction.atomic():
+            items = self.filter(cart_id=cart_id, product_id=product_id, quantity__gt=1)
+            if items.update(quantity=models.F('quantity') - 1):
+                Cart.objects.filter(pk=cart_id).add_to_summary(product_id, -1)
+
+    def remove(self, cart_id, product_id):
+        with transaction.atomic():
+            items = self.select_for_update().filter(cart_id=cart_id, product_id=product_id)
+            quantity = items.values_list('quantity', flat=True).first()
+            if quantity is not None:
+                items.delete()
+                Cart.objects.filter(pk=cart_id).add_to_summary(product_id, -quantity)
+
+    def clear(self, cart_id):
+        with transaction.atomic():
+            self.filter(cart_id=cart_id).delete()
+            Cart.objects.filter(pk=cart_id).clear_summary()
+
+    def apply_operations(self, cart_id, operations):
+        """
+        複数のカート操作を1トランザクションでまとめて適用する
+        operations は {'product_id', 'action' または 'quantity'} の辞書のリスト
+        存在しない商品idが含まれる場合は Product.DoesNotExist を送出する
+        """
+        product_ids = {op['product_id'] for op in operations}
+        with transaction.atomic():
+            # 既存の行をロックして、同時に行われた数量の加算を上書きしないようにする
+            items = {
+                item.product_id: item
+                for item in self.select_for_update().filter(cart_id=cart_id, product_id__in=product_ids)
+            }
+            missing = product_ids - set(items)
+            if missing and Product.objects.active().filter(pk__in=missing).count() != len(missing):
+                raise Product.DoesNotExist
+
+            quantities = {product_id: item.quantity for product_id, item in items.items()}
+            for op in operations:
+                current = quantities.get(op['product_id'], 0)
+                if 'quantity' in op:
+                    current = op['quantity']
+                elif op['action'] == 'increase':
+                    current += 1
+                elif op['action'] == 'decrease' and current > 1:
+                    current -= 1
+                elif op['action'] == 'remove':
+                    current = 0
+                quantities[op['product_id']] = current
+
+            created, updated, removed = [], [], []
+            now = timezone.now()
+            for product_id, quantity in quantities.items():
+                item = items.get(product_id)
+                if item is None:
+                    if quantity > 0:
+                        created.append(self.model(cart_id=cart_id, product_id=product_id, quantity=quantity))
+                elif quantity == 0:
+                    removed.append(item.pk)
+                elif quantity != item.quantity:
+                    if quantity > item.quantity:
+                        item.added_at = now
+                    item.quantity = quantity
+                    updated.append(item)
+
+            if created:
+                self.bulk_create(created)
+            if updated:
+                self.bulk_update(updated, ['quantity', 'added_at'])
+            if removed:
+                self.filter(pk__in=removed).delete()
+            Cart.objects.filter(pk=cart_id).refresh_summary()
+
+
 class CartItem(models.Model):
     cart = models.ForeignKey(Cart, on_delete=models.CASCADE, related_name='items')
     product = models.ForeignKey(Product, on_delete=models.CASCADE)
     quantity = models.PositiveIntegerField(default=1)
+    added_at = models.DateTimeField("追加日時", default=timezone.now) # 最後に数量を増やした日時（ランキングの集計期間の判定用）
+
+    objects = CartItemQuerySet.as_manager()
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['cart', 'product'], name='unique_cart_product'),
+        ]
+        indexes = [
+            models.Index(fields=['added_at'], name='cartitem_added_idx'),
+        ]
 
     def __str__(self):
         return f'Cart {self.cart.id} Item {self.id}'
@@ -114,11 +356,38 @@ class CartItem(models.Model):
     
 
 
+class WishlistItemQuerySet(models.QuerySet):
+    def add(self, user_id, product_id):
+        """
+        お気に入りに追加する（既に追加済みの場合は一意制約の衝突を無視して何もしない）
+        存在しない商品idの場合は Product.DoesNotExist を送出する
+        """
+        if not Product.objects.active().filter(pk=product_id).exists():
+            raise Product.DoesNotExist
+        self.bulk_create([self.model(user_id=user_id, product_id=product_id)], ignore_conflicts=True)
+
+    def product_ids(self, user_id, product_ids=None):
+        items = self.filter(user_id=user_id)
+        if product_ids is not None:
+            items = items.filter(product_id__in=product_ids)
+        return list(items.order_by('added_date', 'id').values_list('product_id', flat=True))
+
+
 class WishlistItem(models.Model):
     user = models.ForeignKey(UserAccount, on_delete=models.CASCADE)
     product = models.ForeignKey(Product, on_delete=models.CASCADE)
     added_date = models.DateTimeField(auto_now_add=True)
 
+    objects = WishlistItemQuerySet.as_manager()
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['user', 'product'], name='unique_wishlist_product'),
+        ]
+        indexes = [
+            models.Index(fields=['added_date'], name='wishlist_added_idx'),
+        ]
+
 
 
 
@@ -136,8 +405,15 @@ class Order(models.Model):
     user = models.ForeignKey(UserAccount, related_name='orders', on_delete=models.CASCADE)
     shipping_information = models.ForeignKey(ShippingInformation, on_delete=models.CASCADE)
     total_price = models.DecimalField(max_digits=10, decimal_places=2)
-    status = models.CharField(max_length=50, choices=[('Processing', 'Processing'), ('Shipped', 'Shipped'), ('Delivered', 'Delivered')])
+    status = models.CharField(max_length=50, choices=[('Pending', 'Pending'), ('Processing', 'Processing'), ('Shipped', 'Shipped'), ('Delivered', 'Delivered')]) # Pending: 支払い待ち
     ordered_at = models.DateTimeField(auto_now_add=True)
+    stripe_session_id = models.CharField("Stripeセッション", max_length=255, blank=True, null=True)
+
+    class Meta:
+        indexes = [
+            # ランキングの集計期間で絞り込む
+            models.Index(fields=['ordered_at'], name='order_ordered_idx'),
+        ]
 
     def __str__(self):
         return f"Order {self.id} by {self.user.name}"
@@ -151,6 +427,7 @@ class ShippingState(Enum):
     
 class OrderDetail(models.Model):
     order = models.ForeignKey(Order, on_delete=models.CASCADE)
+    product = models.ForeignKey(Product, on_delete=models.SET_NULL, blank=True, null=True)
     product_name = models.CharField(max_length=255)
     quantity = models.PositiveIntegerField()
     price = models.DecimalField(max_digits=10, decimal_places=2)
@@ -158,4 +435,109 @@ class OrderDetail(models.Model):
         max_length=10,
         choices=[(state.value, state.name) for state in ShippingState],
         default=ShippingState.PENDING.value,
-    )
\ No newline at end of file
+    )
+
+class WebhookStatus(Enum):
+    PENDING = 'pending'
+    FAILED = 'failed' # 再試行待ち
+    DONE = 'done'
+    DEAD = 'dead' # 再試行の上限に達したもの
+
+
+class WebhookEvent(models.Model):
+    event_id = models.CharField("イベントID", max_length=255, unique=True)
+    type = models.CharField("種類", max_length=255)
+    payload = models.JSONField()
+    status = models.CharField(
+        max_length=10,
+        choices=[(status.value, status.name) for status in WebhookStatus],
+        default=WebhookStatus.PENDING.value,
+    )
+    attempts = models.PositiveSmallIntegerField(default=0)
+    last_error = models.TextField(blank=True)
+    next_attempt_at = models.DateTimeField(default=timezone.now)
+    received_at = models.DateTimeField(auto_now_add=True)
+    processed_at = models.DateTimeField(blank=True, null=True)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['status', 'next_attempt_at'], name='webhook_status_next_idx'),
+        ]
+
+    def __str__(self):
+        return f'{self.type} {self.event_id}'
+
+
+class RelatedProductQuerySet(models.QuerySet):
+    def replace_all(self, rows, batch_size=5000):
+        """
+        関連商品をすべて rows（(商品id, 関連商品id, スコア) を商品ごとにまとめてスコア順に並べたもの）で置き換える
+        1トランザクションで入れ替えるため、集計中や書き込み中も古い関連商品を返し続ける
+        """
+        def related_products():
+            previous, rank = None, 0
+            for product_id, related_id, score in rows:
+                rank = rank + 1 if product_id == previous else 1
+                previous = product_id
+                yield self.model(product_id=product_id, related_id=related_id, rank=rank, score=score)
+
+        with transaction.atomic():
+            self.all().delete()
+            batch = []
+            for related_product in related_products():
+                batch.append(related_product)
+                if len(batch) >= batch_size:
+                    self.bulk_create(batch)
+                    batch = []
+            if batch:
+                self.bulk_create(batch)
+
+
+class RelatedProduct(models.Model):
+    # 「この商品を買った人はこんな商品も」（build_related_products で集計した上位の関連商品）
+    # 一意制約の (product, rank) のインデックスで引けるため、product 単独のインデックスは作らない
+    product = models.ForeignKey(Product, on_delete=models.CASCADE, related_name='+', db_index=False)
+    related = models.ForeignKey(Product, on_delete=models.CASCADE, related_name='related_from')
+    rank = models.PositiveSmallIntegerField("順位")
+    score = models.PositiveIntegerField("スコア")
+
+    objects = RelatedProductQuerySet.as_manager()
+
+    class Meta:
+        constraints = [
+            # 商品ごとの関連商品を順位順に1回のインデックス検索で読む
+            models.UniqueConstraint(fields=['product', 'rank'], name='unique_related_product_rank'),
+        ]
+
+    def __str__(self):
+        return f'{self.product_id} -> {self.related_id} ({self.rank})'
+
+
+class ProductNgramQuerySet(models.QuerySet):
+    def replace_for(self, grams_by_product, batch_size=5000):
+        # grams_by_product（{商品id: n-gram の集合}）の商品の n-gram を1トランザクションで置き換える
+        with transaction.atomic():
+            self.filter(product_id__in=list(grams_by_product)).delete()
+            self.bulk_create(
+                (self.model(product_id=product_id, gram=gram)
+                 for product_id, grams in grams_by_product.items() for gram in grams),
+                batch_size=batch_size,
+            )
+
+
+class ProductNgram(models.Model):
+    # 商品名・説明の1文字と2文字の n-gram（正規化済み）。pg_trgm で絞り込めない1〜2文字の語の検索に使う
+    # 商品の保存時に signals で作り直す（bulk_create 等で登録した場合は build_search_ngrams を実行する）
+    product = models.ForeignKey(Product, on_delete=models.CASCADE, related_name='+')
+    gram = models.CharField(max_length=2)
+
+    objects = ProductNgramQuerySet.as_manager()
+
+    class Meta:
+        constraints = [
+            # n-gram から商品idをインデックスだけで引く
+            models.UniqueConstraint(fields=['gram', 'product'], name='unique_ngram_product'),
+        ]
+
+    def __str__(self):
+        return f'{self.gram} -> {self.product_id}'
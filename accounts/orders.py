@@ -0,0 +1,108 @@
+from django.db import transaction
+
+from .models import Cart, CartItem, Order, OrderDetail, ShippingInformation
+from .payments import get_gateway
+
+
+class OrderError(Exception):
+    pass
+
+
+def get_line_items(items):
+    # Stripeに送る明細はサーバー側の価格から作成する（クライアントの金額は使わない）
+    return [
+        {
+            'price_data': {
+                'currency': 'usd',
+                'product_data': {
+                    'name': item.product.name,
+                },
+                'unit_amount': int(item.product.price * 100), # Cents
+            },
+            'quantity': item.quantity,
+        }
+        for item in items
+    ]
+
+
+def place_order(user_id, success_url, cancel_url):
+    """
+    カートの内容から支払い待ちの注文を作成し、Stripeのチェックアウトセッションを発行する
+    1. カートをロックして明細の取得・合計の計算・注文と注文明細の作成を短いトランザクションで行う
+    2. トランザクションの外でStripeを呼び出す（決済APIの待ち時間の間、接続やロックを保持しない）
+    3. 成功すればセッションIDを保存し、失敗すれば支払い待ちの注文を削除する
+    カートは支払いが完了したとき（complete_order）に空にする
+    """
+    with transaction.atomic():
+        cart = Cart.objects.select_for_update().filter(user_id=user_id).first()
+        if cart is None:
+            raise OrderError('カートが空です')
+
+        items = list(CartItem.objects.filter(cart=cart).with_line_total().order_by('id'))
+        if not items:
+            raise OrderError('カートが空です')
+        unavailable = [item.product.name for item in items if not (item.product.in_stock and item.product.is_active)]
+        if unavailable:
+            raise OrderError(f'在庫切れの商品が含まれています: {", ".join(unavailable)}')
+
+        shipping_information = ShippingInformation.objects.filter(user_id=user_id).first()
+        if shipping_information is None:
+            raise OrderError('配送先が登録されていません')
+
+        order = Order.objects.create(
+            user_id=user_id,
+            shipping_information=shipping_information,
+            total_price=CartItem.objects.filter(cart=cart).totals()['subtotal'],
+            status='Pending',
+        )
+        OrderDetail.objects.bulk_create([
+            OrderDetail(
+                order=order,
+                product=item.product,
+                product_name=item.product.name,
+                quantity=item.quantity,
+                price=item.product.price,
+            )
+            for item in items
+        ])
+
+    try:
+        session = get_gateway().create_checkout_session(
+            payment_method_types=['card'],
+            line_items=get_line_items(items),
+            mode='payment',
+            success_url=success_url,
+            cancel_url=cancel_url,
+            client_reference_id=str(order.id),
+            metadata={'order_id': order.id},
+            # 再試行で同じ注文のセッションが重複して作られないようにする
+            idempotency_key=f'order-{order.id}',
+        )
+    except Exception:
+        # 支払いを始められなかった注文は残さない
+        Order.objects.filter(pk=order.pk, status='Pending').delete()
+        raise
+
+    Order.objects.filter(pk=order.pk).update(stripe_session_id=session.id)
+    order.stripe_session_id = session.id
+    return order, session
+
+
+def complete_order(order_id):
+    """
+    支払いが完了した注文を処理中にし、注文した商品をカートから外す
+    処理済みの注文（Webhookの再送）は何もせず False を返す
+    """
+    with transaction.atomic():
+        order = Order.objects.select_for_update().filter(pk=order_id).values('user_id', 'status').first()
+        if order is None:
+            raise Order.DoesNotExist(f'order {order_id} not found')
+        if order['status'] != 'Pending':
+            return False
+        Order.objects.filter(pk=order_id).update(status='Processing')
+        # 注文後に数量を変えた場合も、注文した商品の行はまとめて外す
+        product_ids = OrderDetail.objects.filter(order_id=order_id).values('product_id')
+        carts = Cart.objects.filter(user_id=order['user_id'])
+        CartItem.objects.filter(cart__in=carts, product_id__in=product_ids).delete()
+        carts.refresh_summary()
+    return True
@@ -0,0 +1,93 @@
+from base64 import urlsafe_b64decode, urlsafe_b64encode
+from collections import OrderedDict
+
+from django.db.models import Q
+from django.utils.dateparse import parse_datetime
+from rest_framework.exceptions import NotFound
+from rest_framework.pagination import PageNumberPagination
+from rest_framework.response import Response
+from rest_framework.utils.urls import remove_query_param, replace_query_param
+
+
+class CatalogPagination(PageNumberPagination):
+    """
+    商品一覧用のページネーション
+    通常はページ番号で取得し、?cursor= を指定した場合は (created_at, id) のキーセットで取得する
+    キーセットではOFFSETとCOUNT(*)を実行しないため、深いページでも速度が落ちない
+    """
+    cursor_query_param = 'cursor'
+    keyset_ordering = ('-created_at', '-id')
+    invalid_cursor_message = 'Invalid cursor'
+
+    keyset = False
+
+    def paginate_queryset(self, queryset, request, view=None):
+        if not self.is_keyset(request):
+            return super().paginate_queryset(queryset, request, view)
+
+        self.keyset = True
+        self.request = request
+        page_size = self.get_page_size(request)
+
+        # 1件多く取得して次ページの有無を判定する
+        results = list(self.get_keyset_queryset(queryset, request)[:page_size + 1])
+        self.has_next = len(results) > page_size
+        self.page = results[:page_size]
+        return self.page
+
+    def is_keyset(self, request):
+        return self.cursor_query_param in request.query_params
+
+    def get_keyset_queryset(self, queryset, request):
+        # カーソルの位置より後ろの行を (created_at, id) の順に並べる（LIMIT は呼び出し側で付ける）
+        position = self.decode_cursor(request)
+        queryset = queryset.order_by(*self.keyset_ordering)
+        if position is not None:
+            created_at, pk = position
+            queryset = queryset.filter(
+                Q(created_at__lt=created_at) | Q(created_at=created_at, id__lt=pk)
+            )
+        return queryset
+
+    def get_paginated_response(self, data):
+        if not self.keyset:
+            return super().get_paginated_response(data)
+        return Response(OrderedDict([
+            ('next', self.get_next_link()),
+            ('results', data),
+        ]))
+
+    def get_next_link(self):
+        if not self.keyset:
+            return super().get_next_link()
+        if not self.has_next:
+            return None
+        url = remove_query_param(self.request.build_absolute_uri(), self.page_query_param)
+        return replace_query_param(url, self.cursor_query_param, self.encode_cursor(self.page[-1]))
+
+    def get_previous_link(self):
+        if not self.keyset:
+            return super().get_previous_link()
+        return None
+
+    def encode_cursor(self, item):
+        if isinstance(item, dict):
+            created_at, pk = item['created_at'], item['id']
+        else:
+            created_at, pk = item.created_at, item.id
+        position = f'{created_at.isoformat()}|{pk}'
+        return urlsafe_b64encode(position.encode()).decode()
+
+    def decode_cursor(self, request):
+        encoded = request.query_params[self.cursor_query_param]
+        if not encoded:
+            return None
+        try:
+            created_at, pk = urlsafe_b64decode(encoded.encode()).decode().split('|')
+            created_at = parse_datetime(created_at)
+            pk = int(pk)
+        except (TypeError, ValueError):
+            raise NotFound(self.invalid_cursor_message)
+        if created_at is None:
+            raise NotFound(self.invalid_cursor_message)
+        return created_at, pk
@@ -0,0 +1,147 @@
+import itertools
+import threading
+import time
+from types import SimpleNamespace
+
+import stripe
+from django.conf import settings
+from django.core.signals import setting_changed
+from django.dispatch import receiver
+from django.utils.module_loading import import_string
+from stripe.http_client import RequestsClient
+
+from . import executors
+
+
+class PaymentGatewayError(Exception):
+    pass
+
+
+class CircuitOpenError(PaymentGatewayError):
+    pass
+
+
+class CircuitBreaker:
+    """
+    連続して失敗した場合に一定時間呼び出しを止め、すぐにエラーを返す
+    reset_timeout 経過後は1回だけ試し、成功すれば元に戻す
+    """
+
+    def __init__(self, failure_threshold, reset_timeout, failure_exceptions=(Exception,)):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.failure_exceptions = failure_exceptions
+        self.failures = 0
+        self.opened_at = None
+        self._lock = threading.Lock()
+
+    @property
+    def is_open(self):
+        return self.opened_at is not None and time.monotonic() - self.opened_at < self.reset_timeout
+
+    def call(self, func, *args, **kwargs):
+        with self._lock:
+            if self.is_open:
+                raise CircuitOpenError('payment gateway is unavailable')
+            if self.opened_at is not None:
+                # 試行中は他の呼び出しを止めておく
+                self.opened_at = time.monotonic()
+        try:
+            result = func(*args, **kwargs)
+        except self.failure_exceptions:
+            with self._lock:
+                self.failures += 1
+                if self.failures >= self.failure_threshold:
+                    self.opened_at = time.monotonic()
+            raise
+        except Exception:
+            # カードエラー等は相手から応答があったため、成功と同じく回路を閉じる（試行中の枠も解放する）
+            self._close()
+            raise
+        self._close()
+        return result
+
+    def _close(self):
+        with self._lock:
+            self.failures = 0
+            self.opened_at = None
+
+
+class StripeGateway:
+    # タイムアウト・通信障害・5xx・レート制限のみを障害として数える（カードエラー等は数えない）
+    failure_exceptions = (
+        stripe.error.APIConnectionError,
+        stripe.error.APIError,
+        stripe.error.RateLimitError,
+    )
+
+    def __init__(self):
+        stripe.api_key = settings.STRIPE_SECRET_KEY
+        stripe.max_network_retries = settings.STRIPE_MAX_NETWORK_RETRIES
+        # スレッドごとにHTTPセッションを保持して接続を再利用する
+        stripe.default_http_client = RequestsClient(
+            timeout=(settings.STRIPE_CONNECT_TIMEOUT, settings.STRIPE_READ_TIMEOUT)
+        )
+        self.breaker = CircuitBreaker(
+            settings.PAYMENT_CIRCUIT_FAILURE_THRESHOLD,
+            settings.PAYMENT_CIRCUIT_RESET_SECONDS,
+            self.failure_exceptions,
+        )
+
+    def create_checkout_session(self, **params):
+        return self.breaker.call(stripe.checkout.Session.create, **params)
+
+
+class FakeGateway:
+    """
+    テスト・負荷計測用のプロセス内ゲートウェイ
+    latency で応答時間を、fail で障害を再現できる
+    """
+
+    def __init__(self, latency=0.0, fail=False):
+        self.latency = latency
+        self.fail = fail
+        self.sessions = []
+        self._ids = itertools.count(1)
+        self.breaker = CircuitBreaker(
+            settings.PAYMENT_CIRCUIT_FAILURE_THRESHOLD,
+            settings.PAYMENT_CIRCUIT_RESET_SECONDS,
+            StripeGateway.failure_exceptions,
+        )
+
+    def _create(self, **params):
+        if self.latency:
+            time.sleep(self.latency)
+        if self.fail:
+            raise stripe.error.APIConnectionError('fake gateway failure')
+        session = SimpleNamespace(id=f'cs_fake_{next(self._ids)}', **params)
+        self.sessions.append(session)
+        return session
+
+    def create_checkout_session(self, **params):
+        return self.breaker.call(self._create, **params)
+
+
+_gateway = None
+_gateway_lock = threading.Lock()
+
+
+def get_gateway():
+    global _gateway
+    if _gateway is None:
+        with _gateway_lock:
+            if _gateway is None:
+                _gateway = import_string(settings.PAYMENT_GATEWAY)()
+    return _gateway
+
+
+async def run_in_executor(func, *args):
+    # 決済APIの呼び出しはイベントループを止めないよう上限付きのスレッドプールで行う
+    return await executors.run_in_executor('payment', settings.PAYMENT_GATEWAY_WORKERS, func, *args)
+
+
+@receiver(setting_changed)
+def reset_gateway(setting, **kwargs):
+    global _gateway
+    if setting.startswith(('PAYMENT_', 'STRIPE_')):
+        _gateway = None
@@ -0,0 +1,75 @@
+import heapq
+from datetime import timedelta
+
+from django.conf import settings
+from django.db import transaction
+from django.db.models import Count, Sum
+from django.utils import timezone
+
+from .cache import bump_catalog_version
+from .models import CartItem, OrderDetail, Product, ShippingState, WishlistItem
+from .replicas import replica_reads
+
+
+def _counts_by_product(queryset, aggregate):
+    # 有効な商品ごとの件数を GROUP BY で集計する（明細の行をアプリに読み込まない）
+    return queryset.filter(product__is_active=True).order_by().values_list('product_id').annotate(n=aggregate)
+
+
+def compute_scores(now=None):
+    """
+    直近 RANKING_WINDOW_DAYS 日の注文数量・カート追加数・お気に入り追加数を商品ごとに集計し、
+    RANKING_WEIGHTS で重み付けした合計を {商品id: スコア} で返す
+    """
+    since = (now or timezone.now()) - timedelta(days=settings.RANKING_WINDOW_DAYS)
+    sources = {
+        'orders': _counts_by_product(
+            OrderDetail.objects.filter(order__ordered_at__gte=since)
+            .exclude(shipping_state=ShippingState.CANCELED.value)
+            .exclude(order__status='Pending'),  # 支払い待ちの注文は数えない
+            Sum('quantity'),
+        ),
+        'carts': _counts_by_product(CartItem.objects.filter(added_at__gte=since), Count('pk')),
+        'wishlists': _counts_by_product(WishlistItem.objects.filter(added_date__gte=since), Count('pk')),
+    }
+    scores = {}
+    # 集計は重いためレプリカで行う（数秒の遅延はランキングに影響しない）
+    with replica_reads():
+        for name, rows in sources.items():
+            weight = settings.RANKING_WEIGHTS.get(name, 0)
+            if not weight:
+                continue
+            for product_id, n in rows:
+                scores[product_id] = scores.get(product_id, 0) + n * weight
+    return scores
+
+
+def compute_rankings(now=None, size=None):
+    # スコアの高い順（同点は新しい商品を上位）に上位 size 件の {商品id: 順位} を返す
+    size = settings.RANKING_SIZE if size is None else size
+    scores = compute_scores(now)
+    top = heapq.nsmallest(size, scores, key=lambda pk: (-scores[pk], -pk))
+    return {pk: rank for rank, pk in enumerate(top, 1)}
+
+
+def update_rankings(now=None, batch_size=1000):
+    """
+    Product.ranking を集計結果で置き換え、更新した商品数を返す
+    順位が変わった商品だけを bulk_update で batch_size 件ずつ書き込み、圏外になった商品は NULL に戻す
+    一覧の Last-Modified に反映されるよう updated_at も更新する
+    """
+    now = now or timezone.now()
+    rankings = compute_rankings(now)
+    with transaction.atomic():
+        current = dict(Product.objects.filter(ranking__isnull=False).values_list('pk', 'ranking'))
+        changed = [
+            Product(pk=pk, ranking=rank, updated_at=now)
+            for pk, rank in rankings.items() if current.get(pk) != rank
+        ]
+        cleared = [pk for pk in current if pk not in rankings]
+        Product.objects.bulk_update(changed, ['ranking', 'updated_at'], batch_size=batch_size)
+        for start in range(0, len(cleared), batch_size):
+            Product.objects.filter(pk__in=cleared[start:start + batch_size]).update(ranking=None, updated_at=now)
+        if changed or cleared:
+            bump_catalog_version()
+    return len(changed) + len(cleared)
@@ -0,0 +1,82 @@
+import heapq
+from itertools import groupby
+
+from django.conf import settings
+
+from .cache import bump_catalog_version
+from .models import CartItem, OrderDetail, RelatedProduct, ShippingState, WishlistItem
+from .replicas import replica_reads
+
+
+def baskets(chunk_size=10000):
+    """
+    (重み, 商品idのタプル) を1バスケットずつ返す
+    注文・カート・利用者ごとのお気に入りをそれぞれバスケットとし、バスケット順に chunk_size 行ずつ読みながらまとめる
+    """
+    orders = OrderDetail.objects.exclude(shipping_state=ShippingState.CANCELED.value).exclude(order__status='Pending')
+    sources = (
+        ('orders', orders, 'order_id'),
+        ('carts', CartItem.objects.all(), 'cart_id'),
+        ('wishlists', WishlistItem.objects.all(), 'user_id'),
+    )
+    for name, queryset, basket in sources:
+        weight = settings.RELATED_WEIGHTS.get(name, 0)
+        if not weight:
+            continue
+        rows = (
+            queryset.filter(product__is_active=True)
+            .order_by(basket)
+            .values_list(basket, 'product_id')
+            .iterator(chunk_size=chunk_size)
+        )
+        for _, items in groupby(rows, key=lambda row: row[0]):
+            yield weight, tuple({product_id for _, product_id in items})
+
+
+def count_cooccurrences(partition=0, partitions=1, chunk_size=10000):
+    """
+    同じバスケットに入っている商品の組を重み付きで数え、{商品id: {関連商品id: スコア}} を返す
+    組は出現したものだけを持つ（疎）ため、メモリは商品数の2乗ではなく実際の組の数に比例する
+    商品を id % partitions で分け、partition 番目の商品の分だけ数えることでメモリ使用量を 1/partitions にできる
+    """
+    max_size = settings.RELATED_MAX_BASKET_SIZE
+    counts = {}
+    for weight, products in baskets(chunk_size):
+        # まとめ買いの大きなバスケットは組の数が多い割に関連が薄いため数えない
+        if len(products) < 2 or len(products) > max_size:
+            continue
+        for a in products:
+            if a % partitions != partition:
+                continue
+            neighbors = counts.get(a)
+            if neighbors is None:
+                neighbors = counts[a] = {}
+            for b in products:
+                if b != a:
+                    neighbors[b] = neighbors.get(b, 0) + weight
+    return counts
+
+
+def top_related(counts, size):
+    # 商品ごとにスコアの高い順（同点は新しい商品を上位）に上位 size 件の (商品id, 関連商品id, スコア) を返す
+    for product_id, neighbors in counts.items():
+        top = heapq.nsmallest(size, neighbors.items(), key=lambda item: (-item[1], -item[0]))
+        for related_id, score in top:
+            yield product_id, related_id, score
+
+
+def build_related_products(partitions=1, chunk_size=10000, batch_size=5000):
+    """
+    注文・カート・お気に入りの共起から関連商品を集計し、RelatedProduct を置き換える
+    集計は重いためレプリカで行い、書き込みは最後に1トランザクションでまとめて行う
+    書き込んだ件数を返す
+    """
+    rows = []
+    with replica_reads():
+        for partition in range(partitions):
+            counts = count_cooccurrences(partition, partitions, chunk_size)
+            rows.extend(top_related(counts, settings.RELATED_PRODUCTS_SIZE))
+            del counts
+    RelatedProduct.objects.replace_all(rows, batch_size)
+    bump_catalog_version()
+    return len(rows)
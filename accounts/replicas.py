@@ -0,0 +1,84 @@
+import random
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+
+from django.conf import settings
+from rest_framework.permissions import SAFE_METHODS
+
+_use_replica = ContextVar('use_replica', default=False)
+
+
+@contextmanager
+def replica_reads(enabled=True):
+    # ブロック内の読み取りをレプリカに振り分ける（レプリカが未設定なら何もしない）
+    token = _use_replica.set(enabled and bool(settings.DATABASE_REPLICAS))
+    try:
+        yield
+    finally:
+        _use_replica.reset(token)
+
+
+def reading_from_replica():
+    return _use_replica.get()
+
+
+class ReplicaRouter:
+    """
+    replica_reads() の中の読み取りだけをレプリカに送り、それ以外はすべてプライマリ（default）を使う
+    書き込みはレプリカから読んだインスタンスでも必ずプライマリに送る
+    """
+
+    def db_for_read(self, model, **hints):
+        if _use_replica.get():
+            return random.choice(settings.DATABASE_REPLICAS)
+        return 'default'
+
+    def db_for_write(self, model, **hints):
+        return 'default'
+
+    def allow_relation(self, obj1, obj2, **hints):
+        # レプリカはプライマリの複製なので、どのDBから読んだインスタンス同士でも関連付けられる
+        return True
+
+    def allow_migrate(self, db, app_label, model_name=None, **hints):
+        return db not in settings.DATABASE_REPLICAS
+
+
+class PinPrimaryMiddleware:
+    """
+    書き込みを行ったクライアントには REPLICA_STICKY_SECONDS の間プライマリから読ませる
+    （レプリカの遅延で自分の変更が見えなくなるのを防ぐ）
+    """
+    cookie_name = 'pin_primary'
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        request.pin_primary = self.cookie_name in request.COOKIES
+        response = self.get_response(request)
+        if settings.DATABASE_REPLICAS and request.method not in SAFE_METHODS and response.status_code < 400:
+            response.set_cookie(
+                self.cookie_name, str(int(time.time())), max_age=settings.REPLICA_STICKY_SECONDS,
+                httponly=True, samesite='Lax',
+            )
+        return response
+
+
+def use_replica_for(request):
+    return request.method in SAFE_METHODS and not getattr(request, 'pin_primary', False)
+
+
+class ReplicaReadMixin:
+    # カタログの読み取りをレプリカから行う（直前に書き込んだクライアントはプライマリ）
+    def dispatch(self, request, *args, **kwargs):
+        with replica_reads(use_replica_for(request)):
+            return super().dispatch(request, *args, **kwargs)
+
+
+class ReplicaChangeListMixin:
+    # 管理画面の一覧（集計・レポート）をレプリカから表示する
+    def changelist_view(self, request, extra_context=None):
+        with replica_reads(use_replica_for(request)):
+            return super().changelist_view(request, extra_context)
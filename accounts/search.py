@@ -0,0 +1,176 @@
+import threading
+import unicodedata
+from array import array
+
+from django.db import connections, router
+from django.db.models import Case, IntegerField, Q, Value, When
+
+from .cache import catalog_cacheable, get_catalog_version
+from .models import Product, ProductNgram
+
+
+def normalize(text):
+    # 全角・半角と大文字・小文字の違いを吸収する
+    return unicodedata.normalize('NFKC', text or '').lower()
+
+
+def split_terms(query):
+    return [term for term in normalize(query).split() if term]
+
+
+def ngrams(text):
+    # 日本語は単語の区切りがないため、1文字と2文字の n-gram で索引を作る
+    grams = set(text)
+    grams.update(text[i:i + 2] for i in range(len(text) - 1))
+    grams.discard(' ')
+    return grams
+
+
+class NgramIndex:
+    """
+    商品名と説明のプロセス内 n-gram 転置索引
+    各語について最も件数の少ない n-gram の候補だけを部分文字列で確認するため、全件を走査しない
+    """
+
+    def __init__(self, rows):
+        self.postings = {}
+        self.documents = {}
+        for pk, name, description, created_at in rows:
+            name, description = normalize(name), normalize(description)
+            self.documents[pk] = (name, description, created_at.timestamp())
+            for gram in ngrams(name) | ngrams(description):
+                posting = self.postings.get(gram)
+                if posting is None:
+                    posting = self.postings[gram] = array('q')
+                posting.append(pk)
+
+    def candidates(self, term):
+        if len(term) == 1:
+            return self.postings.get(term, ())
+        postings = [self.postings.get(term[i:i + 2], ()) for i in range(len(term) - 1)]
+        return min(postings, key=len)
+
+    def search(self, query):
+        terms = split_terms(query)
+        if not terms:
+            return []
+        candidates = min((self.candidates(term) for term in terms), key=len)
+        results = []
+        for pk in candidates:
+            name, description, created_at = self.documents[pk]
+            score = 0
+            for term in terms:
+                if term in name:
+                    # 商品名での一致を優先し、前方一致はさらに上位にする
+                    score += 3 if name.startswith(term) else 2
+                elif term in description:
+                    score += 1
+                else:
+                    break
+            else:
+                results.append((-score, -created_at, -pk))
+        results.sort()
+        return [-pk for _, _, pk in results]
+
+
+_index = {'version': None, 'index': None}
+_index_lock = threading.Lock()
+
+
+def build_index():
+    rows = Product.objects.active().order_by('id').values_list('id', 'name', 'description', 'created_at')
+    return NgramIndex(rows.iterator(chunk_size=5000))
+
+
+def document_ngrams(name, description):
+    return ngrams(normalize(name)) | ngrams(normalize(description))
+
+
+def index_products(rows, batch_size=5000):
+    # rows（(商品id, 商品名, 説明)）の商品の n-gram の表を作り直す
+    ProductNgram.objects.replace_for(
+        {pk: document_ngrams(name, description) for pk, name, description in rows}, batch_size
+    )
+
+
+def rebuild_ngrams(chunk_size=1000, batch_size=5000):
+    # すべての商品の n-gram の表を chunk_size 件ずつ作り直し、作成した行数を返す
+    ProductNgram.objects.all().delete()
+    chunk = []
+    for row in Product.objects.order_by('id').values_list('id', 'name', 'description').iterator(chunk_size):
+        chunk.append(row)
+        if len(chunk) >= chunk_size:
+            index_products(chunk, batch_size)
+            chunk = []
+    if chunk:
+        index_products(chunk, batch_size)
+    return ProductNgram.objects.count()
+
+
+def get_index():
+    """
+    SQLite（開発・テスト）用。説明の長い商品が多いと作り直しに時間とメモリがかかるため本番では使わない
+    カタログのバージョン（商品の保存・削除時に更新される）が変わったら索引を作り直す
+    作り直すのは1つのリクエストだけで、その間ほかのリクエストは古い索引で応答する
+    """
+    version = get_catalog_version()
+    if _index['version'] == version:
+        return _index['index']
+    if _index_lock.acquire(blocking=_index['index'] is None):
+        try:
+            if _index['version'] != version:
+                index = build_index()
+                _index.update(version=version if catalog_cacheable() else None, index=index)
+        finally:
+            _index_lock.release()
+    return _index['index']
+
+
+# pg_trgm は3文字の組で索引を引くため、これより短い語は索引で候補を絞れない（n-gram の表で引く）
+TRIGRAM_MIN_LENGTH = 3
+
+
+def _term_score(term):
+    # n-gram 索引（NgramIndex.search）と同じ規則で点数を付ける: 商品名の前方一致 3・商品名 2・説明 1
+    return Case(
+        When(name__istartswith=term, then=Value(3)),
+        When(name__icontains=term, then=Value(2)),
+        When(description__icontains=term, then=Value(1)),
+        default=Value(0),
+        output_field=IntegerField(),
+    )
+
+
+def _term_filter(term):
+    if len(term) < TRIGRAM_MIN_LENGTH:
+        # 1〜2文字の語は n-gram の表（一意制約のインデックス）から商品を引く
+        return Q(pk__in=ProductNgram.objects.filter(gram=term).values('product_id'))
+    return Q(name__icontains=term) | Q(description__icontains=term)
+
+
+def search_database(query):
+    """
+    PostgreSQL 用。3文字以上の語は pg_trgm の GIN 索引（UPPER(name) / UPPER(description)）、
+    1〜2文字の語は n-gram の表で絞り込み、n-gram 索引と同じ規則で並べる
+    """
+    terms = split_terms(query)
+    queryset = Product.objects.active()
+    score = Value(0, output_field=IntegerField())
+    for term in terms:
+        queryset = queryset.filter(_term_filter(term))
+        score = score + _term_score(term)
+    return queryset.annotate(score=score).order_by('-score', '-created_at', '-id').values_list('id', flat=True)
+
+
+def search_product_ids(query):
+    """
+    検索語に一致する商品IDを関連度順に返す
+    PostgreSQL ではDBの索引を使い、それ以外（SQLite・テスト）はプロセス内の n-gram 索引を使う
+    並び順の規則はどちらも同じ。ただしDBでは3文字以上の語の一致と点数の判定で保存された文字列を NFKC 正規化しないため、
+    全角英数字で登録された商品は半角の検索語に一致しない（n-gram 索引では一致する）
+    """
+    if not split_terms(query):
+        return []
+    if connections[router.db_for_read(Product)].vendor == 'postgresql':
+        return search_database(query)
+    return get_index().search(query)
@@ -1,5 +1,6 @@
 from rest_framework import serializers
 from django.contrib.auth import get_user_model
+from django.utils.encoding import filepath_to_uri
 from .models import Product, Category
 from .models import Cart, CartItem, ShippingInformation
 
@@ -26,6 +27,56 @@ class ProductSerializer(serializers.ModelSerializer):
 
 
 
+class ProductCardListSerializer(serializers.ListSerializer):
+    def to_representation(self, data):
+        # 画像URLの組み立てに必要な値はループの外で一度だけ求める
+        to_card = self.child.card_builder()
+        return [to_card(row) for row in data]
+
+
+class ProductCardSerializer(serializers.BaseSerializer):
+    """
+    商品一覧（カード表示）用の読み取り専用シリアライザ
+    Product.objects.cards() の行（辞書）をそのまま詰め替える
+    出力形式は ProductSerializer と同じで、カードに不要な項目を省いている
+    """
+    created_at_field = serializers.DateTimeField()
+
+    class Meta:
+        list_serializer_class = ProductCardListSerializer
+
+    def card_builder(self):
+        media_url = Product._meta.get_field('image').storage.url('')
+        request = self.context.get('request')
+        if request is not None:
+            media_url = request.build_absolute_uri(media_url)
+        created_at = self.created_at_field.to_representation
+
+        def to_card(row):
+            return {
+                'id': row['id'],
+                'category': {
+                    'id': row['category_id'],
+                    'name': row['category__name'],
+                    'slug': row['category__slug'],
+                },
+                'name': row['name'],
+                'slug': row['slug'],
+                'image': media_url + filepath_to_uri(row['image']).lstrip('/') if row['image'] else None,
+                'price': str(row['price']),
+                'in_stock': row['in_stock'],
+                'sales_discount': row['sales_discount'],
+                'recommend': row['recommend'],
+                'new_product': row['new_product'],
+                'ranking': row['ranking'],
+                'created_at': created_at(row['created_at']),
+            }
+        return to_card
+
+    def to_representation(self, instance):
+        return self.card_builder()(instance)
+
+
 class CartSerializer(serializers.ModelSerializer):
     class Meta:
         model = Cart
@@ -40,6 +91,31 @@ class CartItemSerializer(serializers.ModelSerializer):
         fields = '__all__'
 
 
+class CartProductSerializer(serializers.Serializer):
+    product_id = serializers.IntegerField(min_value=1)
+
+
+class CartUpdateSerializer(CartProductSerializer):
+    action = serializers.ChoiceField(choices=['increase', 'decrease', 'remove'])
+
+
+class CartOperationSerializer(serializers.Serializer):
+    product_id = serializers.IntegerField()
+    action = serializers.ChoiceField(choices=['increase', 'decrease', 'remove'], required=False)
+    quantity = serializers.IntegerField(min_value=0, max_value=1000, required=False)
+
+    def validate(self, attrs):
+        if ('action' in attrs) == ('quantity' in attrs):
+            raise serializers.ValidationError('action と quantity のどちらか一方を指定してください')
+        return attrs
+
+
+class CartBatchSerializer(serializers.Serializer):
+    operations = serializers.ListField(
+        child=CartOperationSerializer(), allow_empty=False, max_length=100
+    )
+
+
 class ShippingInformationSerializer(serializers.ModelSerializer):
     class Meta:
         model = ShippingInformation
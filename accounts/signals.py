@@ -0,0 +1,46 @@
+from django.db.models.signals import post_delete, post_save, pre_delete
+from django.dispatch import receiver
+
+from .cache import bump_catalog_version
+from .entitlements import invalidate_entitlements
+from .models import Cart, Category, Product, UserAccount
+from .search import index_products
+
+
+# 商品・カテゴリが更新されたらカタログのキャッシュを無効化
+@receiver([post_save, post_delete], sender=Product)
+@receiver([post_save, post_delete], sender=Category)
+def invalidate_catalog_cache(sender, **kwargs):
+    bump_catalog_version()
+
+
+# 商品名・説明の変更を検索用の n-gram の表に反映する
+@receiver(post_save, sender=Product)
+def index_product(sender, instance, update_fields=None, **kwargs):
+    if update_fields is None or {'name', 'description'} & set(update_fields):
+        index_products([(instance.pk, instance.name, instance.description)])
+
+
+# 価格の変更をカートの小計に反映する
+@receiver(post_save, sender=Product)
+def refresh_cart_summaries(sender, instance, created, **kwargs):
+    if not created:
+        Cart.objects.filter(items__product=instance).refresh_summary()
+
+
+@receiver(pre_delete, sender=Product)
+def remember_carts(sender, instance, **kwargs):
+    instance._cart_ids = list(Cart.objects.filter(items__product=instance).values_list('pk', flat=True))
+
+
+@receiver(post_delete, sender=Product)
+def refresh_carts_after_delete(sender, instance, **kwargs):
+    cart_ids = getattr(instance, '_cart_ids', None)
+    if cart_ids:
+        Cart.objects.filter(pk__in=cart_ids).refresh_summary()
+
+
+# 管理画面などで有効期限を変更した場合もサブスクの判定に反映する
+@receiver([post_save, post_delete], sender=UserAccount)
+def invalidate_user_entitlement(sender, instance, **kwargs):
+    invalidate_entitlements([instance.pk])
@@ -1,3 +1,1636 @@
-from django.test import TestCase
+import json
+import os
+import subprocess
+import sys
+import threading
+import time
+from contextlib import contextmanager
+from datetime import datetime, timedelta
+from decimal import Decimal
+from io import StringIO
+from types import SimpleNamespace
+from unittest import mock, skipUnless
 
-# Create your tests here.
+import stripe
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.core.cache import cache
+from django.core.exceptions import ImproperlyConfigured
+from django.core.management import call_command
+from django.db import IntegrityError, connection, connections
+from django.test import (
+    AsyncClient, AsyncRequestFactory, SimpleTestCase, TestCase, TransactionTestCase, override_settings,
+)
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
+from rest_framework.exceptions import AuthenticationFailed
+from rest_framework.request import Request
+from rest_framework.test import APIClient, APIRequestFactory
+from rest_framework_simplejwt.tokens import AccessToken
+
+from . import async_views, search, views
+from .authentication import ClaimsJWTAuthentication, ClaimsTokenObtainPairSerializer, ClaimsUser
+from .cache import CATALOG_UPDATED_AT_KEY, CATALOG_VERSION_KEY, bump_catalog_version, catalog_cacheable, get_category_id, get_category_ids
+from .connections import check_connections
+from .entitlements import HasActiveSubscription
+from .models import (
+    Cart, CartItem, Category, Order, OrderDetail, Product, ProductNgram, RelatedProduct, ShippingInformation,
+    ShippingState, UserAccount, WebhookEvent, WebhookStatus, WishlistItem,
+)
+from .payments import CircuitBreaker, CircuitOpenError, FakeGateway, get_gateway
+from .orders import complete_order
+from .rankings import compute_scores, update_rankings
+from .related import build_related_products, count_cooccurrences
+from .replicas import PinPrimaryMiddleware, ReplicaRouter, replica_reads
+from .serializers import ProductCardSerializer, ProductSerializer
+from .webhooks import process_pending_events, record_event
+
+
+def create_products(category, count, **kwargs):
+    offset = Product.objects.count()
+    return [
+        Product.objects.create(
+            category=category,
+            name=f'商品{offset + i}',
+            slug=f'product-{offset + i}',
+            price=Decimal('1000.00'),
+            **kwargs
+        )
+        for i in range(count)
+    ]
+
+
+@contextmanager
+def assertNumStatements(testcase, count):
+    # テストのトランザクション内で発生するSAVEPOINTを除いたクエリ数を確認する
+    with CaptureQueriesContext(connection) as ctx:
+        yield
+    statements = [q['sql'] for q in ctx.captured_queries if 'SAVEPOINT' not in q['sql']]
+    testcase.assertEqual(len(statements), count, '\n'.join(statements))
+
+
+class QueryBudgetMixin:
+    # 1ページの件数に関わらずクエリ数が一定であることを確認する
+    def assertQueryBudget(self, budget, url):
+        with CaptureQueriesContext(connection) as ctx:
+            response = self.client.get(url)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(
+            len(ctx.captured_queries), budget,
+            '\n'.join(q['sql'] for q in ctx.captured_queries)
+        )
+        return response
+
+
+
+class ClaimsAuthenticationTests(TestCase):
+    def setUp(self):
+        self.user = UserAccount.objects.create_user('taro@example.com', '太郎', 'password')
+        UserAccount.objects.filter(pk=self.user.pk).update(customer_id='cus_1')
+        response = self.client.post('/api/login/', {'email': 'taro@example.com', 'password': 'password'})
+        self.client = APIClient()
+        self.client.credentials(HTTP_AUTHORIZATION=f'Bearer {response.json()["access"]}')
+
+    def user_queries(self, queries):
+        return [q['sql'] for q in queries if 'accounts_useraccount' in q['sql']]
+
+    def test_authenticated_requests_skip_user_query(self):
+        with CaptureQueriesContext(connection) as queries:
+            self.assertEqual(self.client.get('/api/auth/cart/').status_code, 200)
+            self.assertEqual(self.client.get('/api/auth/shipping-information/').status_code, 200)
+        self.assertEqual(self.user_queries(queries.captured_queries), [])
+        self.assertTrue(ShippingInformation.objects.filter(user=self.user).exists())
+
+    def test_other_attributes_are_loaded_lazily(self):
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get('/api/auth/user/')
+        self.assertEqual(response.json()['user']['customer_id'], 'cus_1')
+        self.assertEqual(response.json()['user']['name'], '太郎')
+        self.assertEqual(len(self.user_queries(queries.captured_queries)), 1)
+
+    def test_tokens_without_claims(self):
+        client = APIClient()
+        client.credentials(HTTP_AUTHORIZATION=f'Bearer {AccessToken.for_user(self.user)}')
+        response = client.get('/api/auth/user/')
+        self.assertEqual(response.json()['user']['email'], 'taro@example.com')
+
+        user = ClaimsUser({'user_id': self.user.pk})
+        self.user.delete()
+        with self.assertRaises(AuthenticationFailed):
+            user.customer_id
+
+    def refresh(self, token):
+        return self.client.post('/api/refresh/', {'refresh': token})
+
+    def test_refresh_reissues_claims(self):
+        token = self.client.post('/api/login/', {'email': 'taro@example.com', 'password': 'password'}).json()['refresh']
+        UserAccount.objects.filter(pk=self.user.pk).update(is_staff=True, email='jiro@example.com')
+        with self.assertNumQueries(1):
+            access = AccessToken(self.refresh(token).json()['access'])
+        self.assertEqual((access['is_staff'], access['email']), (True, 'jiro@example.com'))
+
+        # 降格はそのまま反映される
+        UserAccount.objects.filter(pk=self.user.pk).update(is_staff=False)
+        self.assertFalse(AccessToken(self.refresh(token).json()['access'])['is_staff'])
+
+    def test_refresh_rejects_inactive_or_deleted_users(self):
+        token = self.client.post('/api/login/', {'email': 'taro@example.com', 'password': 'password'}).json()['refresh']
+        UserAccount.objects.filter(pk=self.user.pk).update(is_active=False)
+        response = self.refresh(token)
+        self.assertEqual(response.status_code, 401)
+        self.assertNotIn('access', response.json())
+
+        UserAccount.objects.filter(pk=self.user.pk).delete()
+        self.assertEqual(self.refresh(token).status_code, 401)
+
+class CatalogQueryBudgetTests(QueryBudgetMixin, TestCase):
+    # 検証子の集計 + COUNT(*) + 商品/カテゴリのJOIN
+    budget = 3
+
+    def setUp(self):
+        cache.clear()
+        self.category = Category.objects.create(name='食品', slug='food')
+        self.other = Category.objects.create(name='雑貨', slug='goods')
+
+    def assertPageBudget(self, url, **flags):
+        create_products(self.category, 1, **flags)
+        self.assertQueryBudget(self.budget, url)
+        create_products(self.category, 11, **flags)
+        create_products(self.other, 3, **flags)
+        response = self.assertQueryBudget(self.budget, url)
+        self.assertEqual(len(response.data['results']), 12)
+        self.assertIn('name', response.data['results'][0]['category'])
+
+    def test_product_list(self):
+        self.assertPageBudget('/api/auth/products/')
+
+    def test_category_products(self):
+        # カタログ更新後はカテゴリの対応表を1回読み込み直す
+        self.budget = 4
+        self.assertPageBudget('/api/auth/category/食品/')
+
+    def test_sales_products(self):
+        self.assertPageBudget('/api/auth/sales-products/', sales_discount=True)
+
+    def test_recommend_products(self):
+        self.assertPageBudget('/api/auth/recommend-products/', recommend=True)
+
+    def test_new_products(self):
+        self.assertPageBudget('/api/auth/new-products/', new_product=True)
+
+    def test_product_detail(self):
+        product = create_products(self.category, 1)[0]
+        response = self.assertQueryBudget(2, f'/api/auth/products/{product.pk}/')
+        self.assertEqual(response.data['category']['slug'], 'food')
+
+    def test_inactive_products_are_hidden(self):
+        active = create_products(self.category, 1, sales_discount=True)[0]
+        inactive = create_products(self.other, 1, sales_discount=True, is_active=False)[0]
+        for url in ['/api/auth/products/', '/api/auth/sales-products/', '/api/auth/category/雑貨/']:
+            with self.subTest(url):
+                ids = [p['id'] for p in self.client.get(url).json()['results']]
+                self.assertNotIn(inactive.pk, ids)
+        self.assertEqual(self.client.get('/api/auth/sales-products/').json()['results'][0]['id'], active.pk)
+        self.assertEqual(self.client.get(f'/api/auth/products/{inactive.pk}/').status_code, 404)
+
+
+class CacheSettingsTests(SimpleTestCase):
+    def import_settings(self, **env):
+        return subprocess.run(
+            [sys.executable, '-c', 'import mysite.settings'], cwd=settings.BASE_DIR,
+            env={**os.environ, 'DJANGO_DEBUG': 'False', **env}, capture_output=True, text=True,
+        )
+
+    def test_production_requires_shared_cache(self):
+        # プロセス内のキャッシュではカタログの更新がほかのワーカーに伝わらない
+        result = self.import_settings(CACHE_BACKEND='')
+        self.assertNotEqual(result.returncode, 0)
+        self.assertIn('CACHE_BACKEND', result.stderr)
+        result = self.import_settings(CACHE_BACKEND='django.core.cache.backends.db.DatabaseCache')
+        self.assertEqual(result.returncode, 0, result.stderr)
+
+
+class CatalogCacheTests(QueryBudgetMixin, TestCase):
+    def setUp(self):
+        cache.clear()
+        self.category = Category.objects.create(name='食品', slug='food')
+        self.product = create_products(self.category, 1, sales_discount=True)[0]
+
+    def test_cached_page_skips_database(self):
+        first = self.assertQueryBudget(3, '/api/auth/sales-products/')
+        second = self.assertQueryBudget(0, '/api/auth/sales-products/')
+        self.assertEqual(first.content, second.content)
+        self.assertEqual(second['Content-Type'], 'application/json')
+
+    def test_pages_are_cached_separately(self):
+        create_products(self.category, 12)
+        self.client.get('/api/auth/products/')
+        response = self.assertQueryBudget(3, '/api/auth/products/?page=2')
+        self.assertEqual(len(response.json()['results']), 1)
+
+    def test_product_save_invalidates(self):
+        self.client.get('/api/auth/sales-products/')
+        self.product.name = '値下げ商品'
+        self.product.save()
+        response = self.assertQueryBudget(3, '/api/auth/sales-products/')
+        self.assertEqual(response.json()['results'][0]['name'], '値下げ商品')
+
+    def test_product_delete_invalidates(self):
+        self.client.get('/api/auth/sales-products/')
+        self.product.delete()
+        # 0件の場合は商品一覧を取得しない
+        response = self.assertQueryBudget(2, '/api/auth/sales-products/')
+        self.assertEqual(response.json()['count'], 0)
+
+    def test_category_save_invalidates(self):
+        self.client.get('/api/auth/categories/')
+        self.client.get('/api/auth/products/')
+        self.category.name = '生鮮食品'
+        self.category.save()
+        categories = self.client.get('/api/auth/categories/').json()
+        products = self.client.get('/api/auth/products/').json()
+        self.assertEqual(categories['results'][0]['name'], '生鮮食品')
+        self.assertEqual(products['results'][0]['category']['name'], '生鮮食品')
+
+    def test_missing_version_is_reinitialised(self):
+        self.client.get('/api/auth/sales-products/')
+        cache.delete(CATALOG_VERSION_KEY)
+        self.assertQueryBudget(3, '/api/auth/sales-products/')
+
+
+class ConditionalGetTests(QueryBudgetMixin, TestCase):
+    def setUp(self):
+        cache.clear()
+        self.category = Category.objects.create(name='食品', slug='food')
+        self.product = create_products(self.category, 1, recommend=True)[0]
+
+    def test_list_not_modified(self):
+        response = self.client.get('/api/auth/recommend-products/')
+        self.assertIn('ETag', response)
+        self.assertIn('Last-Modified', response)
+        with self.assertNumQueries(0):
+            not_modified = self.client.get(
+                '/api/auth/recommend-products/', HTTP_IF_NONE_MATCH=response['ETag']
+            )
+        self.assertEqual(not_modified.status_code, 304)
+        self.assertEqual(not_modified['ETag'], response['ETag'])
+        self.assertEqual(not_modified.content, b'')
+
+    def test_list_if_modified_since(self):
+        response = self.client.get('/api/auth/recommend-products/')
+        not_modified = self.client.get(
+            '/api/auth/recommend-products/', HTTP_IF_MODIFIED_SINCE=response['Last-Modified']
+        )
+        self.assertEqual(not_modified.status_code, 304)
+
+    def test_list_last_modified_advances_when_products_leave(self):
+        # 一覧から外れた商品は max(updated_at) に現れないが、If-Modified-Since だけのクライアントにも新しい一覧を返す
+        hour_ago = timezone.now() - timedelta(hours=1)
+        other = create_products(self.category, 1, recommend=True)[0]
+        Product.objects.update(updated_at=hour_ago)
+
+        def assertModifiedBy(change):
+            cache.clear()
+            cache.set(CATALOG_UPDATED_AT_KEY, hour_ago.timestamp())
+            last_modified = self.client.get('/api/auth/recommend-products/')['Last-Modified']
+            change()
+            response = self.client.get('/api/auth/recommend-products/', HTTP_IF_MODIFIED_SINCE=last_modified)
+            self.assertEqual(response.status_code, 200)
+
+        self.product.is_active = False
+        assertModifiedBy(self.product.save)
+        assertModifiedBy(other.delete)
+
+    def test_list_etag_changes_on_update(self):
+        etag = self.client.get('/api/auth/recommend-products/')['ETag']
+        self.product.price = Decimal('800.00')
+        self.product.save()
+        response = self.client.get('/api/auth/recommend-products/', HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertNotEqual(response['ETag'], etag)
+
+    def test_list_etag_differs_per_page(self):
+        create_products(self.category, 12)
+        first = self.client.get('/api/auth/products/')
+        second = self.client.get('/api/auth/products/?page=2', HTTP_IF_NONE_MATCH=first['ETag'])
+        self.assertEqual(second.status_code, 200)
+
+    def test_category_list_etag_without_queries(self):
+        etag = self.client.get('/api/auth/categories/')['ETag']
+        with self.assertNumQueries(0):
+            response = self.client.get('/api/auth/categories/', HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 304)
+
+    def test_detail_not_modified(self):
+        url = f'/api/auth/products/{self.product.pk}/'
+        etag = self.client.get(url)['ETag']
+        with self.assertNumQueries(1):
+            response = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 304)
+
+    def test_detail_etag_changes_on_category_rename(self):
+        url = f'/api/auth/products/{self.product.pk}/'
+        etag = self.client.get(url)['ETag']
+        self.category.name = '生鮮食品'
+        self.category.save()
+        response = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.data['category']['name'], '生鮮食品')
+
+    def test_detail_not_found(self):
+        response = self.client.get('/api/auth/products/999/')
+        self.assertEqual(response.status_code, 404)
+
+
+class KeysetPaginationTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.category = Category.objects.create(name='食品', slug='food')
+        create_products(self.category, 30, new_product=True)
+        # 作成日時が同じ商品もidで順序が決まること
+        Product.objects.filter(pk__in=Product.objects.order_by('pk').values('pk')[10:20]).update(
+            created_at=Product.objects.order_by('pk')[10].created_at
+        )
+        self.expected = list(Product.objects.order_by('-created_at', '-id').values_list('pk', flat=True))
+
+    def walk(self, url, budget=2):
+        seen = []
+        while url:
+            with CaptureQueriesContext(connection) as ctx:
+                data = self.client.get(url).json()
+            # 検証子の集計 + 一覧取得のみ（OFFSETや一覧用のCOUNT(*)を実行しない）
+            self.assertEqual(len(ctx.captured_queries), budget)
+            self.assertNotIn('OFFSET', ctx.captured_queries[-1]['sql'])
+            # 検証子もそのページの行だけで求める（全件の COUNT(*) を実行しない）
+            self.assertIn('LIMIT', ctx.captured_queries[0]['sql'])
+            self.assertNotIn('count', data)
+            seen.extend(item['id'] for item in data['results'])
+            url = data['next']
+        return seen
+
+    def test_walks_all_products_in_order(self):
+        self.assertEqual(self.walk('/api/auth/products/?cursor='), self.expected)
+
+    def test_flag_filtered_list(self):
+        self.assertEqual(self.walk('/api/auth/new-products/?cursor='), self.expected)
+
+    def test_category_list(self):
+        get_category_id(name='食品')
+        self.assertEqual(self.walk('/api/auth/category/食品/?cursor='), self.expected)
+        self.assertEqual(self.walk('/api/auth/categories/food/products/?cursor='), self.expected)
+
+    def test_page_numbers_still_supported(self):
+        data = self.client.get('/api/auth/products/?page=2').json()
+        self.assertEqual(data['count'], 30)
+        self.assertEqual([item['id'] for item in data['results']], self.expected[12:24])
+
+    def test_invalid_cursor(self):
+        response = self.client.get('/api/auth/products/?cursor=invalid')
+        self.assertEqual(response.status_code, 404)
+
+    def test_conditional_get_on_cursor_page(self):
+        url = '/api/auth/products/?cursor='
+        etag = self.client.get(url)['ETag']
+        self.assertEqual(self.client.get(url, HTTP_IF_NONE_MATCH=etag).status_code, 304)
+
+        product = Product.objects.get(pk=self.expected[0])
+        product.price = Decimal('1500.00')
+        product.save()
+        response = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertNotEqual(response['ETag'], etag)
+
+
+
+class AsyncCatalogViewTests(TransactionTestCase):
+    def setUp(self):
+        cache.clear()
+        self.category = Category.objects.create(name='食品', slug='food')
+        self.products = create_products(self.category, 3, recommend=True)
+
+    def sync_get(self, view, path):
+        # キャッシュを使わずに同期ビューの結果を取得する
+        cache.clear()
+        return view.as_view()(APIRequestFactory().get(path)).render()
+
+    async def async_get(self, view, path):
+        return await view.as_view()(AsyncRequestFactory().get(path))
+
+    async def test_matches_sync_views(self):
+        for name, path in [
+            ('ProductList', '/api/auth/products/?page=1'),
+            ('CategoryList', '/api/auth/categories/'),
+            ('RecommendProducts', '/api/auth/recommend-products/'),
+        ]:
+            with self.subTest(name):
+                response = await self.async_get(getattr(async_views, name), path)
+                self.assertEqual(response.status_code, 200)
+                expected = await sync_to_async(self.sync_get)(getattr(views, name), path)
+                self.assertEqual(json.loads(response.content), json.loads(expected.content))
+
+    async def test_detail_and_conditional_get(self):
+        view = async_views.ProductDetail.as_view()
+        path = f'/api/auth/products/{self.products[0].pk}/'
+        response = await view(AsyncRequestFactory().get(path), pk=self.products[0].pk)
+        self.assertEqual(response.status_code, 200)
+        response = await view(
+            AsyncRequestFactory().get(path, **{'if-none-match': response['ETag']}), pk=self.products[0].pk
+        )
+        self.assertEqual(response.status_code, 304)
+        response = await view(AsyncRequestFactory().get('/api/auth/products/0/'), pk=0)
+        self.assertEqual(response.status_code, 404)
+
+class CategorySlugRouteTests(QueryBudgetMixin, TestCase):
+    def setUp(self):
+        cache.clear()
+        self.category = Category.objects.create(name='食品', slug='food')
+        self.other = Category.objects.create(name='雑貨', slug='goods')
+        create_products(self.category, 2)
+        create_products(self.other, 1)
+
+    def test_products_by_slug(self):
+        get_category_id(slug='food')
+        response = self.assertQueryBudget(3, '/api/auth/categories/food/products/')
+        self.assertEqual(response.json()['count'], 2)
+
+    def test_name_route_is_kept(self):
+        by_name = self.client.get('/api/auth/category/雑貨/').json()
+        by_slug = self.client.get('/api/auth/categories/goods/products/').json()
+        self.assertEqual(by_name['results'], by_slug['results'])
+
+    def test_unknown_category(self):
+        self.assertEqual(self.client.get('/api/auth/categories/unknown/products/').status_code, 404)
+        self.assertEqual(self.client.get('/api/auth/category/unknown/').status_code, 404)
+
+    def test_map_reloads_after_category_save(self):
+        self.assertEqual(get_category_id(slug='food'), self.category.pk)
+        with self.assertNumQueries(0):
+            get_category_id(slug='food')
+        self.category.slug = 'fresh-food'
+        self.category.save()
+        self.assertIsNone(get_category_id(slug='food'))
+        self.assertEqual(get_category_id(slug='fresh-food'), self.category.pk)
+        response = self.client.get('/api/auth/categories/fresh-food/products/')
+        self.assertEqual(response.json()['count'], 2)
+
+
+class ProductCardSerializerTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.category = Category.objects.create(name='食品', slug='food')
+        create_products(self.category, 3, recommend=True)
+        Product.objects.filter(pk=Product.objects.order_by('pk')[0].pk).update(image='photos/products/商品 1.png')
+        self.request = Request(APIRequestFactory().get('/'))
+
+    def test_matches_product_serializer(self):
+        full = ProductSerializer(Product.objects.catalog(), many=True, context={'request': self.request}).data
+        cards = ProductCardSerializer(Product.objects.cards(), many=True, context={'request': self.request}).data
+        self.assertEqual(len(cards), 3)
+        for card, product in zip(cards, full):
+            for key, value in card.items():
+                self.assertEqual(value, product[key], key)
+        self.assertNotIn('description', cards[0])
+
+    def test_single_row(self):
+        row = Product.objects.cards().first()
+        card = ProductCardSerializer(row).data
+        self.assertEqual(card['image'], '/media/' + row['image'])
+
+    def test_list_endpoint_uses_cards(self):
+        results = self.client.get('/api/auth/recommend-products/').json()['results']
+        self.assertEqual(results[0]['image'], 'http://testserver/media/photos/default.jpg')
+        self.assertNotIn('description', results[0])
+        detail = self.client.get(f'/api/auth/products/{results[0]["id"]}/').json()
+        self.assertIn('description', detail)
+
+
+class CartMutationTests(TestCase):
+    def setUp(self):
+        self.user = UserAccount.objects.create_user('taro@example.com', '太郎', 'password')
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+        self.category = Category.objects.create(name='食品', slug='food')
+        self.product = create_products(self.category, 1)[0]
+
+    def quantity(self):
+        return CartItem.objects.get(cart__user=self.user, product=self.product).quantity
+
+    def test_add_creates_then_increments(self):
+        response = self.client.post('/api/auth/add_to_cart/', {'product_id': self.product.pk})
+        self.assertEqual(response.status_code, 201)
+        self.assertEqual(self.quantity(), 1)
+        # カートの取得 + 数量の加算 + カートの集計値の更新
+        with assertNumStatements(self, 3):
+            self.client.post('/api/auth/add_to_cart/', {'product_id': self.product.pk})
+        self.assertEqual(self.quantity(), 2)
+
+    def test_add_unknown_product(self):
+        response = self.client.post('/api/auth/add_to_cart/', {'product_id': 999})
+        self.assertEqual(response.status_code, 404)
+        self.assertFalse(CartItem.objects.exists())
+
+    def test_invalid_product_id(self):
+        for data in [{'product_id': 'abc'}, {'product_id': 0}, {}]:
+            with self.subTest(data):
+                self.assertEqual(self.client.post('/api/auth/add_to_cart/', data).status_code, 400)
+                response = self.client.post('/api/auth/cart/update/', {'action': 'increase', **data})
+                self.assertEqual(response.status_code, 400)
+        response = self.client.post('/api/auth/cart/update/', {'product_id': self.product.pk, 'action': 'double'})
+        self.assertEqual(response.status_code, 400)
+        self.assertFalse(CartItem.objects.exists())
+
+    def test_add_inactive_product(self):
+        inactive = create_products(self.category, 1, is_active=False)[0]
+        response = self.client.post('/api/auth/add_to_cart/', {'product_id': inactive.pk})
+        self.assertEqual(response.status_code, 404)
+        self.assertFalse(CartItem.objects.exists())
+        self.assertEqual(Cart.objects.get(user=self.user).subtotal, Decimal('0.00'))
+
+    def test_update_cart(self):
+        url = '/api/auth/cart/update/'
+        self.client.post(url, {'product_id': self.product.pk, 'action': 'increase'})
+        with assertNumStatements(self, 3):
+            self.client.post(url, {'product_id': self.product.pk, 'action': 'increase'})
+        self.assertEqual(self.quantity(), 2)
+        self.client.post(url, {'product_id': self.product.pk, 'action': 'decrease'})
+        self.client.post(url, {'product_id': self.product.pk, 'action': 'decrease'})
+        self.assertEqual(self.quantity(), 1)
+        response = self.client.post(url, {'product_id': self.product.pk, 'action': 'remove'})
+        self.assertEqual(response.data['message'], 'Item removed from cart')
+        self.assertFalse(CartItem.objects.exists())
+
+    def test_unique_cart_product(self):
+        cart = Cart.objects.create(user=self.user)
+        CartItem.objects.create(cart=cart, product=self.product)
+        with self.assertRaises(IntegrityError):
+            CartItem.objects.create(cart=cart, product=self.product)
+
+
+class ConcurrentCartTests(TransactionTestCase):
+    threads = 8
+    adds_per_thread = 5
+
+    def setUp(self):
+        self.user = UserAccount.objects.create_user('taro@example.com', '太郎', 'password')
+        self.category = Category.objects.create(name='食品', slug='food')
+        self.product = create_products(self.category, 1)[0]
+        self.cart = Cart.objects.create(user=self.user)
+
+    def post_retrying_locks(self, client, url, data, attempts=100):
+        """
+        SQLite（共有キャッシュのインメモリDB）では同時の書き込みが待たずにロックエラー（500）になるため、
+        ロールバックされたリクエストだけをやり直す（更新が失われるかどうかの確認には影響しない）
+        テストクライアントは他のスレッドの例外も受け取ってしまうため、例外ではなくステータスで判定する
+        """
+        for _ in range(attempts):
+            response = client.post(url, data)
+            if response.status_code != 500:
+                return response
+            time.sleep(0.001)
+        raise AssertionError(f'{url} failed {attempts} times')
+
+    def test_parallel_adds_are_not_lost(self):
+        barrier = threading.Barrier(self.threads)
+        errors = []
+
+        def add():
+            client = APIClient(raise_request_exception=False)
+            client.force_authenticate(self.user)
+            try:
+                barrier.wait()
+                for _ in range(self.adds_per_thread):
+                    self.post_retrying_locks(client, '/api/auth/add_to_cart/', {'product_id': self.product.pk})
+            except Exception as e:
+                errors.append(e)
+            finally:
+                connection.close()
+
+        workers = [threading.Thread(target=add) for _ in range(self.threads)]
+        with mock.patch('django.core.handlers.exception.log_response'):  # やり直すロックエラーのログを出さない
+            for worker in workers:
+                worker.start()
+            for worker in workers:
+                worker.join()
+
+        self.assertEqual(errors, [])
+        item = CartItem.objects.get(cart=self.cart, product=self.product)
+        self.assertEqual(item.quantity, self.threads * self.adds_per_thread)
+        self.cart.refresh_from_db()
+        self.assertEqual(self.cart.item_count, self.threads * self.adds_per_thread)
+
+
+class CartBatchTests(TestCase):
+    url = '/api/auth/cart/batch/'
+
+    def setUp(self):
+        self.user = UserAccount.objects.create_user('taro@example.com', '太郎', 'password')
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+        self.category = Category.objects.create(name='食品', slug='food')
+        self.products = create_products(self.category, 4)
+        self.cart = Cart.objects.create(user=self.user)
+        CartItem.objects.create(cart=self.cart, product=self.products[0], quantity=3)
+        CartItem.objects.create(cart=self.cart, product=self.products[1], quantity=1)
+
+    def quantities(self):
+        return dict(CartItem.objects.filter(cart=self.cart).values_list('product_id', 'quantity'))
+
+    def test_applies_operations_in_order(self):
+        p0, p1, p2, p3 = (p.pk for p in self.products)
+        response = self.client.post(self.url, {'operations': [
+            {'product_id': p0, 'action': 'decrease'},
+            {'product_id': p1, 'action': 'remove'},
+            {'product_id': p2, 'action': 'increase'},
+            {'product_id': p2, 'action': 'increase'},
+            {'product_id': p3, 'quantity': 5},
+            {'product_id': p3, 'action': 'decrease'},
+        ]}, format='json')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(self.quantities(), {p0: 2, p2: 2, p3: 4})
+        self.assertEqual(
+            {item['product']['id']: item['quantity'] for item in response.data['items']},
+            {p0: 2, p2: 2, p3: 4}
+        )
+
+    def test_quantity_zero_removes(self):
+        p0 = self.products[0].pk
+        self.client.post(self.url, {'operations': [{'product_id': p0, 'quantity': 0}]}, format='json')
+        self.assertNotIn(p0, self.quantities())
+
+    def test_unknown_product_applies_nothing(self):
+        response = self.client.post(self.url, {'operations': [
+            {'product_id': self.products[0].pk, 'action': 'remove'},
+            {'product_id': 999, 'action': 'increase'},
+        ]}, format='json')
+        self.assertEqual(response.status_code, 404)
+        self.assertEqual(self.quantities(), {self.products[0].pk: 3, self.products[1].pk: 1})
+
+    def test_inactive_product_applies_nothing(self):
+        inactive = create_products(self.category, 1, is_active=False)[0]
+        response = self.client.post(self.url, {'operations': [{'product_id': inactive.pk, 'quantity': 2}]}, format='json')
+        self.assertEqual(response.status_code, 404)
+        self.assertNotIn(inactive.pk, self.quantities())
+
+    def test_invalid_operations(self):
+        for operations in ([], [{'product_id': 1}], [{'product_id': 1, 'action': 'increase', 'quantity': 2}],
+                           [{'product_id': 1, 'action': 'double'}]):
+            response = self.client.post(self.url, {'operations': operations}, format='json')
+            self.assertEqual(response.status_code, 400, operations)
+
+
+class GetCartTests(TestCase):
+    def setUp(self):
+        self.user = UserAccount.objects.create_user('taro@example.com', '太郎', 'password')
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+        self.category = Category.objects.create(name='食品', slug='food')
+        self.cart = Cart.objects.create(user=self.user)
+
+    def add(self, count):
+        for i, product in enumerate(create_products(self.category, count)):
+            CartItem.objects.create(cart=self.cart, product=product, quantity=i + 1)
+
+    def test_constant_queries(self):
+        self.add(1)
+        # カートの取得 + 明細 + 集計
+        with self.assertNumQueries(3):
+            self.client.get('/api/auth/cart/')
+        self.add(10)
+        with self.assertNumQueries(3):
+            response = self.client.get('/api/auth/cart/')
+        self.assertEqual(len(response.data['items']), 11)
+
+    def test_totals(self):
+        self.add(3)
+        data = self.client.get('/api/auth/cart/').data
+        self.assertEqual(data['item_count'], 1 + 2 + 3)
+        self.assertEqual(data['subtotal'], Decimal('6000.00'))
+        self.assertEqual([item['total_price'] for item in data['items']],
+                         [Decimal('1000.00'), Decimal('2000.00'), Decimal('3000.00')])
+        self.assertEqual(data['items'][0]['image_url'], '/media/photos/default.jpg')
+
+    def test_empty_cart(self):
+        data = self.client.get('/api/auth/cart/').data
+        self.assertEqual(data, {'items': [], 'subtotal': Decimal('0.00'), 'item_count': 0})
+
+
+class CartSummaryTests(TestCase):
+    def setUp(self):
+        self.user = UserAccount.objects.create_user('taro@example.com', '太郎', 'password')
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+        self.category = Category.objects.create(name='食品', slug='food')
+        self.products = create_products(self.category, 2)
+
+    def summary(self):
+        with self.assertNumQueries(1):
+            return self.client.get('/api/auth/cart/summary/').data
+
+    def assertSummary(self, item_count, subtotal):
+        self.assertEqual(self.summary(), {'item_count': item_count, 'subtotal': Decimal(subtotal)})
+        self.assertFalse(Cart.objects.drifted().exists())
+
+    def test_maintained_by_cart_endpoints(self):
+        p0, p1 = (p.pk for p in self.products)
+        self.assertSummary(0, '0.00')
+        self.client.post('/api/auth/add_to_cart/', {'product_id': p0})
+        self.client.post('/api/auth/add_to_cart/', {'product_id': p0})
+        self.client.post('/api/auth/cart/update/', {'product_id': p1, 'action': 'increase'})
+        self.assertSummary(3, '3000.00')
+        self.client.post('/api/auth/cart/update/', {'product_id': p0, 'action': 'decrease'})
+        self.client.post('/api/auth/cart/update/', {'product_id': p1, 'action': 'decrease'})
+        self.assertSummary(2, '2000.00')
+        self.client.post('/api/auth/cart/update/', {'product_id': p1, 'action': 'remove'})
+        self.assertSummary(1, '1000.00')
+        self.client.post('/api/auth/cart/batch/', {'operations': [
+            {'product_id': p0, 'quantity': 4}, {'product_id': p1, 'action': 'increase'},
+        ]}, format='json')
+        self.assertSummary(5, '5000.00')
+        self.client.post('/api/auth/cart/remove-all/')
+        self.assertSummary(0, '0.00')
+
+    def test_price_change_is_reflected(self):
+        self.client.post('/api/auth/add_to_cart/', {'product_id': self.products[0].pk})
+        self.products[0].price = Decimal('1500.00')
+        self.products[0].save()
+        self.assertSummary(1, '1500.00')
+        self.products[0].delete()
+        self.assertSummary(0, '0.00')
+
+    def test_bulk_price_change_is_reflected(self):
+        self.client.post('/api/auth/cart/batch/', {'operations': [
+            {'product_id': self.products[0].pk, 'quantity': 2}, {'product_id': self.products[1].pk, 'quantity': 1},
+        ]}, format='json')
+        Product.objects.filter(price__gte=1000, pk=self.products[0].pk).update(price=Decimal('5.00'))
+        self.assertSummary(3, '1010.00')
+        self.products[1].price = Decimal('20.00')
+        Product.objects.bulk_update([self.products[1]], ['price'])
+        self.assertSummary(3, '30.00')
+
+    def test_reconcile_command(self):
+        cart = Cart.objects.create(user=self.user)
+        CartItem.objects.create(cart=cart, product=self.products[0], quantity=2)
+        CartItem.objects.create(cart=cart, product=self.products[1], quantity=1)
+        Cart.objects.create(user=UserAccount.objects.create_user('hanako@example.com', '花子', 'password'))
+        self.assertEqual(list(Cart.objects.drifted()), [cart])
+
+        out = StringIO()
+        call_command('reconcile_cart_summaries', stdout=out)
+        self.assertIn('1件のカートを修正しました', out.getvalue())
+        self.assertSummary(3, '3000.00')
+
+
+class WishlistTests(TestCase):
+    def setUp(self):
+        self.user = UserAccount.objects.create_user('taro@example.com', '太郎', 'password')
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+        self.category = Category.objects.create(name='食品', slug='food')
+        self.products = create_products(self.category, 3)
+
+    def test_add_is_idempotent(self):
+        url = f'/api/auth/wishlist/add/{self.products[0].pk}/'
+        # 商品の存在確認 + INSERT（衝突は無視）
+        with self.assertNumQueries(2):
+            response = self.client.post(url)
+        self.assertEqual(response.data['status'], 'success')
+        self.client.post(url)
+        self.assertEqual(WishlistItem.objects.filter(user=self.user).count(), 1)
+
+    def test_add_unknown_product(self):
+        response = self.client.post('/api/auth/wishlist/add/999/')
+        self.assertEqual(response.status_code, 404)
+        self.assertFalse(WishlistItem.objects.exists())
+
+    def test_add_inactive_product(self):
+        inactive = create_products(self.category, 1, is_active=False)[0]
+        response = self.client.post(f'/api/auth/wishlist/add/{inactive.pk}/')
+        self.assertEqual(response.status_code, 404)
+        self.assertFalse(WishlistItem.objects.exists())
+
+    def test_list_and_remove(self):
+        for product in self.products[:2]:
+            self.client.post(f'/api/auth/wishlist/add/{product.pk}/')
+        with self.assertNumQueries(1):
+            response = self.client.get('/api/auth/wishlist/')
+        self.assertEqual(response.data, [{'product_id': p.pk} for p in self.products[:2]])
+
+        with self.assertNumQueries(1):
+            response = self.client.post(f'/api/auth/wishlist/remove/{self.products[0].pk}/')
+        self.assertEqual(response.data['status'], 'success')
+        response = self.client.post(f'/api/auth/wishlist/remove/{self.products[0].pk}/')
+        self.assertEqual(response.status_code, 404)
+
+    def test_contains(self):
+        self.client.post(f'/api/auth/wishlist/add/{self.products[1].pk}/')
+        other = UserAccount.objects.create_user('hanako@example.com', '花子', 'password')
+        WishlistItem.objects.create(user=other, product=self.products[2])
+        ids = ','.join(str(p.pk) for p in self.products)
+        with self.assertNumQueries(1):
+            response = self.client.get(f'/api/auth/wishlist/contains/?ids={ids}')
+        self.assertEqual(response.data, {'product_ids': [self.products[1].pk]})
+
+    def test_contains_validation(self):
+        self.assertEqual(self.client.get('/api/auth/wishlist/contains/?ids=1,a').status_code, 400)
+        ids = ','.join(str(i) for i in range(101))
+        self.assertEqual(self.client.get(f'/api/auth/wishlist/contains/?ids={ids}').status_code, 400)
+        with self.assertNumQueries(0):
+            self.assertEqual(self.client.get('/api/auth/wishlist/contains/').data, {'product_ids': []})
+
+
+class PlaceOrderTests(TestCase):
+    url = '/api/auth/create-checkout-session/'
+
+    def setUp(self):
+        self.user = UserAccount.objects.create_user('taro@example.com', '太郎', 'password')
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+        self.category = Category.objects.create(name='食品', slug='food')
+        self.products = create_products(self.category, 3)
+        ShippingInformation.objects.create(
+            user=self.user, address='千代田1-1', city='千代田区', state='東京都', postal_code='1000001', country='JP'
+        )
+        self.cart = Cart.objects.create(user=self.user)
+
+    def fill_cart(self, products):
+        for i, product in enumerate(products):
+            CartItem.objects.add(self.cart.id, product.pk, i + 1)
+
+    def checkout(self, **kwargs):
+        with mock.patch('stripe.checkout.Session.create', **kwargs) as create:
+            response = self.client.post(self.url, {'totalPrice': 1}, format='json')
+        return response, create
+
+    def test_places_order_from_cart(self):
+        self.fill_cart(self.products[:2])
+        response, create = self.checkout(return_value=SimpleNamespace(id='cs_test_1'))
+        self.assertEqual(response.status_code, 201)
+        self.assertEqual(response.data['id'], 'cs_test_1')
+
+        order = Order.objects.get(pk=response.data['order_id'])
+        self.assertEqual(order.total_price, Decimal('3000.00'))
+        self.assertEqual(order.stripe_session_id, 'cs_test_1')
+        self.assertEqual(
+            list(order.orderdetail_set.order_by('id').values_list('product_id', 'quantity', 'price')),
+            [(self.products[0].pk, 1, Decimal('1000.00')), (self.products[1].pk, 2, Decimal('1000.00'))]
+        )
+        # クライアントから送られた金額ではなくカートの内容で明細を作成する
+        line_items = create.call_args.kwargs['line_items']
+        self.assertEqual([(li['price_data']['unit_amount'], li['quantity']) for li in line_items],
+                         [(100000, 1), (100000, 2)])
+        self.assertEqual(create.call_args.kwargs['idempotency_key'], f'order-{order.pk}')
+        # 支払いが完了するまでは支払い待ちで、カートも残す
+        self.assertEqual(order.status, 'Pending')
+        self.assertEqual(CartItem.objects.count(), 2)
+
+    def test_stripe_is_called_outside_transaction(self):
+        self.fill_cart(self.products[:1])
+        depth = len(connection.savepoint_ids)
+
+        def create(**params):
+            # 決済APIの応答を待つ間、カートのロックやトランザクションを保持しない
+            self.assertEqual(len(connection.savepoint_ids), depth)
+            self.assertTrue(Order.objects.filter(status='Pending').exists())
+            return SimpleNamespace(id='cs_test_1')
+
+        response, _ = self.checkout(side_effect=create)
+        self.assertEqual(response.status_code, 201)
+
+    def test_complete_order(self):
+        self.fill_cart(self.products[:2])
+        response, _ = self.checkout(return_value=SimpleNamespace(id='cs_test_1'))
+        order_id = response.data['order_id']
+        # 注文後にカートに追加した商品は残す
+        CartItem.objects.add(self.cart.id, self.products[2].pk)
+
+        self.assertTrue(complete_order(order_id))
+        self.assertFalse(complete_order(order_id))
+        self.assertEqual(Order.objects.get(pk=order_id).status, 'Processing')
+        self.assertEqual(list(CartItem.objects.values_list('product_id', flat=True)), [self.products[2].pk])
+        self.cart.refresh_from_db()
+        self.assertEqual((self.cart.item_count, self.cart.subtotal), (1, Decimal('1000.00')))
+
+    def test_payment_webhook_completes_order(self):
+        self.fill_cart(self.products[:1])
+        response, _ = self.checkout(return_value=SimpleNamespace(id='cs_test_1'))
+        stripe_client = FakeStripe(APIClient())
+        session = {'mode': 'payment', 'client_reference_id': str(response.data['order_id'])}
+        with override_settings(STRIPE_WEBHOOK_SECRET=FakeStripe.secret):
+            stripe_client.send(stripe_client.event(
+                'checkout.session.completed', {**session, 'payment_status': 'unpaid'}
+            ))
+            process_pending_events()
+            self.assertEqual(Order.objects.get().status, 'Pending')
+
+            stripe_client.send(stripe_client.event(
+                'checkout.session.async_payment_succeeded', {**session, 'payment_status': 'paid'}
+            ))
+            process_pending_events()
+        self.assertEqual(Order.objects.get().status, 'Processing')
+        self.assertFalse(CartItem.objects.exists())
+
+    def test_constant_queries(self):
+        self.fill_cart(self.products[:1])
+        with CaptureQueriesContext(connection) as small:
+            self.checkout(return_value=SimpleNamespace(id='cs_test_1'))
+        self.fill_cart(self.products)
+        with CaptureQueriesContext(connection) as large:
+            self.checkout(return_value=SimpleNamespace(id='cs_test_2'))
+        self.assertEqual(len(small.captured_queries), len(large.captured_queries))
+
+    def test_stripe_failure_keeps_cart(self):
+        self.fill_cart(self.products[:2])
+        response, _ = self.checkout(side_effect=stripe.error.APIConnectionError('unavailable'))
+        self.assertEqual(response.status_code, 400)
+        self.assertFalse(Order.objects.exists())
+        self.assertEqual(CartItem.objects.count(), 2)
+        self.cart.refresh_from_db()
+        self.assertEqual(self.cart.item_count, 3)
+
+    def test_rejects_invalid_carts(self):
+        response, create = self.checkout()
+        self.assertEqual(response.data, {'error': 'カートが空です'})
+
+        Product.objects.filter(pk=self.products[0].pk).update(in_stock=False)
+        self.fill_cart(self.products[:1])
+        response, create = self.checkout()
+        self.assertEqual(response.status_code, 400)
+        self.assertIn('在庫切れ', response.data['error'])
+
+        Product.objects.filter(pk=self.products[0].pk).update(in_stock=True)
+        ShippingInformation.objects.all().delete()
+        response, create = self.checkout()
+        self.assertEqual(response.data, {'error': '配送先が登録されていません'})
+        create.assert_not_called()
+        self.assertFalse(Order.objects.exists())
+
+
+
+
+
+@override_settings(DATABASE_REPLICAS=['replica0'])
+class ReplicaRoutingTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.category = Category.objects.create(name='食品', slug='food')
+        self.products = create_products(self.category, 2)
+        self.user = UserAccount.objects.create_user('taro@example.com', '太郎', 'password')
+
+    def test_router(self):
+        router = ReplicaRouter()
+        self.assertEqual(router.db_for_read(Product), 'default')
+        with replica_reads():
+            self.assertEqual(router.db_for_read(Product), 'replica0')
+            with replica_reads(False):
+                self.assertEqual(router.db_for_read(Product), 'default')
+        product = Product(pk=1)
+        product._state.db = 'replica0'
+        self.assertEqual(router.db_for_write(Product, instance=product), 'default')
+        self.assertFalse(router.allow_migrate('replica0', 'accounts'))
+        self.assertTrue(router.allow_migrate('default', 'accounts'))
+
+    def test_catalog_reads_from_replica_until_client_writes(self):
+        # レプリカのエイリアスは設定されていないため、選ばれたかどうかだけを確認する
+        with mock.patch('accounts.replicas.random.choice', return_value='default') as choice:
+            self.assertEqual(self.client.get('/api/auth/products/').status_code, 200)
+            self.assertTrue(choice.called)
+
+            choice.reset_mock()
+            client = APIClient()
+            client.force_authenticate(self.user)
+            response = client.post('/api/auth/add_to_cart/', {'product_id': self.products[0].pk}, format='json')
+            self.assertIn(PinPrimaryMiddleware.cookie_name, response.cookies)
+            self.assertEqual(client.get('/api/auth/cart/').status_code, 200)
+            self.assertEqual(client.get('/api/auth/products/?page=1').status_code, 200)
+            choice.assert_not_called()
+
+    def test_recent_update_is_not_cached_from_replica(self):
+        cache.delete(CATALOG_UPDATED_AT_KEY)
+        with replica_reads():
+            self.assertTrue(catalog_cacheable())
+            bump_catalog_version()
+            self.assertFalse(catalog_cacheable())
+        self.assertTrue(catalog_cacheable())
+
+
+@skipUnless(settings.DATABASE_REPLICAS, 'DATABASE_REPLICA_URLS が設定されていません')
+class ReplicaDatabaseTests(TransactionTestCase):
+    # DATABASE_URL=sqlite:///a.sqlite3 DATABASE_REPLICA_URLS=sqlite:///b.sqlite3 \
+    #     python manage.py test accounts.tests.ReplicaDatabaseTests で実行する
+    databases = '__all__'
+
+    def test_catalog_queries_go_to_replica(self):
+        create_products(Category.objects.create(name='食品', slug='food'), 1)
+        replica = connections[settings.DATABASE_REPLICAS[0]]
+        with CaptureQueriesContext(connection) as primary, CaptureQueriesContext(replica) as replicated:
+            self.assertEqual(self.client.get('/api/auth/products/').status_code, 200)
+        self.assertEqual(len(primary.captured_queries), 0)
+        self.assertGreater(len(replicated.captured_queries), 0)
+
+@override_settings(DB_CONN_HEALTH_CHECK_IDLE=30)
+class ConnectionHealthCheckTests(TestCase):
+    def fake_connection(self, usable, health_checks=True, connected=True, idle=60):
+        return mock.Mock(
+            connection=object() if connected else None,
+            in_atomic_block=False,
+            settings_dict={'CONN_HEALTH_CHECKS': health_checks},
+            is_usable=mock.Mock(return_value=usable),
+            last_query_at=time.monotonic() - idle,
+        )
+
+    def test_closes_broken_idle_connections(self):
+        broken, alive = self.fake_connection(False), self.fake_connection(True)
+        unchecked, idle = self.fake_connection(False, health_checks=False), self.fake_connection(False, connected=False)
+        with mock.patch.object(connections, 'all', return_value=[broken, alive, unchecked, idle]):
+            check_connections()
+        broken.close.assert_called_once_with()
+        alive.close.assert_not_called()
+        self.assertGreater(alive.last_query_at, time.monotonic() - 1)
+        unchecked.is_usable.assert_not_called()
+        idle.is_usable.assert_not_called()
+
+    def test_skips_recently_used_connections(self):
+        # 続けて使われている接続は SELECT 1 で確認しない
+        recent = self.fake_connection(False, idle=1)
+        with mock.patch.object(connections, 'all', return_value=[recent]):
+            check_connections()
+        recent.is_usable.assert_not_called()
+        recent.close.assert_not_called()
+
+    def test_records_last_query_time(self):
+        connection.last_query_at = 0
+        Product.objects.exists()
+        self.assertGreater(connection.last_query_at, time.monotonic() - 1)
+
+
+class CircuitBreakerTests(TestCase):
+    def test_opens_after_consecutive_failures_and_recovers(self):
+        breaker = CircuitBreaker(2, reset_timeout=60, failure_exceptions=(ValueError,))
+        failing = mock.Mock(side_effect=ValueError)
+        for _ in range(2):
+            with self.assertRaises(ValueError):
+                breaker.call(failing)
+        # 開いている間は呼び出さずにすぐエラーを返す
+        with self.assertRaises(CircuitOpenError):
+            breaker.call(failing)
+        self.assertEqual(failing.call_count, 2)
+
+        breaker.reset_timeout = 0
+        self.assertEqual(breaker.call(lambda: 'ok'), 'ok')
+        self.assertFalse(breaker.is_open)
+        self.assertEqual(breaker.failures, 0)
+
+    def test_ignores_other_errors(self):
+        breaker = CircuitBreaker(1, reset_timeout=60, failure_exceptions=(ValueError,))
+        with self.assertRaises(KeyError):
+            breaker.call(mock.Mock(side_effect=KeyError))
+        self.assertFalse(breaker.is_open)
+
+    def test_trial_with_other_error_closes_the_circuit(self):
+        breaker = CircuitBreaker(1, reset_timeout=60, failure_exceptions=(ValueError,))
+        with self.assertRaises(ValueError):
+            breaker.call(mock.Mock(side_effect=ValueError))
+        # reset_timeout が経過した後の試行でカードエラー等（障害として数えない例外）が起きた場合
+        breaker.opened_at -= 60
+        with self.assertRaises(KeyError):
+            breaker.call(mock.Mock(side_effect=KeyError))
+        self.assertFalse(breaker.is_open)
+        self.assertEqual(breaker.call(lambda: 'ok'), 'ok')
+
+
+@override_settings(PAYMENT_GATEWAY='accounts.payments.FakeGateway', PAYMENT_CIRCUIT_FAILURE_THRESHOLD=2)
+class PaymentGatewayTests(TestCase):
+    url = '/api/auth/create-checkout-session/'
+
+    def setUp(self):
+        self.user = UserAccount.objects.create_user('taro@example.com', '太郎', 'password')
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+        category = Category.objects.create(name='食品', slug='food')
+        ShippingInformation.objects.create(
+            user=self.user, address='千代田1-1', city='千代田区', state='東京都', postal_code='1000001', country='JP'
+        )
+        cart = Cart.objects.create(user=self.user)
+        CartItem.objects.add(cart.id, create_products(category, 1)[0].pk, 1)
+
+    def test_fake_gateway_creates_session(self):
+        response = self.client.post(self.url, format='json')
+        self.assertEqual(response.status_code, 201)
+        gateway = get_gateway()
+        self.assertIsInstance(gateway, FakeGateway)
+        self.assertEqual(response.data['id'], gateway.sessions[0].id)
+        self.assertEqual(gateway.sessions[0].client_reference_id, str(response.data['order_id']))
+
+    def test_open_circuit_returns_503_without_calling_stripe(self):
+        get_gateway().fail = True
+        for _ in range(2):
+            self.assertEqual(self.client.post(self.url, format='json').status_code, 400)
+        response = self.client.post(self.url, format='json')
+        self.assertEqual(response.status_code, 503)
+        self.assertFalse(Order.objects.exists())
+        self.assertEqual(CartItem.objects.count(), 1)
+
+
+@override_settings(PAYMENT_GATEWAY='accounts.payments.FakeGateway')
+class AsyncCheckoutTests(TransactionTestCase):
+    url = '/api/auth/create-checkout-session/async/'
+
+    def setUp(self):
+        self.user = UserAccount.objects.create_user('taro@example.com', '太郎', 'password')
+        category = Category.objects.create(name='食品', slug='food')
+        product = create_products(category, 1)[0]
+        ShippingInformation.objects.create(
+            user=self.user, address='千代田1-1', city='千代田区', state='東京都', postal_code='1000001', country='JP'
+        )
+        cart = Cart.objects.create(user=self.user)
+        CartItem.objects.add(cart.id, product.pk, 2)
+        # 3.2 の AsyncClient は HTTP_ を付けずにヘッダー名をそのまま渡す
+        self.token = str(AccessToken.for_user(self.user))
+
+    async def test_places_order(self):
+        response = await AsyncClient().post(self.url, authorization=f'Bearer {self.token}')
+        self.assertEqual(response.status_code, 201)
+        self.assertTrue(response.json()['id'].startswith('cs_fake_'))
+
+    async def test_requires_token(self):
+        response = await AsyncClient().post(self.url)
+        self.assertEqual(response.status_code, 401)
+        response = await AsyncClient().post(self.url, authorization='Bearer invalid')
+        self.assertEqual(response.status_code, 401)
+
+class FakeStripe:
+    """
+    テスト用にStripeのWebhookイベントを作成し、署名付きで送信する
+    """
+    secret = 'whsec_test'
+
+    def __init__(self, client):
+        self.client = client
+        self.counter = 0
+
+    def event(self, type, obj, created=1700000000):
+        self.counter += 1
+        return {'id': f'evt_test_{self.counter}', 'type': type, 'created': created, 'data': {'object': obj}}
+
+    def sign(self, payload, timestamp=None, secret=None):
+        timestamp = int(time.time()) if timestamp is None else timestamp
+        signature = stripe.WebhookSignature._compute_signature(f'{timestamp}.{payload}', secret or self.secret)
+        return f't={timestamp},v1={signature}'
+
+    def send(self, event, **kwargs):
+        payload = json.dumps(event)
+        return self.client.post(
+            '/api/auth/webhooks/stripe/', payload, content_type='application/json',
+            HTTP_STRIPE_SIGNATURE=self.sign(payload, **kwargs)
+        )
+
+
+@override_settings(STRIPE_WEBHOOK_SECRET=FakeStripe.secret, WEBHOOK_MAX_ATTEMPTS=2)
+class StripeWebhookTests(TestCase):
+    def setUp(self):
+        self.user = UserAccount.objects.create_user('taro@example.com', '太郎', 'password')
+        self.stripe = FakeStripe(APIClient())
+
+    def invoice_paid(self, customer='cus_1', email='taro@example.com', period_end=1702592000):
+        return self.stripe.event('invoice.paid', {
+            'customer': customer, 'customer_email': email,
+            'lines': {'data': [{'period': {'start': 1700000000, 'end': period_end}}]},
+        })
+
+    def test_records_and_processes_event(self):
+        with self.assertNumQueries(1):
+            response = self.stripe.send(self.invoice_paid())
+        self.assertEqual(response.status_code, 200)
+        event = WebhookEvent.objects.get()
+        self.assertEqual(event.status, WebhookStatus.PENDING.value)
+        self.user.refresh_from_db()
+        self.assertIsNone(self.user.current_period_end)
+
+        self.assertEqual(process_pending_events(), 1)
+        event.refresh_from_db()
+        self.assertEqual(event.status, WebhookStatus.DONE.value)
+        self.user.refresh_from_db()
+        self.assertEqual(self.user.customer_id, 'cus_1')
+        self.assertEqual(self.user.current_period_end, datetime(2023, 12, 14, 22, 13, 20, tzinfo=timezone.utc))
+
+    def test_duplicate_delivery_is_ignored(self):
+        event = self.invoice_paid()
+        self.stripe.send(event)
+        self.stripe.send(event)
+        self.assertEqual(WebhookEvent.objects.count(), 1)
+        self.assertEqual(process_pending_events(), 1)
+        self.assertEqual(process_pending_events(), 0)
+
+    def test_rejects_when_secret_is_not_set(self):
+        # 空の鍵で署名したイベントも受け付けない
+        with override_settings(STRIPE_WEBHOOK_SECRET=''):
+            self.assertEqual(self.stripe.send(self.invoice_paid(), secret='').status_code, 503)
+            with self.assertRaises(ImproperlyConfigured):
+                record_event(json.dumps(self.invoice_paid()), '')
+        self.assertFalse(WebhookEvent.objects.exists())
+
+    def test_rejects_invalid_signature(self):
+        self.assertEqual(self.stripe.send(self.invoice_paid(), secret='whsec_other').status_code, 400)
+        self.assertEqual(self.stripe.send(self.invoice_paid(), timestamp=1).status_code, 400)
+        self.assertFalse(WebhookEvent.objects.exists())
+
+    def test_retry_then_dead_letter(self):
+        self.stripe.send(self.invoice_paid(customer='cus_unknown', email='unknown@example.com'))
+        process_pending_events()
+        event = WebhookEvent.objects.get()
+        self.assertEqual(event.status, WebhookStatus.FAILED.value)
+        self.assertIn('DoesNotExist', event.last_error)
+        # 再試行時刻になるまでは処理しない
+        self.assertEqual(process_pending_events(), 0)
+
+        WebhookEvent.objects.update(next_attempt_at=timezone.now())
+        process_pending_events()
+        event.refresh_from_db()
+        self.assertEqual((event.status, event.attempts), (WebhookStatus.DEAD.value, 2))
+        WebhookEvent.objects.update(next_attempt_at=timezone.now())
+        self.assertEqual(process_pending_events(), 0)
+
+    def test_checkout_session_and_unknown_types(self):
+        self.stripe.send(self.stripe.event('checkout.session.completed', {
+            'mode': 'subscription', 'customer': 'cus_2', 'customer_details': {'email': 'Taro@example.com'},
+        }))
+        self.stripe.send(self.stripe.event('customer.created', {'id': 'cus_2'}))
+        call_command('process_webhook_events', stdout=StringIO())
+        self.assertEqual(
+            set(WebhookEvent.objects.values_list('status', flat=True)), {WebhookStatus.DONE.value}
+        )
+        self.user.refresh_from_db()
+        self.assertEqual(self.user.customer_id, 'cus_2')
+        self.assertEqual(self.user.current_period_end, datetime(2023, 12, 14, 22, 13, 20, tzinfo=timezone.utc))
+
+
+class EntitlementTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.user = UserAccount.objects.create_user('taro@example.com', '太郎', 'password')
+        self.factory = APIRequestFactory()
+
+    def login(self):
+        response = self.client.post('/api/login/', {'email': 'taro@example.com', 'password': 'password'})
+        return response.json()
+
+    def has_permission(self, token):
+        request = self.factory.get('/', HTTP_AUTHORIZATION=f'Bearer {token}')
+        drf_request = Request(request, authenticators=[ClaimsJWTAuthentication()])
+        return HasActiveSubscription().has_permission(drf_request, None)
+
+    def test_active_claim_authorizes_without_queries(self):
+        UserAccount.objects.filter(pk=self.user.pk).update(current_period_end=timezone.now() + timedelta(days=3))
+        access = self.login()['access']
+        with self.assertNumQueries(0):
+            self.assertTrue(self.has_permission(access))
+
+    def test_renewal_is_visible_before_token_refresh(self):
+        tokens = self.login()
+        self.assertFalse(self.has_permission(tokens['access']))
+        with self.assertNumQueries(0):
+            self.assertFalse(self.has_permission(tokens['access']))
+
+        # 署名付きのWebhookを処理するとキャッシュが削除される
+        stripe_client = FakeStripe(APIClient())
+        created = int((timezone.now() - timedelta(days=1)).timestamp())
+        with override_settings(STRIPE_WEBHOOK_SECRET=FakeStripe.secret):
+            stripe_client.send(stripe_client.event('checkout.session.completed', {
+                'mode': 'subscription', 'customer': 'cus_1', 'customer_email': 'taro@example.com',
+            }, created=created))
+        process_pending_events()
+        self.assertTrue(self.has_permission(tokens['access']))
+
+        access = self.client.post('/api/refresh/', {'refresh': tokens['refresh']}).json()['access']
+        self.assertEqual(AccessToken(access)['period_end'], int(UserAccount.objects.get().current_period_end.timestamp()))
+
+    def test_status_endpoint(self):
+        client = APIClient()
+        client.credentials(HTTP_AUTHORIZATION=f'Bearer {self.login()["access"]}')
+        self.assertEqual(client.get('/api/auth/subscription/status/').json(), {'active': False, 'current_period_end': None})
+
+        self.user.current_period_end = datetime(2100, 1, 1, tzinfo=timezone.utc)
+        self.user.save()
+        with self.assertNumQueries(1):
+            response = client.get('/api/auth/subscription/status/')
+        self.assertEqual(response.json(), {'active': True, 'current_period_end': '2100-01-01T00:00:00Z'})
+        with self.assertNumQueries(0):
+            client.get('/api/auth/subscription/status/')
+
+
+class RegisterTests(TestCase):
+    url = '/api/auth/register/'
+
+    def test_duplicate_email_is_rejected_by_unique_index(self):
+        data = {'name': '太郎', 'email': 'Taro@example.com', 'password': 'password'}
+        self.assertEqual(self.client.post(self.url, data).status_code, 201)
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.post(self.url, dict(data, email='taro@EXAMPLE.com'))
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(response.json(), {'error': '既に登録されているメールアドレスです'})
+        self.assertFalse([q for q in queries.captured_queries if q['sql'].startswith('SELECT')])
+        self.assertEqual(UserAccount.objects.count(), 1)
+
+    @override_settings(PASSWORD_HASH_ITERATIONS=1000)
+    def test_hash_iterations_are_tunable(self):
+        user = UserAccount.objects.create_user('taro@example.com', '太郎', 'password')
+        self.assertTrue(user.password.startswith('pbkdf2_sha256$1000$'))
+        with override_settings(PASSWORD_HASH_ITERATIONS=2000):
+            # 反復回数が変わったハッシュはログイン時に更新される
+            self.assertTrue(user.check_password('password'))
+        self.assertTrue(user.password.startswith('pbkdf2_sha256$2000$'))
+
+
+class AsyncAuthViewTests(TransactionTestCase):
+    async def test_register_and_login(self):
+        register = async_views.RegisterView.as_view()
+        login = async_views.LoginView.as_view(serializer_class=ClaimsTokenObtainPairSerializer)
+        data = {'name': '太郎', 'email': 'taro@example.com', 'password': 'password'}
+        factory = AsyncRequestFactory()
+
+        response = await register(factory.post('/api/auth/register/', data, content_type='application/json'))
+        self.assertEqual(response.status_code, 201)
+        response = await register(factory.post('/api/auth/register/', data, content_type='application/json'))
+        self.assertEqual(response.status_code, 400)
+
+        response = await login(factory.post('/api/login/', data, content_type='application/json'))
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(AccessToken(json.loads(response.content)['access'])['email'], 'taro@example.com')
+
+
+class ProductSearchTests(TestCase):
+    url = '/api/auth/products/search/'
+
+    def setUp(self):
+        cache.clear()
+        category = Category.objects.create(name='食品', slug='food')
+        self.apple, self.juice, self.cake = [
+            Product.objects.create(category=category, name=name, slug=slug, description=description, price=100)
+            for name, slug, description in [
+                ('青森りんご', 'apple', '甘いりんごです'),
+                ('りんごジュース', 'juice', '果汁100%のＪＵＩＣＥ'),
+                ('チーズケーキ', 'cake', 'りんごは使っていません'),
+            ]
+        ]
+
+    def search(self, q, **params):
+        response = self.client.get(self.url, {'q': q, **params})
+        self.assertEqual(response.status_code, 200)
+        return response.json()
+
+    def test_ranks_name_matches_first(self):
+        data = self.search('りんご')
+        self.assertEqual(data['count'], 3)
+        self.assertEqual([p['id'] for p in data['results']], [self.juice.pk, self.apple.pk, self.cake.pk])
+
+    def test_normalizes_width_case_and_combines_terms(self):
+        self.assertEqual([p['id'] for p in self.search('juice')['results']], [self.juice.pk])
+        self.assertEqual([p['id'] for p in self.search('ｒ')['results']], [])
+        self.assertEqual([p['id'] for p in self.search('りんご 青森')['results']], [self.apple.pk])
+        self.assertEqual(self.search('ぶどう')['count'], 0)
+
+    def test_index_follows_product_changes(self):
+        self.search('りんご')
+        self.cake.name = 'りんごケーキ'
+        self.cake.save()
+        self.juice.delete()
+        self.assertEqual([p['id'] for p in self.search('りんご')['results']], [self.cake.pk, self.apple.pk])
+
+    def test_database_search_ranks_like_the_index(self):
+        self.cake.name = 'りんごのチーズケーキ'
+        self.cake.save()
+        # 1〜2文字の語（'りん'・'ｊｕ'・'甘' など）は n-gram の表で引く
+        for query in ['りんご', 'りんご 青森', 'ケーキ', 'ジュース 果汁', 'ぶどう', 'りん', 'ｊｕ', '甘 りんご', '森']:
+            with self.subTest(query):
+                self.assertEqual(list(search.search_database(query)), search.get_index().search(query))
+
+    def test_ngram_table_follows_product_changes(self):
+        grams = lambda product: set(ProductNgram.objects.filter(product=product).values_list('gram', flat=True))
+        self.assertEqual(grams(self.apple), search.document_ngrams('青森りんご', '甘いりんごです'))
+        self.apple.description = '酸っぱい'
+        self.apple.save()
+        self.assertNotIn('甘', grams(self.apple))
+        # 商品名・説明以外の更新では作り直さない
+        ProductNgram.objects.all().delete()
+        Product.objects.get(pk=self.apple.pk).save(update_fields=['price'])
+        self.assertFalse(ProductNgram.objects.exists())
+        self.assertEqual(search.rebuild_ngrams(chunk_size=2), sum(
+            len(search.document_ngrams(p.name, p.description)) for p in Product.objects.all()
+        ))
+        self.assertEqual(list(search.search_database('酸')), [self.apple.pk])
+
+    def test_paginates_and_requires_query(self):
+        data = self.search('りんご', page=1)
+        self.assertEqual(len(data['results']), 3)
+        self.assertIsNone(data['next'])
+        self.assertEqual(self.client.get(self.url).status_code, 400)
+
+
+class ProductFilterTests(QueryBudgetMixin, TestCase):
+    url = '/api/auth/products/'
+
+    def setUp(self):
+        cache.clear()
+        self.food = Category.objects.create(name='食品', slug='food')
+        self.drink = Category.objects.create(name='飲料', slug='drink')
+        self.cheap = create_products(self.food, 1, sales_discount=True, ranking=2)[0]
+        self.mid = create_products(self.food, 1, in_stock=False, ranking=1)[0]
+        self.expensive = create_products(self.drink, 1, recommend=True)[0]
+        Product.objects.filter(pk=self.cheap.pk).update(price=500)
+        Product.objects.filter(pk=self.mid.pk).update(price=2000)
+        Product.objects.filter(pk=self.expensive.pk).update(price=12000)
+
+    def ids(self, query):
+        response = self.client.get(f'{self.url}?{query}')
+        self.assertEqual(response.status_code, 200, response.content)
+        return [p['id'] for p in response.json()['results']]
+
+    def test_filters(self):
+        self.assertEqual(self.ids('category=food'), [self.mid.pk, self.cheap.pk])
+        self.assertEqual(self.ids('category=drink,food&in_stock=true'), [self.expensive.pk, self.cheap.pk])
+        self.assertEqual(self.ids('min_price=1000&max_price=12000'), [self.expensive.pk, self.mid.pk])
+        self.assertEqual(self.ids('sales_discount=1'), [self.cheap.pk])
+        self.assertEqual(self.ids('recommend=true&category=food'), [])
+
+    def test_false_flags_exclude_flagged_products(self):
+        self.assertEqual(self.ids('sales_discount=false'), [self.expensive.pk, self.mid.pk])
+        self.assertEqual(self.ids('recommend=0&in_stock=true'), [self.cheap.pk])
+        # true と false は別のキャッシュになる
+        self.assertEqual(self.ids('sales_discount=true'), [self.cheap.pk])
+
+    def test_sort(self):
+        self.assertEqual(self.ids('sort=price'), [self.cheap.pk, self.mid.pk, self.expensive.pk])
+        self.assertEqual(self.ids('sort=-price'), [self.expensive.pk, self.mid.pk, self.cheap.pk])
+        self.assertEqual(self.ids('sort=ranking'), [self.mid.pk, self.cheap.pk, self.expensive.pk])
+        self.assertEqual(self.ids('sort=created_at'), [self.cheap.pk, self.mid.pk, self.expensive.pk])
+
+    def test_invalid_parameters(self):
+        for query in ['sort=name', 'min_price=abc', 'in_stock=maybe', 'category=unknown', 'cursor=&sort=price']:
+            with self.subTest(query):
+                self.assertEqual(self.client.get(f'{self.url}?{query}').status_code, 400)
+
+    def test_facets_in_one_query(self):
+        # カテゴリの対応表はプロセス内に保持済みとして、検証子の集計・件数・一覧・ファセットの4クエリ
+        get_category_ids()
+        response = self.assertQueryBudget(4, f'{self.url}?category=food&facets=1')
+        self.assertEqual(response.json()['facets'], {
+            'total': 2,
+            # 選択中のカテゴリの条件を除いて数える
+            'categories': {'drink': 1, 'food': 2},
+            'flags': {'sales_discount': 1, 'recommend': 0, 'new_product': 0, 'in_stock': 1},
+            'price': [
+                {'min': 0, 'max': 1000, 'count': 1},
+                {'min': 1000, 'max': 3000, 'count': 1},
+                {'min': 3000, 'max': 5000, 'count': 0},
+                {'min': 5000, 'max': 10000, 'count': 0},
+                {'min': 10000, 'max': None, 'count': 0},
+            ],
+        })
+
+    def test_equivalent_queries_share_cache(self):
+        self.client.get(f'{self.url}?category=food,drink&in_stock=1&facets=1&utm_source=mail')
+        self.assertQueryBudget(0, f'{self.url}?facets=true&in_stock=true&category=drink,food')
+
+
+class RankingTests(QueryBudgetMixin, TestCase):
+    url = '/api/auth/ranking-products/'
+
+    def setUp(self):
+        cache.clear()
+        self.category = Category.objects.create(name='食品', slug='food')
+        self.a, self.b, self.c = create_products(self.category, 3)
+        self.inactive = create_products(self.category, 1, is_active=False)[0]
+        self.users = [UserAccount.objects.create_user(f'user{i}@example.com', f'利用者{i}', 'password') for i in range(3)]
+        shipping = ShippingInformation.objects.create(
+            user=self.users[0], address='千代田1-1', city='千代田区', state='東京都', postal_code='1000001', country='JP'
+        )
+        self.order = Order.objects.create(
+            user=self.users[0], shipping_information=shipping, total_price=0, status='Processing'
+        )
+        old_order = Order.objects.create(
+            user=self.users[0], shipping_information=shipping, total_price=0, status='Processing'
+        )
+        Order.objects.filter(pk=old_order.pk).update(ordered_at=timezone.now() - timedelta(days=30))
+
+        # a: 注文3個（15点）、b: カート3件（6点）、c: お気に入り2件（2点）
+        self.order_detail(self.order, self.a, 3)
+        self.order_detail(self.order, self.b, 100, shipping_state=ShippingState.CANCELED.value)
+        self.order_detail(old_order, self.c, 100)
+        self.order_detail(self.order, self.inactive, 100)
+        for user in self.users:
+            CartItem.objects.add(Cart.objects.create(user=user).id, self.b.pk)
+        for user in self.users[:2]:
+            WishlistItem.objects.add(user.pk, self.c.pk)
+
+    def order_detail(self, order, product, quantity, **kwargs):
+        OrderDetail.objects.create(
+            order=order, product=product, product_name=product.name, quantity=quantity, price=product.price, **kwargs
+        )
+
+    def rankings(self):
+        return dict(Product.objects.filter(ranking__isnull=False).values_list('pk', 'ranking'))
+
+    def test_scores_within_window(self):
+        # キャンセルされた注文・集計期間外の注文・無効な商品は数えない
+        self.assertEqual(compute_scores(), {self.a.pk: 15, self.b.pk: 6, self.c.pk: 2})
+
+    def test_readding_to_cart_moves_it_into_the_window(self):
+        CartItem.objects.update(added_at=timezone.now() - timedelta(days=30))
+        self.assertNotIn(self.b.pk, compute_scores())
+        cart_ids = list(Cart.objects.values_list('pk', flat=True))
+        CartItem.objects.add(cart_ids[0], self.b.pk)
+        CartItem.objects.apply_operations(cart_ids[1], [{'product_id': self.b.pk, 'action': 'increase'}])
+        CartItem.objects.apply_operations(cart_ids[2], [{'product_id': self.b.pk, 'quantity': 1}])
+        self.assertEqual(compute_scores()[self.b.pk], 4)
+
+    def test_update_rankings(self):
+        self.assertEqual(update_rankings(batch_size=1), 3)
+        self.assertEqual(self.rankings(), {self.a.pk: 1, self.b.pk: 2, self.c.pk: 3})
+        # 順位が変わらなければ書き込まない
+        self.assertEqual(update_rankings(), 0)
+
+        # 圏外になった商品は順位を外す
+        with override_settings(RANKING_SIZE=2):
+            self.assertEqual(update_rankings(), 1)
+        self.assertEqual(self.rankings(), {self.a.pk: 1, self.b.pk: 2})
+
+    def test_command(self):
+        out = StringIO()
+        call_command('update_rankings', stdout=out)
+        self.assertIn('3件', out.getvalue())
+
+    def test_endpoint(self):
+        self.assertEqual(self.client.get(self.url).json()['results'], [])
+        update_rankings()
+        # 検証子の集計・件数・一覧の3クエリ（順位の部分インデックスを読むだけで全件を並べ替えない）
+        results = self.assertQueryBudget(3, self.url).json()['results']
+        self.assertEqual([p['id'] for p in results], [self.a.pk, self.b.pk, self.c.pk])
+        self.assertEqual([p['ranking'] for p in results], [1, 2, 3])
+
+
+class RelatedProductTests(QueryBudgetMixin, TestCase):
+    def setUp(self):
+        cache.clear()
+        self.category = Category.objects.create(name='食品', slug='food')
+        self.a, self.b, self.c, self.d = create_products(self.category, 4)
+        self.inactive = create_products(self.category, 1, is_active=False)[0]
+        self.user = UserAccount.objects.create_user('taro@example.com', '太郎', 'password')
+        self.shipping = ShippingInformation.objects.create(
+            user=self.user, address='千代田1-1', city='千代田区', state='東京都', postal_code='1000001', country='JP'
+        )
+        # 注文（重み3）: [a, b], [a, b, c], キャンセルされた [c, d]
+        self.order([self.a, self.b])
+        self.order([self.a, self.b, self.c, self.inactive])
+        self.order([self.c, self.d], shipping_state=ShippingState.CANCELED.value)
+        # カート（重み2）: [a, c]、お気に入り（重み1）: [a, d]
+        cart = Cart.objects.create(user=self.user)
+        for product in (self.a, self.c):
+            CartItem.objects.add(cart.id, product.pk)
+        for product in (self.a, self.d):
+            WishlistItem.objects.add(self.user.pk, product.pk)
+
+    def order(self, products, **kwargs):
+        order = Order.objects.create(
+            user=self.user, shipping_information=self.shipping, total_price=0, status='Processing'
+        )
+        for product in products:
+            OrderDetail.objects.create(
+                order=order, product=product, product_name=product.name, quantity=1, price=product.price, **kwargs
+            )
+
+    def related_ids(self, product):
+        return list(RelatedProduct.objects.filter(product=product).order_by('rank').values_list('related_id', flat=True))
+
+    def test_count_cooccurrences(self):
+        counts = count_cooccurrences()
+        self.assertEqual(counts[self.a.pk], {self.b.pk: 6, self.c.pk: 5, self.d.pk: 1})
+        self.assertEqual(counts[self.d.pk], {self.a.pk: 1})
+        self.assertNotIn(self.inactive.pk, counts)
+
+        # 商品を分けて数えても結果は同じ
+        partitioned = {**count_cooccurrences(0, 2), **count_cooccurrences(1, 2)}
+        self.assertEqual(partitioned, counts)
+
+    def test_large_baskets_are_skipped(self):
+        with override_settings(RELATED_MAX_BASKET_SIZE=2):
+            self.assertEqual(count_cooccurrences()[self.a.pk], {self.b.pk: 3, self.c.pk: 2, self.d.pk: 1})
+
+    def test_build_related_products(self):
+        self.assertEqual(build_related_products(partitions=2), 8)
+        self.assertEqual(self.related_ids(self.a), [self.b.pk, self.c.pk, self.d.pk])
+        self.assertEqual(self.related_ids(self.b), [self.a.pk, self.c.pk])
+
+        # 作り直すと上位 RELATED_PRODUCTS_SIZE 件で置き換わる
+        with override_settings(RELATED_PRODUCTS_SIZE=1):
+            call_command('build_related_products', stdout=StringIO())
+        self.assertEqual(self.related_ids(self.a), [self.b.pk])
+        self.assertEqual(RelatedProduct.objects.count(), 4)
+
+    def test_endpoint(self):
+        url = f'/api/auth/products/{self.a.pk}/related/'
+        self.assertEqual(self.client.get(url).json(), [])
+        build_related_products()
+        # 関連商品の一意インデックスを1回引くだけ
+        response = self.assertQueryBudget(1, url)
+        self.assertEqual([p['id'] for p in response.json()], [self.b.pk, self.c.pk, self.d.pk])
+        self.assertEqual(self.client.get('/api/auth/products/999999/related/').json(), [])
@@ -1,28 +1,42 @@
+from django.conf import settings
 from django.urls import path
-from .views import RegisterView, UserView, SubscriptionView
-from .views import ProductList, ProductDetail, GetCart
-from .views import update_cart, remove_all, add_to_cart, CategoryList, CategoryProductsList, SalesDiscountProducts, RecommendProducts, NewProducts, GetWishlist, CreateCheckoutSessionView, ShippingInformationCreateUpdateView
-from . import views
+from .views import UserView
+from .views import GetCart
+from .views import update_cart, remove_all, add_to_cart, GetWishlist, CreateCheckoutSessionView, ShippingInformationCreateUpdateView
+from . import async_views, views
+
+# ASGI（uvicornワーカー）で動かす場合はカタログを非同期ビューで提供する
+catalog = async_views if settings.ASYNC_CATALOG_VIEWS else views
+auth = async_views if settings.ASYNC_AUTH_VIEWS else views
 
 urlpatterns = [
-    path('register/', RegisterView.as_view()),
+    path('register/', auth.RegisterView.as_view()),
     path('user/', UserView.as_view()),
-    path('subscription/', SubscriptionView.as_view()),
-    path('products/', ProductList.as_view(), name='product_list'),
-    path('products/<int:pk>/', ProductDetail.as_view(), name='product_detail'),
+    path('subscription/status/', views.SubscriptionStatusView.as_view(), name='subscription-status'),
+    path('webhooks/stripe/', views.StripeWebhookView.as_view(), name='stripe-webhook'),
+    path('products/', catalog.ProductList.as_view(), name='product_list'),
+    path('products/search/', catalog.ProductSearch.as_view(), name='product-search'),
+    path('products/<int:pk>/', catalog.ProductDetail.as_view(), name='product_detail'),
+    path('products/<int:pk>/related/', catalog.RelatedProducts.as_view(), name='related-products'),
     path('add_to_cart/', add_to_cart, name='add_to_cart'),
     path('cart/', GetCart.as_view(), name='get-cart'),
     path('cart/update/', update_cart, name='update-cart'),
     path('cart/remove-all/', remove_all, name='remove-all'),
-    path('categories/', CategoryList.as_view(), name='category_list'),
-    path('category/<str:name>/', CategoryProductsList.as_view(), name='category-products'),
-    path('sales-products/', SalesDiscountProducts.as_view()),
-    path('recommend-products/', RecommendProducts.as_view()),
-    path('new-products/', NewProducts.as_view()),
+    path('cart/batch/', views.batch_update_cart, name='batch-update-cart'),
+    path('cart/summary/', views.CartSummary.as_view(), name='cart-summary'),
+    path('categories/', catalog.CategoryList.as_view(), name='category_list'),
+    path('category/<str:name>/', catalog.CategoryProductsList.as_view(), name='category-products'),
+    path('categories/<slug:slug>/products/', catalog.CategoryProductsList.as_view(), name='category-products-by-slug'),
+    path('sales-products/', catalog.SalesDiscountProducts.as_view()),
+    path('recommend-products/', catalog.RecommendProducts.as_view()),
+    path('new-products/', catalog.NewProducts.as_view()),
+    path('ranking-products/', catalog.RankingProducts.as_view(), name='ranking-products'),
     path('wishlist/add/<int:product_id>/', views.add_to_wishlist, name='add_to_wishlist'),
     path('wishlist/remove/<int:product_id>/', views.remove_from_wishlist, name='remove_from_wishlist'),
     path('wishlist/', GetWishlist.as_view(), name='wishlist'),
+    path('wishlist/contains/', views.WishlistContains.as_view(), name='wishlist-contains'),
     path('create-checkout-session/', CreateCheckoutSessionView.as_view(), name='create-checkout-session'),
+    path('create-checkout-session/async/', views.create_checkout_session_async, name='create-checkout-session-async'),
     path('shipping-information/', ShippingInformationCreateUpdateView.as_view(), name='shipping-information'),
 
 
@@ -5,18 +5,36 @@ from rest_framework.views import APIView
 from rest_framework import generics
 from rest_framework.decorators import api_view, permission_classes
 from datetime import datetime
-from dateutil.relativedelta import relativedelta
-from .models import Product, Cart, CartItem, Category, UserAccount, WishlistItem, ShippingInformation
+from decimal import Decimal
+from .models import Product, Cart, CartItem, Category, WishlistItem, ShippingInformation
 # from django.contrib.auth.models import UserAccount
-from .serializers import UserSerializer, CategorySerializer, ProductSerializer, CartSerializer, CartItemSerializer, ShippingInformationSerializer
-from django.shortcuts import get_object_or_404
+from .serializers import UserSerializer, CategorySerializer, ProductSerializer, ProductCardSerializer, CartSerializer, CartItemSerializer, CartBatchSerializer, CartProductSerializer, CartUpdateSerializer, ShippingInformationSerializer
+from django.db import IntegrityError, transaction
 User = get_user_model()
 from rest_framework.permissions import IsAuthenticated
+from rest_framework.exceptions import AuthenticationFailed
 from rest_framework import status
 from django.shortcuts import render, redirect
-from django.http import JsonResponse
+from django.http import Http404, JsonResponse
+import logging
 import stripe
 from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+from django.utils import timezone
+from django.utils.functional import cached_property
+from .authentication import ClaimsJWTAuthentication
+from .cache import CatalogCacheMixin, get_category_id
+from .conditional import ConditionalListMixin, ConditionalRetrieveMixin
+from .entitlements import get_period_end
+from .filters import ProductFilter
+from .pagination import CatalogPagination
+from .replicas import ReplicaReadMixin
+from .search import search_product_ids
+from .orders import OrderError, place_order
+from .payments import CircuitOpenError, run_in_executor
+from .webhooks import record_event
+
+logger = logging.getLogger(__name__)
 
 # アカウント登録
 class RegisterView(APIView):
@@ -29,21 +47,21 @@ class RegisterView(APIView):
             email = data['email'].lower()
             password = data['password']
 
-            # ユーザーの存在確認
-            if not User.objects.filter(email=email).exists():
-                # ユーザーが存在しない場合は作成
+            # 存在確認はせず、メールアドレスのユニーク制約で重複を検出する（同時登録でも1件だけ作成される）
+            with transaction.atomic():
                 User.objects.create_user(name=name, email=email, password=password)
 
-                return Response(
-                    {'success': 'ユーザーの作成に成功しました'},
-                    status=status.HTTP_201_CREATED
-                )
-            else:
-                return Response(
-                    {'error': '既に登録されているメールアドレスです'},
-                    status=status.HTTP_400_BAD_REQUEST
-                )
-        
+            return Response(
+                {'success': 'ユーザーの作成に成功しました'},
+                status=status.HTTP_201_CREATED
+            )
+
+        except IntegrityError:
+            return Response(
+                {'error': '既に登録されているメールアドレスです'},
+                status=status.HTTP_400_BAD_REQUEST
+            )
+
         except:
             return Response(
                 {'error': 'アカウント登録時に問題が発生しました'},
@@ -70,83 +88,116 @@ class UserView(APIView):
             )
 
 
-# サブスク定期請求
-class SubscriptionView(APIView):
-    permission_classes = (permissions.AllowAny,)
+# サブスクの状態（キャッシュから返し、通常はDBを読まない）
+class SubscriptionStatusView(APIView):
+    def get(self, request):
+        period_end = get_period_end(request.user.id)
+        return Response({
+            'active': period_end is not None and period_end > timezone.now().timestamp(),
+            'current_period_end': datetime.fromtimestamp(period_end, tz=timezone.utc) if period_end else None,
+        })
+
+
+# Stripe Webhook（保存のみ行い、処理は process_webhook_events で行う）
+class StripeWebhookView(APIView):
+    authentication_classes = []
+    permission_classes = [permissions.AllowAny]
 
     def post(self, request):
         try:
-            print("SubscriptionView")
-            print(request.data)
-            email = request.data["email"]
-            customer_id = request.data["customer_id"]
-            created = request.data["created"]
-            user_data = User.objects.filter(customer_id=customer_id)
-            if len(user_data):
-                user_data = user_data[0]
-            else:
-                user_data = User.objects.get(email=email)
-                user_data.customer_id = customer_id
-            created = datetime.fromtimestamp(created)
-            # 有効期限は1ヶ月後を設定
-            user_data.current_period_end = created + relativedelta(months=1)
-            user_data.save()
-
-            return Response(
-                {'success': 'サブスク有効期限の更新に成功しました'},
-                status=status.HTTP_200_OK
-            )
-        except:
-            return Response(
-                {'error': 'サブスク有効期限の更新に失敗しました'},
-                status=status.HTTP_500_INTERNAL_SERVER_ERROR
-            )
+            record_event(request.body, request.META.get('HTTP_STRIPE_SIGNATURE', ''))
+        except ImproperlyConfigured:
+            # 署名を検証できないため受け付けない（Stripe は 2xx 以外を再送する）
+            logger.error('STRIPE_WEBHOOK_SECRET is not set; rejecting webhook')
+            return Response({'error': 'Webhook is not configured'}, status=status.HTTP_503_SERVICE_UNAVAILABLE)
+        except (ValueError, KeyError, stripe.error.SignatureVerificationError):
+            return Response({'error': 'Invalid webhook'}, status=status.HTTP_400_BAD_REQUEST)
+        return Response({'received': True}, status=status.HTTP_200_OK)
         
 
-class ProductList(generics.ListAPIView):
-    queryset = Product.objects.all()
-    serializer_class = ProductSerializer
+# 商品一覧（category・min_price・max_price・in_stock・各フラグで絞り込み、sort で並び替え、facets=1 で件数を付ける）
+class ProductList(ReplicaReadMixin, ConditionalListMixin, CatalogCacheMixin, generics.ListAPIView):
+    queryset = Product.objects.cards()
+    serializer_class = ProductCardSerializer
+    pagination_class = CatalogPagination
     permission_classes = [permissions.AllowAny]
 
+    @cached_property
+    def product_filter(self):
+        return ProductFilter(self.request.query_params)
+
+    def get_cache_path(self, request):
+        # パラメータの順序や表記が違っても同じ条件なら同じキャッシュを使う
+        return f'{request.path}?{self.product_filter.cache_params()}'
+
+    def filter_queryset(self, queryset):
+        return self.product_filter.apply(super().filter_queryset(queryset))
 
-class ProductDetail(generics.RetrieveAPIView):
-    queryset = Product.objects.all()
+    def get_paginated_response(self, data):
+        response = super().get_paginated_response(data)
+        if self.product_filter.facets:
+            response.data['facets'] = self.product_filter.get_facets(self.get_queryset())
+        return response
+
+
+class ProductDetail(ReplicaReadMixin, ConditionalRetrieveMixin, generics.RetrieveAPIView):
+    queryset = Product.objects.catalog()
     serializer_class = ProductSerializer
     permission_classes = [permissions.AllowAny]
 
 
+# この商品を買った人はこんな商品も（build_related_products で集計した関連商品を順位順に返す）
+# 集計前の商品や存在しない商品は空の一覧を返す
+class RelatedProducts(ReplicaReadMixin, CatalogCacheMixin, generics.ListAPIView):
+    serializer_class = ProductCardSerializer
+    pagination_class = None
+    authentication_classes = []
+    permission_classes = []
+
+    def get_queryset(self):
+        # (商品, 順位) の一意インデックスを1回引き、関連商品とカテゴリはJOINで取得する
+        return Product.objects.filter(related_from__product_id=self.kwargs['pk']).order_by('related_from__rank').cards()
+
+
+# 商品検索（商品名・説明、関連度順）
+class ProductSearch(ReplicaReadMixin, generics.ListAPIView):
+    serializer_class = ProductCardSerializer
+    permission_classes = [permissions.AllowAny]
+
+    def list(self, request, *args, **kwargs):
+        query = request.query_params.get('q', '')
+        if not query.strip():
+            return Response({'error': '検索語を指定してください'}, status=status.HTTP_400_BAD_REQUEST)
+
+        # 索引で並べたIDをページ分割し、そのページの商品だけを取得する
+        page = self.paginate_queryset(search_product_ids(query))
+        rows = {row['id']: row for row in Product.objects.cards().filter(id__in=list(page))}
+        serializer = self.get_serializer([rows[pk] for pk in page if pk in rows], many=True)
+        return self.get_paginated_response(serializer.data)
+
+
 @api_view(['POST'])
 def add_to_cart(request):
-    try:
-        user = UserAccount.objects.get(id=request.user.id)
-    except Exception as e:
-        print("======ERROR======")
-        print(e)
-        return Response({"error": "User not found"}, status=status.HTTP_404_NOT_FOUND)  # エラーレスポンスを返す
-
-    product_id = request.data['product_id']
-    product = Product.objects.get(id=product_id)
+    serializer = CartProductSerializer(data=request.data)
+    serializer.is_valid(raise_exception=True)
+    product_id = serializer.validated_data['product_id']
 
     # カートの取得または作成
-    cart, created = Cart.objects.get_or_create(user=user, defaults={'user': user})
-    
-    # カートアイテムの作成
-    cart_item, created = CartItem.objects.get_or_create(cart=cart, product=product, defaults={'cart': cart, 'product': product})
+    cart, created = Cart.objects.get_or_create(user_id=request.user.id)
 
-    if not created:
-        cart_item.quantity += 1
-        cart_item.save()
+    # カートアイテムの作成（既にあれば数量を加算）
+    try:
+        CartItem.objects.add(cart.id, product_id)
+    except Product.DoesNotExist:
+        return Response({"error": "Product not found"}, status=status.HTTP_404_NOT_FOUND)
 
     return Response({"message": "Product added to cartda!!!"}, status=status.HTTP_201_CREATED)
 
-class GetCart(APIView):
-    permission_classes = [IsAuthenticated]
-
-    def get(self, request):
-        cart, created = Cart.objects.get_or_create(user=request.user)
-        print(cart)
-        items = CartItem.objects.filter(cart=cart)
-        cart_data = [
+def get_cart_data(cart):
+    # 商品をJOINで同時に取得し、小計・合計はSQLで計算する（行数に関わらずクエリ数は一定）
+    items = CartItem.objects.filter(cart=cart).with_line_total().order_by('id')
+    return {
+        "items": [
             {
                 "product": {
                     "id": item.product.id,
@@ -154,152 +205,231 @@ class GetCart(APIView):
                     "price": item.product.price,
                 },
                 "quantity": item.quantity,
-                "total_price": item.get_total_price(),
+                "total_price": item.line_total,
                 "image_url": item.product.image.url if item.product.image else 'photos/default.jpg'
             }
             for item in items
-        ]
+        ],
+        **CartItem.objects.filter(cart=cart).totals(),
+    }
+
 
-        return Response({"items": cart_data}, status=status.HTTP_200_OK)
+class GetCart(APIView):
+    permission_classes = [IsAuthenticated]
+
+    def get(self, request):
+        cart, created = Cart.objects.get_or_create(user_id=request.user.id)
+        return Response(get_cart_data(cart), status=status.HTTP_200_OK)
     
 @api_view(['POST'])
 def update_cart(request):
-    user = UserAccount.objects.get(id=request.user.id)
-    product_id = request.data['product_id']
-    action = request.data['action']
-    product = Product.objects.get(id=product_id)
-    cart, _ = Cart.objects.get_or_create(user=user)
-    cart_item, created = CartItem.objects.get_or_create(cart=cart, product=product)
+    serializer = CartUpdateSerializer(data=request.data)
+    serializer.is_valid(raise_exception=True)
+    product_id = serializer.validated_data['product_id']
+    action = serializer.validated_data['action']
+    cart, _ = Cart.objects.get_or_create(user_id=request.user.id)
 
     if action == "increase":
-        cart_item.quantity += 1
-    elif action == "decrease" and cart_item.quantity > 1:
-        cart_item.quantity -= 1
+        try:
+            CartItem.objects.add(cart.id, product_id)
+        except Product.DoesNotExist:
+            return Response({"error": "Product not found"}, status=status.HTTP_404_NOT_FOUND)
+    elif action == "decrease":
+        CartItem.objects.decrease(cart.id, product_id)
     elif action == "remove":
-        cart_item.delete()
+        CartItem.objects.remove(cart.id, product_id)
         return Response({"message": "Item removed from cart"}, status=status.HTTP_200_OK)
 
-    cart_item.save()
     return Response({"message": "Cart updated"}, status=status.HTTP_200_OK)
 
+@api_view(['POST'])
+def batch_update_cart(request):
+    # 複数のカート操作をまとめて適用し、適用後のカートを返す
+    serializer = CartBatchSerializer(data=request.data)
+    serializer.is_valid(raise_exception=True)
+    cart, _ = Cart.objects.get_or_create(user_id=request.user.id)
+    try:
+        CartItem.objects.apply_operations(cart.id, serializer.validated_data['operations'])
+    except Product.DoesNotExist:
+        return Response({"error": "Product not found"}, status=status.HTTP_404_NOT_FOUND)
+    except IntegrityError:
+        # 同じ商品が同時に追加された場合
+        return Response({"error": "Cart was modified concurrently"}, status=status.HTTP_409_CONFLICT)
+    return Response(get_cart_data(cart), status=status.HTTP_200_OK)
+
 @api_view(['POST'])
 def remove_all(request):
-    user = request.user
-    cart, _ = Cart.objects.get_or_create(user=user)
-    print(cart)
-    cart.items.all().delete()
+    cart, _ = Cart.objects.get_or_create(user_id=request.user.id)
+    CartItem.objects.clear(cart.id)
     return Response({"message": "All items removed from cart"}, status=status.HTTP_200_OK)
 
 
+class CartSummary(APIView):
+    permission_classes = [IsAuthenticated]
+
+    # ヘッダーのバッジ表示用（カートの1行のみを読む）
+    def get(self, request):
+        summary = Cart.objects.filter(user_id=request.user.id).values('item_count', 'subtotal').first()
+        if summary is None:
+            summary = {'item_count': 0, 'subtotal': Decimal('0.00')}
+        return Response(summary, status=status.HTTP_200_OK)
+
 
 
 
 
-class CategoryList(generics.ListAPIView):
+
+class CategoryList(ReplicaReadMixin, ConditionalListMixin, CatalogCacheMixin, generics.ListAPIView):
     queryset = Category.objects.all()
     serializer_class = CategorySerializer
+    last_modified_field = None  # カテゴリは更新日時を持たないためカタログのバージョンのみで判定
     authentication_classes = []
     permission_classes = []
 
-class CategoryProductsList(generics.ListAPIView):
-    serializer_class = ProductSerializer
+class CategoryProductsList(ReplicaReadMixin, ConditionalListMixin, CatalogCacheMixin, generics.ListAPIView):
+    serializer_class = ProductCardSerializer
+    pagination_class = CatalogPagination
 
     authentication_classes = []
     permission_classes = []
 
     def get_queryset(self):
-        category_name = self.kwargs['name']
-        category = get_object_or_404(Category, name=category_name)
-        return Product.objects.filter(category=category)
+        # スラッグ（旧URLでは名前）からカテゴリidを引き、商品のみを1クエリで取得する
+        if 'slug' in self.kwargs:
+            category_id = get_category_id(slug=self.kwargs['slug'])
+        else:
+            category_id = get_category_id(name=self.kwargs['name'])
+        if category_id is None:
+            raise Http404
+        return Product.objects.in_category(category_id).cards()
     
 
-class SalesDiscountProducts(generics.ListAPIView):
-    queryset = Product.objects.filter(sales_discount=True)
-    serializer_class = ProductSerializer
+class SalesDiscountProducts(ReplicaReadMixin, ConditionalListMixin, CatalogCacheMixin, generics.ListAPIView):
+    queryset = Product.objects.sales_discount().cards()
+    serializer_class = ProductCardSerializer
+    pagination_class = CatalogPagination
     authentication_classes = []
     permission_classes = []
 
-class RecommendProducts(generics.ListAPIView):
-    queryset = Product.objects.filter(recommend=True)
-    serializer_class = ProductSerializer
+class RecommendProducts(ReplicaReadMixin, ConditionalListMixin, CatalogCacheMixin, generics.ListAPIView):
+    queryset = Product.objects.recommended().cards()
+    serializer_class = ProductCardSerializer
+    pagination_class = CatalogPagination
     authentication_classes = []
     permission_classes = []
 
-class NewProducts(generics.ListAPIView):
-    queryset = Product.objects.filter(new_product=True)
-    serializer_class = ProductSerializer
+class NewProducts(ReplicaReadMixin, ConditionalListMixin, CatalogCacheMixin, generics.ListAPIView):
+    queryset = Product.objects.new_products().cards()
+    serializer_class = ProductCardSerializer
+    pagination_class = CatalogPagination
     authentication_classes = []
     permission_classes = []
 
+# ランキング（update_rankings で集計した上位 RANKING_SIZE 件を順位の部分インデックスから読む）
+class RankingProducts(ReplicaReadMixin, ConditionalListMixin, CatalogCacheMixin, generics.ListAPIView):
+    serializer_class = ProductCardSerializer
+    authentication_classes = []
+    permission_classes = []
+
+    def get_queryset(self):
+        # 順位は1から連番のため、件数の上限は順位の範囲で絞る
+        return Product.objects.ranked().filter(ranking__lte=settings.RANKING_SIZE).cards()
+
 
 class GetWishlist(APIView):
     permission_classes = [IsAuthenticated]
 
     def get(self, request):
-        print("GET WISHLIST")
-        
-        wishlist_items = WishlistItem.objects.filter(user=request.user)
-        wishlist_data = [{"product_id": item.product.id} for item in wishlist_items]
-        
+        # 商品idは明細の行にあるため商品を読み込まない
+        wishlist_data = [
+            {"product_id": product_id}
+            for product_id in WishlistItem.objects.product_ids(request.user.id)
+        ]
         return Response(wishlist_data, status=status.HTTP_200_OK)
-    
+
+
+class WishlistContains(APIView):
+    permission_classes = [IsAuthenticated]
+    max_ids = 100
+
+    # 商品一覧の1ページ分について、お気に入り済みの商品idを1クエリで返す
+    def get(self, request):
+        try:
+            ids = [int(i) for i in request.query_params.get('ids', '').split(',') if i]
+        except ValueError:
+            return Response({"error": "ids must be comma separated integers"}, status=status.HTTP_400_BAD_REQUEST)
+        if len(ids) > self.max_ids:
+            return Response({"error": f"ids must not exceed {self.max_ids}"}, status=status.HTTP_400_BAD_REQUEST)
+        product_ids = WishlistItem.objects.product_ids(request.user.id, ids) if ids else []
+        return Response({"product_ids": product_ids}, status=status.HTTP_200_OK)
+
+
 @api_view(['POST'])
 def add_to_wishlist(request, product_id):
-    product = get_object_or_404(Product, pk=product_id)
-    WishlistItem.objects.create(user=request.user, product=product)
-    print("added to wishlist")
-    print(request.user)
-    print(product_id)
-    print(product)
+    # 追加済みの場合も成功として扱う
+    try:
+        WishlistItem.objects.add(request.user.id, product_id)
+    except Product.DoesNotExist:
+        return Response({"status": "error", "message": "Product not found"}, status=status.HTTP_404_NOT_FOUND)
     return Response({"status": "success", "message": "Product added to wishlist"})
 
 @api_view(['POST'])
 def remove_from_wishlist(request, product_id):
-    product = get_object_or_404(Product, pk=product_id)
-    print("remove from wishlist")
-    try:
-        item = WishlistItem.objects.get(user=request.user, product=product)
-        print(item)
-        item.delete()
+    deleted, _ = WishlistItem.objects.filter(user_id=request.user.id, product_id=product_id).delete()
+    if deleted:
         return Response({"status": "success", "message": "Product removed from wishlist"})
-    except WishlistItem.DoesNotExist:
-        return Response({"status": "error", "message": "Product not found in wishlist"}, status=status.HTTP_404_NOT_FOUND)
+    return Response({"status": "error", "message": "Product not found in wishlist"}, status=status.HTTP_404_NOT_FOUND)
     
 
 
-stripe.api_key = settings.STRIPE_SECRET_KEY
+def _checkout(user_id, request):
+    try:
+        order, session = place_order(
+            user_id,
+            success_url=request.build_absolute_uri('/success'),
+            cancel_url=request.build_absolute_uri('/cancel'),
+        )
+        return {'id': session.id, 'order_id': order.id}, status.HTTP_201_CREATED
+    except OrderError as e:
+        return {'error': str(e)}, status.HTTP_400_BAD_REQUEST
+    except CircuitOpenError as e:
+        # 決済サービスの障害中は待たせずにすぐ返す
+        return {'error': str(e)}, status.HTTP_503_SERVICE_UNAVAILABLE
+    except stripe.error.StripeError as e:
+        return str(e), status.HTTP_400_BAD_REQUEST
+
 
 class CreateCheckoutSessionView(APIView):
-    print("CreateCheckoutSessionView")
+    # 注文を作成してStripeのチェックアウトセッションを返す（金額はサーバー側のカートから計算）
     def post(self, request, *args, **kwargs):
-        print(request.data) # Debug statement
+        data, code = _checkout(request.user.id, request)
+        return Response(data, status=code)
 
-        amount = request.data.get('totalPrice', 0) * 100 # Cents
-        try:
-            session = stripe.checkout.Session.create(
-                payment_method_types=['card'],
-                line_items=[
-                    {
-                        'price_data': {
-                            'currency': 'usd',
-                            'product_data': {
-                                'name': 'Total',
-                            },
-                            'unit_amount': amount,
-                        },
-                        'quantity': 1,
-                    },
-                ],
-                mode='payment',
-                success_url=request.build_absolute_uri('/success'),
-                cancel_url=request.build_absolute_uri('/cancel'),
-            )
-            return Response({'id': session.id}, status=status.HTTP_201_CREATED)
-        except Exception as e:
-            return Response(str(e), status=status.HTTP_400_BAD_REQUEST)
-        
+
+def _checkout_in_worker(request):
+    try:
+        authenticated = ClaimsJWTAuthentication().authenticate(request)
+    except AuthenticationFailed as e:
+        return {'detail': str(e.detail)}, status.HTTP_401_UNAUTHORIZED
+    if authenticated is None:
+        return {'detail': 'Authentication credentials were not provided.'}, status.HTTP_401_UNAUTHORIZED
+    return _checkout(authenticated[0].id, request)
+
+
+async def create_checkout_session_async(request):
+    """
+    ASGI（mysite.asgi）で動かすチェックアウト
+    Stripeの応答を待つ間もイベントループは他のリクエストを処理できる
+    同時に実行する数は PAYMENT_GATEWAY_WORKERS で制限する
+    """
+    if request.method != 'POST':
+        return JsonResponse({'detail': 'Method not allowed'}, status=status.HTTP_405_METHOD_NOT_ALLOWED)
+    data, code = await run_in_executor(_checkout_in_worker, request)
+    return JsonResponse(data, status=code, safe=False)
 
 
+# JWTはヘッダーで送られるためCSRFの対象外にする（csrf_exempt は3.2では非同期ビューに使えない）
+create_checkout_session_async.csrf_exempt = True
 
 
 class ShippingInformationCreateUpdateView(generics.RetrieveUpdateAPIView):
@@ -309,5 +439,5 @@ class ShippingInformationCreateUpdateView(generics.RetrieveUpdateAPIView):
 
     def get_object(self):
         # 既存のShippingInformationを取得するか、新しいインスタンスを作成
-        obj, created = ShippingInformation.objects.get_or_create(user=self.request.user)
+        obj, created = ShippingInformation.objects.get_or_create(user_id=self.request.user.id)
         return obj
\ No newline at end of file
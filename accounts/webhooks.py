@@ -0,0 +1,136 @@
+import json
+import logging
+from datetime import datetime, timedelta
+
+import stripe
+from dateutil.relativedelta import relativedelta
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+from django.db import transaction
+from django.utils import timezone
+
+from .entitlements import invalidate_entitlements
+from .models import UserAccount, WebhookEvent, WebhookStatus
+from .orders import complete_order
+
+logger = logging.getLogger(__name__)
+
+
+def apply_subscription_payment(customer_id, email, period_end):
+    # 顧客IDで見つからない場合はメールアドレスで検索し、顧客IDを紐付ける
+    user_ids = []
+    if customer_id:
+        user_ids = list(UserAccount.objects.filter(customer_id=customer_id).values_list('pk', flat=True))
+    if not user_ids and email:
+        user_ids = list(UserAccount.objects.filter(email=email.lower()).values_list('pk', flat=True))
+    if not user_ids:
+        raise UserAccount.DoesNotExist(f'customer {customer_id} / {email} not found')
+    UserAccount.objects.filter(pk__in=user_ids).update(customer_id=customer_id, current_period_end=period_end)
+    invalidate_entitlements(user_ids)
+
+
+def handle_order_paid(session):
+    # 単発の支払い（place_order で作成した注文）が完了したら注文を確定する
+    if session.get('payment_status') != 'paid':
+        return
+    order_id = (session.get('metadata') or {}).get('order_id') or session.get('client_reference_id')
+    if order_id:
+        complete_order(int(order_id))
+
+
+def handle_checkout_session_completed(event):
+    session = event['data']['object']
+    if session.get('mode') == 'payment':
+        handle_order_paid(session)
+        return
+    if session.get('mode') != 'subscription':
+        return
+    created = datetime.fromtimestamp(event['created'], tz=timezone.utc)
+    email = session.get('customer_email') or (session.get('customer_details') or {}).get('email')
+    # 有効期限は1ヶ月後を設定
+    apply_subscription_payment(session['customer'], email, created + relativedelta(months=1))
+
+
+def handle_invoice_paid(event):
+    invoice = event['data']['object']
+    period_end = max(line['period']['end'] for line in invoice['lines']['data'])
+    apply_subscription_payment(
+        invoice['customer'], invoice.get('customer_email'), datetime.fromtimestamp(period_end, tz=timezone.utc)
+    )
+
+
+def handle_async_payment_succeeded(event):
+    # 銀行振込など、セッションの完了より後に支払いが完了する場合
+    handle_order_paid(event['data']['object'])
+
+
+HANDLERS = {
+    'checkout.session.completed': handle_checkout_session_completed,
+    'checkout.session.async_payment_succeeded': handle_async_payment_succeeded,
+    'invoice.paid': handle_invoice_paid,
+}
+
+
+def record_event(payload, sig_header):
+    """
+    署名を検証してイベントを保存する（処理はワーカーで行う）
+    同じイベントIDが再送された場合は保存しない
+    """
+    # 空の鍵では誰でも署名を作れるため、未設定なら受け付けない
+    if not settings.STRIPE_WEBHOOK_SECRET:
+        raise ImproperlyConfigured('STRIPE_WEBHOOK_SECRET is not set')
+    if hasattr(payload, 'decode'):
+        payload = payload.decode('utf-8')
+    stripe.WebhookSignature.verify_header(
+        payload, sig_header, settings.STRIPE_WEBHOOK_SECRET, stripe.Webhook.DEFAULT_TOLERANCE
+    )
+    event = json.loads(payload)
+    WebhookEvent.objects.bulk_create(
+        [WebhookEvent(event_id=event['id'], type=event['type'], payload=event)],
+        ignore_conflicts=True,
+    )
+    return event
+
+
+def _retry_delay(attempts):
+    return timedelta(seconds=settings.WEBHOOK_RETRY_BASE_SECONDS * 2 ** (attempts - 1))
+
+
+def process_pending_events(batch_size=100):
+    """
+    処理待ち・再試行待ちのイベントをまとめて処理し、処理した件数を返す
+    複数のワーカーで実行しても同じイベントを処理しないよう、対象の行をロックして取得する
+    """
+    now = timezone.now()
+    with transaction.atomic():
+        events = list(
+            WebhookEvent.objects.select_for_update(skip_locked=True)
+            .filter(
+                status__in=[WebhookStatus.PENDING.value, WebhookStatus.FAILED.value],
+                next_attempt_at__lte=now,
+            )
+            .order_by('next_attempt_at', 'id')[:batch_size]
+        )
+        for event in events:
+            event.attempts += 1
+            handler = HANDLERS.get(event.type)
+            try:
+                if handler is not None:
+                    with transaction.atomic():
+                        handler(event.payload)
+            except Exception as e:
+                logger.exception('webhook event %s failed', event.event_id)
+                event.last_error = f'{type(e).__name__}: {e}'
+                if event.attempts >= settings.WEBHOOK_MAX_ATTEMPTS:
+                    event.status = WebhookStatus.DEAD.value
+                else:
+                    event.status = WebhookStatus.FAILED.value
+                    event.next_attempt_at = now + _retry_delay(event.attempts)
+            else:
+                event.status = WebhookStatus.DONE.value
+                event.last_error = ''
+                event.processed_at = timezone.now()
+        WebhookEvent.objects.bulk_update(
+            events, ['status', 'attempts', 'last_error', 'next_attempt_at', 'processed_at']
+        )
+    return len(events)
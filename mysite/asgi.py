@@ -5,6 +5,11 @@ It exposes the ASGI callable as a module-level variable named ``application``.
 
 For more information on this file, see
 https://docs.djangoproject.com/en/3.2/howto/deployment/asgi/
+
+The async checkout view (create-checkout-session/async/) and the async
+catalog views (ASYNC_CATALOG_VIEWS=True) only free the worker while waiting
+on Stripe or the database when served from here, e.g.
+``gunicorn mysite.asgi -k uvicorn.workers.UvicornWorker``.
 """
 
 import os
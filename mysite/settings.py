@@ -1,6 +1,7 @@
 from pathlib import Path
 from datetime import timedelta
 import os
+from django.core.exceptions import ImproperlyConfigured
 from dotenv import load_dotenv
 load_dotenv()
 
@@ -47,6 +48,7 @@ MIDDLEWARE = [
     'django.middleware.clickjacking.XFrameOptionsMiddleware',
     'corsheaders.middleware.CorsMiddleware', # 追加
     'whitenoise.middleware.WhiteNoiseMiddleware',
+    'accounts.replicas.PinPrimaryMiddleware',
 
 
 ]
@@ -84,11 +86,34 @@ DATABASES = {
 
 import dj_database_url
 
+# DB接続をリクエストをまたいで再利用する秒数（0で毎リクエスト接続し直す）
+# 再利用する前に接続が生きているか確認する（accounts.connections.check_connections）
+DB_CONNECTION_OPTIONS = {
+    'conn_max_age': int(os.environ.get('DB_CONN_MAX_AGE', 60)),
+    'conn_health_checks': os.environ.get('DB_CONN_HEALTH_CHECKS', 'True') == 'True',
+}
+# この秒数以上クエリを実行していない接続だけを、リクエストの開始時に確認する
+DB_CONN_HEALTH_CHECK_IDLE = float(os.environ.get('DB_CONN_HEALTH_CHECK_IDLE', 30))
 DATABASES = {
-    'default': dj_database_url.config(
-        default=os.environ.get('DATABASE_URL')
-    )
+    'default': dj_database_url.config(default=os.environ.get('DATABASE_URL'), **DB_CONNECTION_OPTIONS)
 }
+
+# 読み取り専用レプリカ（カンマ区切りのURL）。カタログと管理画面の一覧はレプリカから読む
+# テストではプライマリのテスト用DBをそのまま使う
+DATABASE_REPLICAS = []
+for i, url in enumerate(u.strip() for u in os.environ.get('DATABASE_REPLICA_URLS', '').split(',') if u.strip()):
+    DATABASES[f'replica{i}'] = dict(dj_database_url.parse(url, **DB_CONNECTION_OPTIONS), TEST={'MIRROR': 'default'})
+    DATABASE_REPLICAS.append(f'replica{i}')
+DATABASE_ROUTERS = ['accounts.replicas.ReplicaRouter']
+# 書き込み後にプライマリから読み続ける秒数（レプリカの遅延より長くする）
+REPLICA_STICKY_SECONDS = int(os.environ.get('REPLICA_STICKY_SECONDS', 10))
+
+# PgBouncer等のトランザクションプーリング経由で接続する場合（DB_POOLER=transaction）
+# トランザクションをまたいでサーバー側カーソルを保持できないため無効にする
+if os.environ.get('DB_POOLER') == 'transaction':
+    for database in DATABASES.values():
+        database['DISABLE_SERVER_SIDE_CURSORS'] = True
+
 # DATABASES = {
 #     'default': {
 #         'ENGINE': 'django.db.backends.postgresql',
@@ -100,9 +125,68 @@ DATABASES = {
 #     }
 # }
 
+# Cache
+# ローカルではローカルメモリ、本番では共有キャッシュ（memcached等）を環境変数で指定する
+
+CACHES = {
+    'default': {
+        'BACKEND': os.environ.get('CACHE_BACKEND') or 'django.core.cache.backends.locmem.LocMemCache',
+        'LOCATION': os.environ.get('CACHE_LOCATION', ''),
+    }
+}
+# カタログのバージョン・カテゴリの対応表・検索の索引・サブスクの無効化はワーカー・dyno 間でキャッシュを共有して伝えるため、
+# 本番（DEBUG=False）でプロセス内のキャッシュを使うと、ほかのワーカーが再起動まで古い内容を返し続ける
+PROCESS_LOCAL_CACHE_BACKENDS = (
+    'django.core.cache.backends.locmem.LocMemCache',
+    'django.core.cache.backends.dummy.DummyCache',
+)
+if not DEBUG and CACHES['default']['BACKEND'] in PROCESS_LOCAL_CACHE_BACKENDS:
+    raise ImproperlyConfigured(
+        'CACHE_BACKEND must be a cache shared by all processes when DJANGO_DEBUG=False '
+        '(e.g. django.core.cache.backends.db.DatabaseCache)'
+    )
+
+# カタログ一覧のキャッシュ保持秒数（更新時はバージョンで無効化される）
+CATALOG_CACHE_TIMEOUT = int(os.environ.get('CATALOG_CACHE_TIMEOUT', 60 * 15))
+
+# 商品一覧のファセットの価格帯の境界（円）
+PRODUCT_PRICE_BUCKETS = [1000, 3000, 5000, 10000]
+
+# 売れ筋ランキング（update_rankings で集計する）
+# 直近 RANKING_WINDOW_DAYS 日の注文数量・カート追加・お気に入り追加を重み付けして合計し、上位 RANKING_SIZE 件に順位を付ける
+# carts は集計時点でカートに入っている明細のうち、期間内に追加（数量の増加を含む）されたものの件数（明細ごとに1件）
+# 購入済みのカートは支払い完了時に空になるため carts には含まれず、orders で数える
+RANKING_WINDOW_DAYS = int(os.environ.get('RANKING_WINDOW_DAYS', 7))
+RANKING_WEIGHTS = {'orders': 5, 'carts': 2, 'wishlists': 1}
+RANKING_SIZE = int(os.environ.get('RANKING_SIZE', 100))
+
+# 関連商品（build_related_products で集計する）
+# 同じ注文・カート・お気に入りに入っている回数を重み付けして数え、商品ごとに上位 RELATED_PRODUCTS_SIZE 件を保存する
+RELATED_WEIGHTS = {'orders': 3, 'carts': 2, 'wishlists': 1}
+RELATED_PRODUCTS_SIZE = int(os.environ.get('RELATED_PRODUCTS_SIZE', 10))
+# これより多くの商品が入ったバスケットは数えない
+RELATED_MAX_BASKET_SIZE = int(os.environ.get('RELATED_MAX_BASKET_SIZE', 50))
+
+# ASGIで動かす場合にカタログAPIを非同期ビューで提供する（1ワーカーあたりの同時処理数はスレッド数まで）
+ASYNC_CATALOG_VIEWS = os.environ.get('ASYNC_CATALOG_VIEWS', 'False') == 'True'
+CATALOG_ASYNC_WORKERS = int(os.environ.get('CATALOG_ASYNC_WORKERS', 16))
+# ASGIで動かす場合に登録・ログインを非同期ビューで提供する（ハッシュ計算の同時実行数はCPUコア数程度にする）
+ASYNC_AUTH_VIEWS = os.environ.get('ASYNC_AUTH_VIEWS', 'False') == 'True'
+AUTH_HASHER_WORKERS = int(os.environ.get('AUTH_HASHER_WORKERS', os.cpu_count() or 1))
+
 # Password validation
 # https://docs.djangoproject.com/en/3.2/ref/settings/#auth-password-validators
 
+# パスワードのハッシュ（反復回数は PASSWORD_HASH_ITERATIONS で調整、既定は Django 3.2 と同じ）
+# 回数を下げるとログイン・登録は速くなるが、漏洩時に解読されやすくなる
+PASSWORD_HASHERS = [
+    'accounts.hashers.TunablePBKDF2PasswordHasher',
+    'django.contrib.auth.hashers.PBKDF2SHA1PasswordHasher',
+    'django.contrib.auth.hashers.Argon2PasswordHasher',
+    'django.contrib.auth.hashers.BCryptSHA256PasswordHasher',
+]
+PASSWORD_HASH_ITERATIONS = int(os.environ.get('PASSWORD_HASH_ITERATIONS', 260000))
+
 AUTH_PASSWORD_VALIDATORS = [
     {
         'NAME': 'django.contrib.auth.password_validation.UserAttributeSimilarityValidator',
@@ -151,7 +235,8 @@ REST_FRAMEWORK = {
         'rest_framework.permissions.IsAuthenticated',
     ],
     'DEFAULT_AUTHENTICATION_CLASSES': [
-        'rest_framework_simplejwt.authentication.JWTAuthentication',
+        # ユーザーはトークンのクレームから作り、リクエストごとにDBを読まない
+        'accounts.authentication.ClaimsJWTAuthentication',
     ],
     'DEFAULT_PAGINATION_CLASS': 'rest_framework.pagination.PageNumberPagination',
     'PAGE_SIZE': 12, # 1ページあたりのアイテム数
@@ -186,3 +271,24 @@ MEDIA_ROOT = os.path.join(BASE_DIR, 'media/')
 
 STRIPE_PUBLIC_KEY = os.getenv('STRIPE_PUBLIC_KEY')
 STRIPE_SECRET_KEY = os.getenv('STRIPE_SECRET_KEY')
+# 未設定の場合、Webhook は署名を検証できないため 503 で拒否する
+STRIPE_WEBHOOK_SECRET = os.getenv('STRIPE_WEBHOOK_SECRET', '')
+
+# 決済ゲートウェイ（テスト・負荷計測では accounts.payments.FakeGateway を使う）
+PAYMENT_GATEWAY = os.environ.get('PAYMENT_GATEWAY', 'accounts.payments.StripeGateway')
+# Stripe APIのタイムアウト（秒）と通信エラー時の再試行回数
+STRIPE_CONNECT_TIMEOUT = float(os.environ.get('STRIPE_CONNECT_TIMEOUT', 3))
+STRIPE_READ_TIMEOUT = float(os.environ.get('STRIPE_READ_TIMEOUT', 10))
+STRIPE_MAX_NETWORK_RETRIES = int(os.environ.get('STRIPE_MAX_NETWORK_RETRIES', 1))
+# 連続して失敗した回数がしきい値を超えたら、指定秒数の間は呼び出さずにエラーを返す
+PAYMENT_CIRCUIT_FAILURE_THRESHOLD = int(os.environ.get('PAYMENT_CIRCUIT_FAILURE_THRESHOLD', 5))
+PAYMENT_CIRCUIT_RESET_SECONDS = float(os.environ.get('PAYMENT_CIRCUIT_RESET_SECONDS', 30))
+# 非同期ビューから決済APIを呼び出すスレッド数
+PAYMENT_GATEWAY_WORKERS = int(os.environ.get('PAYMENT_GATEWAY_WORKERS', 8))
+
+# サブスク有効期限をキャッシュする秒数（更新時には削除される）
+ENTITLEMENT_CACHE_TIMEOUT = int(os.environ.get('ENTITLEMENT_CACHE_TIMEOUT', 60 * 60))
+
+# Webhookの再試行回数と間隔（秒、試行ごとに倍にする）
+WEBHOOK_MAX_ATTEMPTS = int(os.environ.get('WEBHOOK_MAX_ATTEMPTS', 5))
+WEBHOOK_RETRY_BASE_SECONDS = int(os.environ.get('WEBHOOK_RETRY_BASE_SECONDS', 60))
@@ -1,13 +1,18 @@
 from django.contrib import admin
 from django.urls import path, include
 from rest_framework_simplejwt.views import TokenObtainPairView, TokenRefreshView, TokenVerifyView
+from accounts import async_views
+from accounts.authentication import ClaimsTokenObtainPairSerializer, ClaimsTokenRefreshSerializer
 
 from django.conf import settings
 from django.conf.urls.static import static
 
+# ASGIで動かす場合はパスワードの照合を上限付きのスレッドプールで行う
+LoginView = async_views.LoginView if settings.ASYNC_AUTH_VIEWS else TokenObtainPairView
+
 urlpatterns = [
-    path('api/login/', TokenObtainPairView.as_view()),
-    path('api/refresh/', TokenRefreshView.as_view()),
+    path('api/login/', LoginView.as_view(serializer_class=ClaimsTokenObtainPairSerializer)),
+    path('api/refresh/', TokenRefreshView.as_view(serializer_class=ClaimsTokenRefreshSerializer)),
     path('api/verify/', TokenVerifyView.as_view()),
     path('api/auth/', include('accounts.urls')),
     path('admin/', admin.site.urls),